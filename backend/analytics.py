@@ -0,0 +1,299 @@
+import json
+
+import numpy
+
+import engine
+
+#
+# Card Tables
+#
+
+ROUNDS = list(engine.Round)
+ROUND_INDICES = {current_round: i for (i, current_round) in enumerate(ROUNDS)}
+
+ALL_CARDS = [engine.Card.from_code(code) for code in range(0, engine.CARD_CODE_COUNT)]
+
+CARD_POINT_VALUES = numpy.array([card.point_value for card in ALL_CARDS], dtype=numpy.int16)
+CARD_UNPLAYED_VALUES = numpy.array([-abs(card.point_value) for card in ALL_CARDS], dtype=numpy.int16)
+CARD_IS_WILD = numpy.array([card.is_wild for card in ALL_CARDS], dtype=bool)
+CARD_IS_RED_THREE = numpy.array([((card.rank == engine.CardRank.THREE) and card.suit.is_red) for card in ALL_CARDS], dtype=bool)
+
+# Book cards are scored in a single pass by packing each card's point value
+# and whether it's wild into one integer
+BOOK_WILD_COUNT_LIMIT = 1024
+CARD_BOOK_VALUES = (CARD_POINT_VALUES.astype(numpy.int32) * BOOK_WILD_COUNT_LIMIT) + CARD_IS_WILD
+
+#
+# Recording
+#
+
+class RoundRecord(object):
+
+    def __init__(self, hands, feet, books, going_out_player_index):
+        self.hands = hands
+        self.feet = feet
+        self.books = books
+        self.going_out_player_index = going_out_player_index
+
+class RecordingGame(engine.Game):
+
+    def __init__(self, player_names, decks, rules=None, shuffle_seed=""):
+        self.round_records = {}
+        super().__init__(player_names, decks, None, rules, shuffle_seed)
+
+    def end_round_with_player_going_out(self, player):
+        hands = [[card.code for card in round_player.hand] for round_player in self.players]
+        feet = [[card.code for card in round_player.foot] for round_player in self.players]
+        books = [{engine.RANK_INDICES[rank]: [card.code for card in book.cards] for (rank, book) in round_player.books[self.round].items()} for round_player in self.players]
+        going_out_player_index = None if player is None else self.players.index(player)
+
+        self.round_records[self.round] = RoundRecord(hands, feet, books, going_out_player_index)
+
+        super().end_round_with_player_going_out(player)
+
+class GameRecord(object):
+
+    @staticmethod
+    def from_replay(player_names, initial_state_json, actions_json):
+        decks = {current_round: engine.Deck.from_json(initial_state_json["decks"][current_round.value]) for current_round in ROUNDS}
+
+        rules_json = initial_state_json.get("rules")
+        rules = engine.RuleSet.from_json(rules_json) if rules_json is not None else engine.DEFAULT_RULES
+
+        game = RecordingGame(player_names, decks, rules, initial_state_json.get("shuffle_seed", ""))
+        for action_json in actions_json:
+            game.apply_action(engine.Action.from_json(action_json))
+
+        return GameRecord(len(player_names), game.round_records, rules)
+
+    @staticmethod
+    def from_stored_game(player_names, initial_state, action_contents):
+        initial_state_json = json.loads(initial_state)
+        actions_json = [json.loads(action_content) for action_content in action_contents]
+        return GameRecord.from_replay(player_names, initial_state_json, actions_json)
+
+    @staticmethod
+    def from_corpus_game(corpus_game):
+        game = corpus_game.replay(RecordingGame)
+        return GameRecord(len(corpus_game.player_names), game.round_records, corpus_game.rules)
+
+    def __init__(self, player_count, round_records, rules=None):
+        self.player_count = player_count
+        self.round_records = round_records
+        self.rules = rules if rules is not None else engine.DEFAULT_RULES
+
+#
+# Encoding
+#
+
+# Each card is stored once, as a code in a flat array. Hand and foot cards
+# carry the index of the (game, player, round) slot that holds them, and book
+# cards are stored book by book with the offset where each book starts and the
+# slot that owns it, so scoring never touches padding. Scoring rules are kept
+# per game, so games played under different variants score in the same pass.
+
+class EncodedGames(object):
+
+    def __init__(self, shape, hand_cards, hand_owners, foot_cards, foot_owners, book_cards, book_offsets, book_owners, went_out, player_mask, round_mask, game_rules):
+        self.shape = shape
+        self.hand_cards = hand_cards
+        self.hand_owners = hand_owners
+        self.foot_cards = foot_cards
+        self.foot_owners = foot_owners
+        self.book_cards = book_cards
+        self.book_offsets = book_offsets
+        self.book_owners = book_owners
+        self.went_out = went_out
+        self.player_mask = player_mask
+        self.round_mask = round_mask
+        self.game_rules = game_rules
+
+    @property
+    def game_count(self):
+        return self.shape[0]
+
+    @property
+    def slot_count(self):
+        return (self.shape[0] * self.shape[1] * self.shape[2])
+
+def encode_games(game_records):
+    game_count = len(game_records)
+    player_count = max([game_record.player_count for game_record in game_records], default=0)
+    round_count = len(ROUNDS)
+
+    hand_cards = []
+    hand_owners = []
+    foot_cards = []
+    foot_owners = []
+    book_cards = []
+    book_offsets = []
+    book_owners = []
+
+    went_out = numpy.zeros((game_count, player_count, round_count), dtype=bool)
+    player_mask = numpy.zeros((game_count, player_count), dtype=bool)
+    round_mask = numpy.zeros((game_count, round_count), dtype=bool)
+
+    complete_book_sizes = numpy.zeros(game_count, dtype=numpy.int64)
+    book_values = numpy.zeros((game_count, 2), dtype=numpy.int64)
+    going_out_bonuses = numpy.zeros(game_count, dtype=numpy.int64)
+
+    for (game_index, game_record) in enumerate(game_records):
+        player_mask[game_index, :game_record.player_count] = True
+
+        rules = game_record.rules.compile()
+        complete_book_sizes[game_index] = rules.complete_book_size
+        book_values[game_index] = rules.book_values
+        going_out_bonuses[game_index] = rules.going_out_bonus
+
+        for (current_round, round_record) in game_record.round_records.items():
+            round_index = ROUND_INDICES[current_round]
+            round_mask[game_index, round_index] = True
+
+            for player_index in range(0, game_record.player_count):
+                slot = (((game_index * player_count) + player_index) * round_count) + round_index
+
+                hand = round_record.hands[player_index]
+                hand_cards.extend(hand)
+                hand_owners.extend([slot] * len(hand))
+
+                foot = round_record.feet[player_index]
+                foot_cards.extend(foot)
+                foot_owners.extend([slot] * len(foot))
+
+                for book in round_record.books[player_index].values():
+                    book_offsets.append(len(book_cards))
+                    book_owners.append(slot)
+                    book_cards.extend(book)
+
+            if round_record.going_out_player_index is not None:
+                went_out[game_index, round_record.going_out_player_index, round_index] = True
+
+    return EncodedGames(
+        (game_count, player_count, round_count),
+        numpy.array(hand_cards, dtype=numpy.uint8),
+        numpy.array(hand_owners, dtype=numpy.int64),
+        numpy.array(foot_cards, dtype=numpy.uint8),
+        numpy.array(foot_owners, dtype=numpy.int64),
+        numpy.array(book_cards, dtype=numpy.uint8),
+        numpy.array(book_offsets, dtype=numpy.int64),
+        numpy.array(book_owners, dtype=numpy.int64),
+        went_out,
+        player_mask,
+        round_mask,
+        EncodedRules(complete_book_sizes, book_values, going_out_bonuses)
+    )
+
+class EncodedRules(object):
+
+    def __init__(self, complete_book_sizes, book_values, going_out_bonuses):
+        self.complete_book_sizes = complete_book_sizes
+        self.book_values = book_values
+        self.going_out_bonuses = going_out_bonuses
+
+#
+# Scoring
+#
+
+class EncodedPoints(object):
+
+    def __init__(self, in_hand, in_foot, in_books, laid_down, for_going_out):
+        self.in_hand = in_hand
+        self.in_foot = in_foot
+        self.in_books = in_books
+        self.laid_down = laid_down
+        self.for_going_out = for_going_out
+
+    @property
+    def total(self):
+        return (self.in_hand + self.in_foot + self.in_books + self.laid_down + self.for_going_out)
+
+def score_games(encoded_games):
+    slot_count = encoded_games.slot_count
+
+    in_hand = sum_by_owner(CARD_UNPLAYED_VALUES[encoded_games.hand_cards], encoded_games.hand_owners, slot_count)
+    in_foot = sum_by_owner(CARD_UNPLAYED_VALUES[encoded_games.foot_cards], encoded_games.foot_owners, slot_count)
+
+    if len(encoded_games.book_offsets) > 0:
+        # Books always hold at least three cards, so reduceat never sees an
+        # empty segment
+        book_sums = numpy.add.reduceat(CARD_BOOK_VALUES[encoded_games.book_cards], encoded_games.book_offsets)
+    else:
+        book_sums = numpy.zeros(0, dtype=numpy.int32)
+
+    book_card_values = book_sums // BOOK_WILD_COUNT_LIMIT
+    book_wild_counts = book_sums % BOOK_WILD_COUNT_LIMIT
+    book_sizes = numpy.diff(encoded_games.book_offsets, append=len(encoded_games.book_cards))
+
+    # Every game owns a contiguous run of (player, round) slots
+    game_rules = encoded_games.game_rules
+    book_games = encoded_games.book_owners // (encoded_games.shape[1] * encoded_games.shape[2])
+
+    book_values = game_rules.book_values[book_games, (book_wild_counts == 0).astype(numpy.int64)]
+    book_values = numpy.where(book_sizes >= game_rules.complete_book_sizes[book_games], book_values, 0)
+
+    in_books = sum_by_owner(book_values, encoded_games.book_owners, slot_count)
+    laid_down = sum_by_owner(book_card_values, encoded_games.book_owners, slot_count)
+    for_going_out = encoded_games.went_out * game_rules.going_out_bonuses[:, numpy.newaxis, numpy.newaxis]
+
+    return EncodedPoints(
+        in_hand.reshape(encoded_games.shape),
+        in_foot.reshape(encoded_games.shape),
+        in_books.reshape(encoded_games.shape),
+        laid_down.reshape(encoded_games.shape),
+        for_going_out
+    )
+
+def sum_by_owner(values, owners, owner_count):
+    return numpy.bincount(owners, weights=values, minlength=owner_count).astype(numpy.int64)
+
+#
+# Aggregate Statistics
+#
+
+class RoundStatistics(object):
+
+    def __init__(self, current_round, average_points, going_out_rate, red_three_penalty_rate):
+        self.current_round = current_round
+        self.average_points = average_points
+        self.going_out_rate = going_out_rate
+        self.red_three_penalty_rate = red_three_penalty_rate
+
+    def to_json(self):
+        return {
+            "round": self.current_round.value,
+            "average_points": self.average_points,
+            "going_out_rate": self.going_out_rate,
+            "red_three_penalty_rate": self.red_three_penalty_rate
+        }
+
+def calculate_round_statistics(encoded_games, encoded_points=None):
+    if encoded_points is None:
+        encoded_points = score_games(encoded_games)
+
+    # (game, player, round) mask of player-rounds that were actually played
+    played = encoded_games.player_mask[:, :, numpy.newaxis] & encoded_games.round_mask[:, numpy.newaxis, :]
+    played_count = played.sum(axis=(0, 1))
+    round_count = encoded_games.round_mask.sum(axis=0)
+
+    total_points = numpy.where(played, encoded_points.total, 0).sum(axis=(0, 1))
+    going_out_count = encoded_games.went_out.any(axis=1).sum(axis=0)
+
+    hand_red_threes = sum_by_owner(CARD_IS_RED_THREE[encoded_games.hand_cards], encoded_games.hand_owners, encoded_games.slot_count)
+    foot_red_threes = sum_by_owner(CARD_IS_RED_THREE[encoded_games.foot_cards], encoded_games.foot_owners, encoded_games.slot_count)
+    has_red_three = ((hand_red_threes + foot_red_threes) > 0).reshape(encoded_games.shape)
+    red_three_count = (has_red_three & played).sum(axis=(0, 1))
+
+    statistics = []
+    for (round_index, current_round) in enumerate(ROUNDS):
+        if round_count[round_index] == 0:
+            statistics.append(RoundStatistics(current_round, 0.0, 0.0, 0.0))
+            continue
+
+        statistics.append(RoundStatistics(
+            current_round,
+            float(total_points[round_index] / played_count[round_index]),
+            float(going_out_count[round_index] / round_count[round_index]),
+            float(red_three_count[round_index] / played_count[round_index])
+        ))
+
+    return statistics
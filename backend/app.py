@@ -1,21 +1,43 @@
+import concurrent.futures
 import datetime
+import hmac
+import multiprocessing
+import os
 
 import flask
 import flask_cors
 import flask_login
 import itsdangerous
-import peewee
 import pusher
 
+import bots
+import cold_storage
+import compaction
 import engine
+import engine_pool
+import http_caching
+import metrics
+import profiling
+import rate_limiting
 import sekrits
+import serialization
+import solver
+import tournaments
+import views
 
 from models import db
 from models import User
+from models import UserSearchTerm
 from models import UserRole
 from models import Game
 from models import UserGame
 from models import Action
+from models import ActionRejectedError
+from models import GameSnapshot
+from models import GameArchive
+from models import Tournament
+from models import TournamentEntrant
+from models import TournamentTable
 
 #
 # Setup
@@ -34,6 +56,222 @@ pusher_client = pusher.Pusher(
     ssl=True
 )
 
+#
+# Serialization
+#
+
+serialization_secrets = sekrits.app_secrets.get("serialization", {})
+response_encoder = serialization.Encoder(serialization_secrets.get("json_backend", "auto"))
+fragment_cache = serialization.FragmentCache(response_encoder, serialization_secrets.get("fragment_cache_megabytes", 64) * 1024 * 1024)
+
+#
+# Compression
+#
+
+compression_secrets = sekrits.app_secrets.get("compression", {})
+compressor = http_caching.Compressor(
+    min_bytes=compression_secrets.get("min_bytes", 1024),
+    gzip_level=compression_secrets.get("gzip_level", 6),
+    brotli_quality=compression_secrets.get("brotli_quality", 4))
+
+#
+# Bulk Game Creation
+#
+
+bulk_create_secrets = sekrits.app_secrets.get("bulk_create", {})
+max_bulk_game_count = bulk_create_secrets.get("max_games", 500)
+
+if bulk_create_secrets.get("process_count", 0) > 1:
+    # Dealing is most of the work of a new game, so big batches are dealt by
+    # worker processes. They're forked here, before any of the background
+    # threads below start, so none of them can hold a lock the workers need;
+    # spawning instead would import this module again in every worker.
+    deal_executor = concurrent.futures.ProcessPoolExecutor(bulk_create_secrets["process_count"], mp_context=multiprocessing.get_context("fork"))
+    deal_executor.submit(int).result()
+else:
+    deal_executor = None
+
+def create_initial_states(player_names_and_rules):
+    if (deal_executor is None) or (len(player_names_and_rules) < bulk_create_secrets.get("min_pool_batch", 16)):
+        return [engine_pool.create_initial_state(player_names, rules) for (player_names, rules) in player_names_and_rules]
+
+    chunk_size = max(1, len(player_names_and_rules) // (bulk_create_secrets["process_count"] * 4))
+    return list(deal_executor.map(engine_pool.create_initial_state, *zip(*player_names_and_rules), chunksize=chunk_size))
+
+#
+# Metrics
+#
+
+if sekrits.app_secrets.get("enable_metrics", False):
+    metrics_sink = metrics.PrometheusMetricsSink()
+else:
+    metrics_sink = None
+
+# /metrics is only served to scrapers that send this as a bearer token
+metrics_token = sekrits.app_secrets.get("metrics_token")
+
+#
+# Profiling
+#
+
+profiling_secrets = sekrits.app_secrets.get("profiling")
+
+if profiling_secrets is not None:
+    request_profiler = profiling.RequestProfiler(
+        slow_request_seconds=profiling_secrets.get("slow_request_seconds", 0.5),
+        sample_rate=profiling_secrets.get("sample_rate", 0.1),
+        dump_dir=profiling_secrets.get("dump_dir", "profiles")
+    )
+    request_profiler.install(app, db)
+else:
+    request_profiler = None
+
+#
+# Admission Control
+#
+
+# Endpoints that replay games, and how many of each run at once by default
+REPLAY_CONCURRENCY = {
+    "sync_user": 16,
+    "add_action_to_game": 16,
+    "find_lay_down_for_game": 4,
+    "view_game": 16
+}
+
+rate_limit_secrets = sekrits.app_secrets.get("rate_limits")
+
+if rate_limit_secrets is not None:
+    bucket_store = rate_limiting.MemoryBucketStore(rate_limit_secrets.get("max_buckets", 100000))
+
+    if rate_limit_secrets.get("redis_url") is not None:
+        bucket_store = rate_limiting.FallbackBucketStore(rate_limiting.RedisBucketStore(rate_limit_secrets["redis_url"]), bucket_store)
+        bucket_store.logger = app.logger
+
+    admission_control = rate_limiting.AdmissionControl(
+        bucket_store,
+        {
+            "user": rate_limiting.Limit(rate_limit_secrets.get("user_rate", 5.0), rate_limit_secrets.get("user_burst", 20)),
+            "game": rate_limiting.Limit(rate_limit_secrets.get("game_rate", 5.0), rate_limit_secrets.get("game_burst", 20))
+        },
+        dict(REPLAY_CONCURRENCY, **rate_limit_secrets.get("max_concurrent", {}))
+    )
+else:
+    admission_control = None
+
+#
+# Bots
+#
+
+def notify_players(game):
+    for usergame in game.usergames:
+        send_sync_notification(usergame.user_id)
+
+bot_secrets = sekrits.app_secrets.get("bots")
+
+if bot_secrets is not None:
+    bot_pool = bots.BotWorkerPool(
+        worker_count=bot_secrets.get("worker_count", 4),
+        poll_seconds=bot_secrets.get("poll_seconds", 5.0),
+        metrics_sink=metrics_sink,
+        notify=notify_players
+    )
+else:
+    bot_pool = None
+
+def enqueue_bot_turn(game):
+    if (bot_pool is None) or game.finished:
+        return
+
+    if User.get_by_id(game.current_user_id).is_bot:
+        bot_pool.enqueue_game(game.id)
+
+#
+# Compaction
+#
+
+compaction_secrets = sekrits.app_secrets.get("compaction")
+
+if compaction_secrets is not None:
+    compactor = compaction.Compactor(
+        poll_seconds=compaction_secrets.get("poll_seconds", 30.0),
+        batch_size=compaction_secrets.get("batch_size", 100),
+        archive_finished_games=compaction_secrets.get("archive_finished_games", True)
+    )
+else:
+    compactor = None
+
+#
+# Cold Storage
+#
+
+cold_storage_secrets = sekrits.app_secrets.get("cold_storage")
+
+if cold_storage_secrets is not None:
+    cold_store = cold_storage.ColdStorage(cold_storage_secrets["directory"])
+    cold_storage_archiver = cold_storage.ColdStorageArchiver(
+        cold_store,
+        poll_seconds=cold_storage_secrets.get("poll_seconds", 3600.0),
+        batch_size=cold_storage_secrets.get("batch_size", 1000),
+        min_age_seconds=cold_storage_secrets.get("min_age_seconds", 604800)
+    )
+else:
+    cold_store = None
+    cold_storage_archiver = None
+
+#
+# Tournaments
+#
+
+tournament_secrets = sekrits.app_secrets.get("tournaments", {})
+max_tournament_entrant_count = tournament_secrets.get("max_entrants", 10000)
+standings_cache = tournaments.StandingsCache(tournament_secrets.get("standings_cache_size", 64))
+
+def notify_tournament_players(game_ids):
+    usergames = UserGame.select().where(UserGame.game.in_(game_ids))
+    send_sync_notifications([usergame.user_id for usergame in usergames])
+
+    for game in Game.select().where(Game.id.in_(game_ids)):
+        enqueue_bot_turn(game)
+
+tournament_director = tournaments.TournamentDirector(
+    poll_seconds=tournament_secrets.get("poll_seconds", 5.0),
+    batch_size=tournament_secrets.get("batch_size", 10),
+    deal=create_initial_states,
+    notify=notify_tournament_players
+)
+
+def cold_store_for_game(game):
+    if cold_store is None:
+        raise cold_storage.ColdStorageError("Game %d is in cold storage, which isn't configured" % game.id)
+
+    return cold_store
+
+#
+# Background Services
+#
+
+# The bots, compactor, archiver and tournament director run on threads that
+# aren't started on import, so scripts, tests and worker processes can import
+# the app without them. app.py's main and the ASGI app's startup start them;
+# other servers either call start_background_services once per process or set
+# start_background_services in the secrets to start them on import.
+
+background_services_started = False
+
+def start_background_services():
+    global background_services_started
+
+    if background_services_started:
+        return
+
+    background_services_started = True
+    for service in (bot_pool, compactor, cold_storage_archiver, tournament_director):
+        if service is not None:
+            service.start(app.logger)
+
+if sekrits.app_secrets.get("start_background_services", False):
+    start_background_services()
+
 #
 # Flask-Login
 #
@@ -52,28 +290,91 @@ def load_user(user_id):
 
 def token_required(function):
     def wrapper(*args, **kwargs):
-        api_token = flask.request.headers.get("X-App-Token")
+        with profiling.phase("auth"):
+            api_token = flask.request.headers.get("X-App-Token")
 
-        if not api_token:
-            return error("No API token found in request", 400)
+            if not api_token:
+                return error("No API token found in request", 400)
 
-        try:
-            signer = itsdangerous.Signer(sekrits.app_secrets["token_signing_key"])
-            email = signer.unsign(api_token).decode("utf-8")
+            try:
+                user = user_for_token(api_token)
+
+                kwargs["current_user"] = user
+                flask_login.login_user(user)
+            except Exception as e:
+                print("Error logging user in with token: " + str(e))
+                return error("Invalid request", 400)
 
-            user = User.get(User.email == email)
+        return function(*args, **kwargs)
+
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+def user_for_token(api_token):
+    return User.get(User.email == email_for_token(api_token))
 
-            kwargs["current_user"] = user
-            flask_login.login_user(user)
-        except Exception as e:
-            print("Error logging user in with token: " + str(e))
-            return error("Invalid request", 400)
+def email_for_token(api_token):
+    signer = itsdangerous.Signer(sekrits.app_secrets["token_signing_key"])
+    return signer.unsign(api_token).decode("utf-8")
+
+#
+# Request Admission
+#
+
+# These go above token_required, so requests are turned away before the
+# user is loaded
+
+def rate_limited(function):
+    def wrapper(*args, **kwargs):
+        if admission_control is not None:
+            keys = rate_limit_keys(flask.request.headers.get("X-App-Token"), flask.request.get_json(silent=True))
+
+            rejection = admission_control.check_rates(function.__name__, keys)
+            if rejection is not None:
+                return too_many_requests(rejection)
 
         return function(*args, **kwargs)
 
     wrapper.__name__ = function.__name__
     return wrapper
 
+def replay_limited(function):
+    def wrapper(*args, **kwargs):
+        if admission_control is None:
+            return function(*args, **kwargs)
+
+        rejection = admission_control.enter(function.__name__)
+        if rejection is not None:
+            return too_many_requests(rejection)
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            admission_control.leave(function.__name__)
+
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+def rate_limit_keys(api_token, body):
+    # The user and then the game a request is for, as far as can be told
+    # without the database. Requests without a valid token aren't counted
+    # against anything, since token_required turns them away anyway, and
+    # otherwise anyone could empty a game's bucket.
+    if not api_token:
+        return []
+
+    try:
+        keys = [("user", email_for_token(api_token))]
+    except (itsdangerous.BadSignature, UnicodeDecodeError):
+        return []
+
+    if type(body) is dict:
+        game_id = body.get("game")
+        if type(game_id) is int:
+            keys.append(("game", game_id))
+
+    return keys
+
 #
 # Database Lifecycle
 #
@@ -88,6 +389,36 @@ def _db_close(exc):
     if not db.is_closed():
         db.close()
 
+#
+# Response Compression
+#
+
+@app.after_request
+def _compress_response(response):
+    if (response.mimetype != "application/json") or response.direct_passthrough or ("Content-Encoding" in response.headers):
+        return response
+
+    body = response.get_data()
+    if not compressor.should_compress(body):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    coding = compressor.negotiate(flask.request.headers.get("Accept-Encoding"))
+    if coding is None:
+        return response
+
+    with profiling.phase("compression"):
+        response.set_data(compressor.compress(body, coding))
+
+    response.headers["Content-Encoding"] = coding
+
+    etag = response.headers.get("ETag")
+    if etag is not None:
+        response.headers["ETag"] = http_caching.coded_entity_tag(etag, coding)
+
+    return response
+
 #
 # Testing
 #
@@ -95,9 +426,15 @@ def _db_close(exc):
 def create_tables():
     db.create_tables([
         User,
+        UserSearchTerm,
         Game,
         UserGame,
-        Action
+        Action,
+        GameSnapshot,
+        GameArchive,
+        Tournament,
+        TournamentEntrant,
+        TournamentTable
     ], safe=True)
 
 #
@@ -165,6 +502,7 @@ def logout():
 # Synchronization
 
 @app.route("/api/sync", methods=["POST"])
+@replay_limited
 @token_required
 def sync_user(current_user):
     if not current_user.is_authenticated:
@@ -178,24 +516,65 @@ def sync_user(current_user):
     if last_updated_string is None:
         return error("Last updated date and time is required", 400)
 
+    server_sync_time_string = sync_time_string()
+
+    last_updated = parse_last_updated(last_updated_string)
+    if last_updated is None:
+        return error("Invalid last updated date and time", 400)
+
+    # Clients that render from server views don't need decks or actions
+    projected_views = body.get("projected_views", False)
+
+    # Clients often sync again after a push that changed nothing they
+    # haven't already got, so the tag is checked before anything is loaded
+    sync_rows = load_sync_rows(current_user, last_updated)
+    etag = sync_etag(current_user, last_updated, projected_views, sync_rows)
+    if http_caching.entity_tag_matches(flask.request.headers.get("If-None-Match"), etag):
+        return not_modified(etag)
+
+    try:
+        (sync_json, view_logs) = load_sync(current_user, last_updated, projected_views, sync_rows)
+    except cold_storage.ColdStorageError as e:
+        return error("Error loading game: " + str(e), 500)
+
+    with profiling.phase("replay"):
+        try:
+            game_views = {game_id: engine_pool.project_views(game_log, current_user.email)[1] for (game_id, game_log) in view_logs.items()}
+        except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+            return error("Error loading game: " + str(e), 400)
+
+    add_game_views(sync_json, game_views)
+
+    response = success(server_sync_time=server_sync_time_string, **sync_json)
+    response.headers["ETag"] = etag
+    return response
+
+def sync_time_string():
     # "Mon, 13 Apr 2020 22:46:09 GMT"
-    server_sync_time_string = datetime.datetime.now(datetime.timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT")
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT")
 
+def parse_last_updated(last_updated_string):
     try:
         # "2020-04-06 18:07:22 -0000"
         last_updated = datetime.datetime.strptime(last_updated_string, "%Y-%m-%d %H:%M:%S %z")
-        if last_updated.tzinfo is None:
-            raise ValueError
-    except ValueError:
-        return error("Invalid last updated date and time", 400)
+    except (TypeError, ValueError):
+        return None
+
+    if last_updated.tzinfo is None:
+        return None
+
+    return last_updated
+
+def load_sync_rows(current_user, last_updated):
+    # The games, usergames and users a sync sends, which are all its tag
+    # needs
 
     # TODO: This is gross and I'm sure there's a better way to do this directly
     #       in a database query
     initial_usergames = UserGame.select().where(UserGame.user == current_user)
     game_ids = [usergame.game_id for usergame in initial_usergames]
-    games = Game.select().where(Game.id.in_(game_ids) & (Game.last_updated > last_updated))
-    usergames = UserGame.select().where(UserGame.game.in_(games))
-    actions = Action.select().where(Action.game.in_(games) & (Action.created > last_updated))
+    games = list(Game.select().where(Game.id.in_(game_ids) & (Game.last_updated > last_updated)))
+    usergames = list(UserGame.select().where(UserGame.game.in_(games)))
 
     # TODO: This is gross and I'm sure there's a better way to do this directly
     #       in a database query
@@ -208,19 +587,108 @@ def sync_user(current_user):
     if current_user.id not in user_ids:
         user_ids.append(current_user.id)
 
-    users = User.select().where(User.id.in_(user_ids) & (User.last_updated > last_updated))
-
-    return success(
-        games=[game.to_json() for game in games],
-        usergames=[usergame.to_json() for usergame in usergames],
-        actions=[action.to_json() for action in actions],
-        users=[user.to_json() for user in users],
-        server_sync_time=server_sync_time_string
-    )
+    users = list(User.select().where(User.id.in_(user_ids) & (User.last_updated > last_updated)))
+
+    return (games, usergames, users)
+
+def sync_etag(current_user, last_updated, projected_views, sync_rows):
+    # A game's actions only change along with its action count, and the
+    # sync time is left out, so polling again with the same cursor gets the
+    # same tag until something the client would see changes
+    (games, usergames, users) = sync_rows
+
+    return http_caching.entity_tag(
+        current_user.id,
+        last_updated,
+        projected_views,
+        [(game.id, game.last_updated, game.action_count, game.in_cold_storage) for game in games],
+        [(usergame.id, usergame.role, usergame.user_accepted) for usergame in usergames],
+        [(user.id, user.last_updated) for user in users])
+
+def load_sync(current_user, last_updated, projected_views, sync_rows=None):
+    # Everything a sync needs from the database, ready to send. Games that
+    # need projected views come back as logs for the caller to replay,
+    # keyed by game ID.
+    if sync_rows is None:
+        sync_rows = load_sync_rows(current_user, last_updated)
+
+    (games, usergames, users) = sync_rows
+
+    # Games in cold storage only have a stub left in the database, so the
+    # rest comes from their archive file
+    cold_records = {}
+    for game in games:
+        if game.in_cold_storage:
+            cold_records[game.id] = cold_store_for_game(game).load_record(game)
+
+    actions = []
+    view_logs = {}
+
+    if projected_views:
+        for game in games:
+            if game.id in cold_records:
+                view_logs[game.id] = cold_storage.record_log(game, cold_records[game.id])
+            else:
+                view_logs[game.id] = game.load_log()
+    else:
+        actions = list(Action.select().where(Action.game.in_(games) & (Action.created > last_updated)))
+
+        # Finished games keep their actions in archives instead
+        for archive in GameArchive.select().where(GameArchive.game.in_(games)):
+            actions += [action for action in archive.load_actions() if action_created_after(action, last_updated)]
+
+        for game in games:
+            if game.id in cold_records:
+                actions += [action for action in cold_storage.record_actions(game, cold_records[game.id]) if action_created_after(action, last_updated)]
+
+    with profiling.phase("serialization"):
+        # Rows that only change along with their version are encoded once
+        # and reused. Projected games get their views added later, and games
+        # in cold storage take their initial state from the record, so those
+        # are left as JSON.
+        games_json = []
+        for game in games:
+            if projected_views:
+                game_json = game.to_json()
+                del game_json["initial_state"]
+            elif game.id in cold_records:
+                game_json = game.to_json()
+                game_json["initial_state"] = cold_records[game.id]["initial_state"]
+            else:
+                # last_updated can be stored to the second, and the current
+                # user changes with every action
+                game_json = fragment_cache.fragment(game, (game.last_updated, game.action_count))
+
+            games_json.append(game_json)
+
+        usergames_json = [usergame.to_json() for usergame in usergames]
+
+        # Actions never change once they have a sequence number
+        actions_json = [fragment_cache.fragment(action, action.sequence) if action.sequence is not None else action.to_json() for action in actions]
+        users_json = [fragment_cache.fragment(user, user.last_updated) for user in users]
+
+    sync_json = {
+        "games": games_json,
+        "usergames": usergames_json,
+        "actions": actions_json,
+        "users": users_json
+    }
+
+    return (sync_json, view_logs)
+
+def add_game_views(sync_json, game_views):
+    # Only projected syncs have views, and their games are still JSON
+    if len(game_views) == 0:
+        return
+
+    for game_json in sync_json["games"]:
+        if game_json["id"] in game_views:
+            game_json["view"] = game_views[game_json["id"]]
 
 # Game Management
 
 @app.route("/api/game/create", methods=["POST"])
+@rate_limited
 @token_required
 def create_game(current_user):
     if not current_user.is_authenticated:
@@ -230,16 +698,11 @@ def create_game(current_user):
     if body is None:
         return error("Could not decode body as JSON", 400)
 
-    title = body.get("title")
-    if (title is None) or (type(title) is not str):
-        return error("Title required", 400)
+    (game_setup, message) = read_game_setup(body)
+    if message is not None:
+        return error(message, 400)
 
-    user_emails = body.get("users")
-    if (user_emails is None) or (type(user_emails) is not list):
-        return error("Emails of other players required", 400)
-
-    if len(user_emails) < 1 or len(user_emails) > 5:
-        return error("Player count is out of range", 400)
+    (title, user_emails, rules) = game_setup
 
     users = [current_user]
     for user_email in user_emails:
@@ -249,7 +712,11 @@ def create_game(current_user):
         else:
             users.append(user)
 
-    game = Game.create(title, users)
+    try:
+        game = Game.create(title, users, rules)
+    except engine.IllegalSetupError as e:
+        return error("Invalid game: " + str(e), 400)
+
     UserGame.create(current_user, game, UserRole.OWNER)
 
     # TODO: [1:] is kinda gross
@@ -261,7 +728,58 @@ def create_game(current_user):
 
     return success(game_id=game.id)
 
+@app.route("/api/game/create_many", methods=["POST"])
+@rate_limited
+@token_required
+def create_games(current_user):
+    if not current_user.is_authenticated:
+        return error("User must be authenticated", 403)
+
+    body = flask.request.get_json()
+    if body is None:
+        return error("Could not decode body as JSON", 400)
+
+    games_json = body.get("games")
+    if (games_json is None) or (type(games_json) is not list) or (len(games_json) == 0):
+        return error("Games required", 400)
+
+    if len(games_json) > max_bulk_game_count:
+        return error("Too many games, at most %d can be created at once" % max_bulk_game_count, 400)
+
+    game_setups = []
+    for game_json in games_json:
+        if type(game_json) is not dict:
+            return error("Invalid game", 400)
+
+        (game_setup, message) = read_game_setup(game_json)
+        if message is not None:
+            return error(message, 400)
+
+        game_setups.append(game_setup)
+
+    # Every player in the batch, in one query
+    all_emails = set([user_email for (title, user_emails, rules) in game_setups for user_email in user_emails])
+    users_by_email = {user.email: user for user in User.select().where(User.email.in_(list(all_emails)))}
+
+    if len(users_by_email) < len(all_emails):
+        return error("Unknown user", 400)
+
+    game_users = [[current_user] + [users_by_email[user_email] for user_email in user_emails] for (title, user_emails, rules) in game_setups]
+
+    try:
+        initial_states = create_initial_states([([user.email for user in users], rules) for (users, (title, user_emails, rules)) in zip(game_users, game_setups)])
+    except engine.IllegalSetupError as e:
+        return error("Invalid game: " + str(e), 400)
+
+    game_ids = Game.create_many([(title, users, initial_state, snapshot_state) for (users, (title, user_emails, rules), (initial_state, snapshot_state)) in zip(game_users, game_setups, initial_states)])
+
+    # One notification per player, however many games they're in
+    send_sync_notifications([user.id for users in game_users for user in users])
+
+    return success(game_ids=game_ids)
+
 @app.route("/api/game/accept", methods=["POST"])
+@rate_limited
 @token_required
 def accept_game_invite(current_user):
     if not current_user.is_authenticated:
@@ -295,6 +813,8 @@ def accept_game_invite(current_user):
     return success()
 
 @app.route("/api/game/add_action", methods=["POST"])
+@rate_limited
+@replay_limited
 @token_required
 def add_action_to_game(current_user):
     if not current_user.is_authenticated:
@@ -312,42 +832,238 @@ def add_action_to_game(current_user):
     if game is None:
         return error("Unknown game", 400)
 
-    if not game.have_all_players_accepted_invite:
-        return error("Players have not all accepted invites yet", 400)
-
     action_json = body.get("action")
     if action_json is None:
         return error("Action required", 400)
 
-    action = Action.create_without_saving(action_json, game)
+    # Only finished games are ever moved to cold storage
+    if game.in_cold_storage:
+        return error("Game is over", 400)
 
-    if not action.content_has_player:
-        return error("Invalid action", 400)
+    with profiling.phase("replay"):
+        try:
+            game.add_action_for_user(current_user, action_json, metrics_sink)
+        except ActionRejectedError as e:
+            return error(str(e), 400)
 
-    if not action.is_for_player(current_user.email):
-        return error("Cannot play for another player", 400)
+    notify_players(game)
+    enqueue_bot_turn(game)
 
-    try:
-        game.load_initial_state()
-        game.load_actions()
-    except (engine.IllegalActionError, engine.IllegalSetupError) as e:
-        return error("Error loading game: " + str(e), 400)
+    return success()
+
+@app.route("/api/game/find_lay_down", methods=["POST"])
+@replay_limited
+@token_required
+def find_lay_down_for_game(current_user):
+    if not current_user.is_authenticated:
+        return error("User must be authenticated", 403)
+
+    body = flask.request.get_json()
+    if body is None:
+        return error("Could not decode body as JSON", 400)
+
+    game_id = body.get("game")
+    if game_id is None:
+        return error("Game required", 400)
 
     try:
-        game.apply_action(action)
-    except (engine.IllegalActionError, engine.IllegalSetupError) as e:
-        return error("Error applying new action: " + str(e), 400)
+        goal = solver.LayDownGoal(body.get("goal", solver.LayDownGoal.FEWEST_CARDS.value))
+    except ValueError:
+        return error("Unknown lay down goal", 400)
 
-    action.save()
+    use_discard_pile = body.get("use_discard_pile", False)
 
-    game.update_current_user()
-    game.last_updated = datetime.datetime.now(datetime.timezone.utc)
-    game.save()
+    game = Game.get_or_none(Game.id == game_id)
+    if game is None:
+        return error("Unknown game", 400)
 
-    for usergame in game.usergames:
-        send_sync_notification(usergame.user_id)
+    if game.in_cold_storage:
+        return error("Game is over", 400)
 
-    return success()
+    # Checked again on the replayed game, but this saves replaying it
+    if game.current_user_id != current_user.id:
+        return error("Not your turn", 400)
+
+    with profiling.phase("replay"):
+        try:
+            game.load_state()
+        except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+            return error("Error loading game: " + str(e), 400)
+
+    lay_down_result = engine_pool.find_lay_down(game.game_engine.game, current_user.email, use_discard_pile, goal)
+
+    if lay_down_result.error is not None:
+        return error(lay_down_result.error, 400)
+    elif lay_down_result.action_json is None:
+        return success(action=None)
+    else:
+        return success(action=lay_down_result.action_json, points=lay_down_result.points)
+
+@app.route("/api/game/view", methods=["POST"])
+@replay_limited
+@token_required
+def view_game(current_user):
+    if not current_user.is_authenticated:
+        return error("User must be authenticated", 403)
+
+    body = flask.request.get_json()
+    if body is None:
+        return error("Could not decode body as JSON", 400)
+
+    game_id = body.get("game")
+    if game_id is None:
+        return error("Game required", 400)
+
+    since = body.get("since")
+    if (since is not None) and ((type(since) is not int) or (since < 0)):
+        return error("Invalid view version", 400)
+
+    game = Game.get_or_none(Game.id == game_id)
+    if game is None:
+        return error("Unknown game", 400)
+
+    if UserGame.get_or_none(UserGame.user == current_user, UserGame.game == game) is None:
+        return error("User is not a part of this game", 400)
+
+    with profiling.phase("replay"):
+        try:
+            # Opening a game in cold storage puts it back in the database
+            if game.in_cold_storage:
+                cold_storage.rehydrate_game(game, cold_store_for_game(game))
+
+            (since_view, view) = game.load_views(current_user.email, since)
+        except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+            return error("Error loading game: " + str(e), 400)
+        except cold_storage.ColdStorageError as e:
+            return error("Error loading game: " + str(e), 500)
+
+    # Clients asking about a version we can't diff from get the whole view
+    if since_view is None:
+        return success(view=view)
+    else:
+        return success(delta=views.diff_views(since_view, view))
+
+# Tournaments
+
+@app.route("/api/tournament/create", methods=["POST"])
+@rate_limited
+@token_required
+def create_tournament(current_user):
+    if not current_user.is_authenticated:
+        return error("User must be authenticated", 403)
+
+    body = flask.request.get_json()
+    if body is None:
+        return error("Could not decode body as JSON", 400)
+
+    title = body.get("title")
+    if (title is None) or (type(title) is not str):
+        return error("Title required", 400)
+
+    # The owner runs the tournament, and only plays if they enter themselves
+    user_emails = body.get("users")
+    if (user_emails is None) or (type(user_emails) is not list):
+        return error("Emails of entrants required", 400)
+
+    user_emails = list(dict.fromkeys(user_emails))
+    if (len(user_emails) < tournaments.MIN_TABLE_SIZE) or (len(user_emails) > max_tournament_entrant_count):
+        return error("Entrant count is out of range", 400)
+
+    table_size = body.get("table_size", 4)
+    if (type(table_size) is not int) or (table_size < tournaments.MIN_TABLE_SIZE) or (table_size > tournaments.MAX_TABLE_SIZE):
+        return error("Table size is out of range", 400)
+
+    if tournaments.table_sizes(len(user_emails), table_size)[0] > table_size:
+        return error("Entrants can't all be seated %d to a table" % table_size, 400)
+
+    round_count = body.get("round_count", 3)
+    if (type(round_count) is not int) or (round_count < 1):
+        return error("Round count is out of range", 400)
+
+    rules_json = body.get("rules")
+    if rules_json is not None:
+        try:
+            rules = engine.RuleSet.from_json(rules_json)
+        except engine.IllegalSetupError as e:
+            return error("Invalid rules: " + str(e), 400)
+    else:
+        rules = None
+
+    users = list(User.select().where(User.email.in_(user_emails)))
+    if len(users) < len(user_emails):
+        return error("Unknown user", 400)
+
+    tournament = Tournament.create(title, current_user, users, table_size, round_count, rules)
+
+    # The director seats the first round
+    tournament_director.wake()
+
+    return success(tournament=tournament.to_json())
+
+def load_tournament_for_user(body, current_user):
+    tournament_id = body.get("tournament")
+    if tournament_id is None:
+        return (None, None, "Tournament required")
+
+    tournament = Tournament.get_or_none(Tournament.id == tournament_id)
+    if tournament is None:
+        return (None, None, "Unknown tournament")
+
+    entrant = TournamentEntrant.get_or_none(TournamentEntrant.tournament == tournament, TournamentEntrant.user == current_user)
+    if (entrant is None) and (tournament.owner_id != current_user.id):
+        return (None, None, "User is not a part of this tournament")
+
+    return (tournament, entrant, None)
+
+@app.route("/api/tournament/view", methods=["POST"])
+@token_required
+def view_tournament(current_user):
+    if not current_user.is_authenticated:
+        return error("User must be authenticated", 403)
+
+    body = flask.request.get_json()
+    if body is None:
+        return error("Could not decode body as JSON", 400)
+
+    (tournament, entrant, message) = load_tournament_for_user(body, current_user)
+    if message is not None:
+        return error(message, 400)
+
+    # The entrant's place and seat, if they're playing
+    if entrant is not None:
+        standing = standings_cache.standing_of(tournament, entrant)
+        standing_json = standing.to_json() if standing is not None else None
+    else:
+        standing_json = None
+
+    return success(tournament=tournament.to_json(), standing=standing_json)
+
+@app.route("/api/tournament/standings", methods=["POST"])
+@token_required
+def view_tournament_standings(current_user):
+    if not current_user.is_authenticated:
+        return error("User must be authenticated", 403)
+
+    body = flask.request.get_json()
+    if body is None:
+        return error("Could not decode body as JSON", 400)
+
+    (tournament, entrant, message) = load_tournament_for_user(body, current_user)
+    if message is not None:
+        return error(message, 400)
+
+    offset = body.get("offset", 0)
+    count = body.get("count", 50)
+    if (type(offset) is not int) or (type(count) is not int) or (offset < 0) or (count < 1) or (count > 500):
+        return error("Invalid page", 400)
+
+    (standings, entrant_count) = standings_cache.standings(tournament, offset, count)
+    users = {user.id: user for user in User.select().where(User.id.in_([standing.entrant.user_id for standing in standings]))}
+
+    return success(
+        standings=[standing.to_json(users.get(standing.entrant.user_id)) for standing in standings],
+        entrant_count=entrant_count
+    )
 
 # Search
 
@@ -368,24 +1084,112 @@ def search_for_user(current_user):
     if len(search_term) == 0:
         return error("Search term must not be empty", 400)
 
-    full_name = peewee.fn.LOWER(User.first_name.concat(" ").concat(User.last_name))
-    search_term = "%" + search_term.lower() + "%"
-    users = User.select().where((User.id != current_user.id) & full_name % search_term).order_by(full_name)
+    offset = body.get("offset", 0)
+    count = body.get("count", 25)
+    if (type(offset) is not int) or (type(count) is not int) or (offset < 0) or (count < 1) or (count > 100):
+        return error("Invalid page", 400)
+
+    users = UserSearchTerm.search(search_term, current_user.id, offset, count)
 
     return success(
-        users=[user.to_json() for user in users]
+        users=[fragment_cache.fragment(user, user.last_updated) for user in users]
     )
 
+# Metrics
+
+def metrics_authorized(authorization):
+    if metrics_token is None:
+        return False
+
+    expected = "Bearer " + metrics_token
+    return hmac.compare_digest(authorization.encode("utf-8"), expected.encode("utf-8"))
+
+@app.route("/metrics", methods=["GET"])
+def export_metrics():
+    if (metrics_sink is None) and (request_profiler is None) and (admission_control is None):
+        return error("Metrics are not enabled", 404)
+
+    if not metrics_authorized(flask.request.headers.get("Authorization", "")):
+        return error("Metrics token required", 403)
+
+    metrics_text = ""
+
+    if metrics_sink is not None:
+        metrics_text += metrics_sink.render()
+
+    if request_profiler is not None:
+        metrics_text += request_profiler.render()
+
+    if admission_control is not None:
+        metrics_text += admission_control.render()
+
+    return flask.Response(metrics_text, mimetype="text/plain; version=0.0.4")
+
 #
 # Helpers
 #
 
 def send_sync_notification(user_id):
     channel = "user-%d" % user_id
-    pusher_client.trigger(channel, "sync", {})
+
+    with profiling.phase("push"):
+        pusher_client.trigger(channel, "sync", {})
+
+def send_sync_notifications(user_ids):
+    # Pusher takes up to 100 channels per trigger
+    channels = ["user-%d" % user_id for user_id in sorted(set(user_ids))]
+
+    with profiling.phase("push"):
+        for start in range(0, len(channels), 100):
+            pusher_client.trigger(channels[start:(start + 100)], "sync", {})
+
+def read_game_setup(game_json):
+    # The title, other players and house rules of a new game, or a message
+    # saying what's wrong with them
+    title = game_json.get("title")
+    if (title is None) or (type(title) is not str):
+        return (None, "Title required")
+
+    user_emails = game_json.get("users")
+    if (user_emails is None) or (type(user_emails) is not list):
+        return (None, "Emails of other players required")
+
+    if len(user_emails) < 1 or len(user_emails) > 5:
+        return (None, "Player count is out of range")
+
+    # House rules are optional, anything left out keeps its usual value
+    rules_json = game_json.get("rules")
+    if rules_json is not None:
+        try:
+            rules = engine.RuleSet.from_json(rules_json)
+        except engine.IllegalSetupError as e:
+            return (None, "Invalid rules: " + str(e))
+    else:
+        rules = None
+
+    return ((title, user_emails, rules), None)
+
+def action_created_after(action, date):
+    created = action.created
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=datetime.timezone.utc)
+
+    return (created > date)
+
+def json_response(response_json, code):
+    with profiling.phase("serialization"):
+        return flask.Response(response_encoder.encode(response_json), status=code, mimetype="application/json")
+
+def not_modified(etag):
+    return flask.Response(status=304, headers={"ETag": etag})
 
 def error(message, code):
-    return (flask.jsonify({"success": False, "message": message}), code)
+    return json_response({"success": False, "message": message}, code)
+
+def too_many_requests(rejection):
+    response = error("Too many requests", 429)
+    response.headers["Retry-After"] = rejection.retry_after_header
+    return response
 
 def success(*args, **kwargs):
     response_json = {"success": True}
@@ -393,11 +1197,16 @@ def success(*args, **kwargs):
     for (key, value) in kwargs.items():
         response_json[key] = value
 
-    return (flask.jsonify(response_json), 200)
+    return json_response(response_json, 200)
 
 #
 # Main
 #
 
 if __name__ == "__main__":
+    # The reloader runs this file in a process that only watches for changes
+    # too, which shouldn't start anything
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_services()
+
     app.run(debug=True)
@@ -0,0 +1,586 @@
+import asyncio
+import concurrent.futures
+import io
+import json
+import multiprocessing
+import os
+import sys
+
+import app as flask_app
+import cold_storage
+import engine
+import engine_pool
+import http_caching
+import sekrits
+import solver
+import views
+
+from models import db
+from models import Game
+from models import UserGame
+from models import ActionRejectedError
+
+#
+# Setup
+#
+
+# An ASGI app for serving the backend with uvicorn:
+#
+#     uvicorn async_app:app
+#
+# The hot endpoints (sync, add_action, view, find_lay_down) are handled here
+# without blocking the event loop: peewee is synchronous, so every database
+# call runs on a thread pool, and every replay runs on a process pool so the
+# engine isn't held back by the GIL. Everything else goes through to the
+# Flask app, which also runs on the thread pool.
+#
+# This hasn't been shown to serve more requests than the Flask app: with
+# benchmarks/loadtest.py the two were within a few percent of each other
+# (112 and 114.5 requests a second), so run the load test against both
+# before switching a deployment over.
+#
+# There's no __main__ here on purpose. Engine workers are spawned, and a
+# spawned process imports the script it was started from again, so running
+# this file directly would import the Flask app in every worker. Under
+# uvicorn the workers only import engine_pool for the functions they run.
+
+async_secrets = sekrits.app_secrets.get("async", {})
+
+DATABASE_THREAD_COUNT = async_secrets.get("database_thread_count", 16)
+ENGINE_PROCESS_COUNT = async_secrets.get("engine_process_count")
+
+class RequestError(Exception):
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+#
+# Pools
+#
+
+class Pools(object):
+
+    def __init__(self, database_thread_count, engine_process_count):
+        self.database_thread_count = database_thread_count
+        self.engine_process_count = engine_process_count or os.cpu_count()
+        self.database_executor = None
+        self.engine_executor = None
+
+    def start(self):
+        if self.database_executor is not None:
+            return
+
+        self.database_executor = concurrent.futures.ThreadPoolExecutor(self.database_thread_count, thread_name_prefix="database")
+
+        # Engine workers are spawned rather than forked, so they don't inherit
+        # database connections or the background threads of the Flask app
+        self.engine_executor = concurrent.futures.ProcessPoolExecutor(self.engine_process_count, mp_context=multiprocessing.get_context("spawn"))
+
+    def stop(self):
+        if self.database_executor is None:
+            return
+
+        self.database_executor.shutdown(wait=True)
+        self.engine_executor.shutdown(wait=True)
+        self.database_executor = None
+        self.engine_executor = None
+
+    async def warm_up(self):
+        # Starts every engine worker now, instead of on the first requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.engine_executor, os.getpid) for _ in range(0, self.engine_process_count)])
+
+    async def run_query(self, function, *args):
+        # Each call gets a connection for as long as it runs, like a request
+        # does in the Flask app
+        self.start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.database_executor, run_with_connection, function, args)
+
+    async def run_in_thread(self, function, *args):
+        self.start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.database_executor, function, *args)
+
+    async def run_engine(self, function, *args):
+        self.start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.engine_executor, function, *args)
+
+def run_with_connection(function, args):
+    with db.connection_context():
+        return function(*args)
+
+pools = Pools(DATABASE_THREAD_COUNT, ENGINE_PROCESS_COUNT)
+
+# Notifications are sent after the response, and the tasks are kept here so
+# they aren't garbage collected before they finish
+background_tasks = set()
+
+def run_in_background(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(finish_background_task)
+
+def finish_background_task(task):
+    background_tasks.discard(task)
+
+    if (not task.cancelled()) and (task.exception() is not None):
+        flask_app.app.logger.warning("Couldn't notify players: " + str(task.exception()))
+
+#
+# Token Authentication
+#
+
+def load_user_for_token(api_token):
+    try:
+        return flask_app.user_for_token(api_token)
+    except Exception:
+        raise RequestError("Invalid request", 400)
+
+async def authenticate(request):
+    api_token = request.headers.get("x-app-token")
+    if not api_token:
+        raise RequestError("No API token found in request", 400)
+
+    return await pools.run_query(load_user_for_token, api_token)
+
+#
+# Game API
+#
+
+# The same checks and messages as the Flask routes, split into the parts that
+# touch the database and the parts that touch the engine
+
+async def sync_user(request, current_user):
+    body = request.json()
+
+    last_updated_string = body.get("last_updated")
+    if last_updated_string is None:
+        raise RequestError("Last updated date and time is required", 400)
+
+    server_sync_time_string = flask_app.sync_time_string()
+
+    last_updated = flask_app.parse_last_updated(last_updated_string)
+    if last_updated is None:
+        raise RequestError("Invalid last updated date and time", 400)
+
+    projected_views = body.get("projected_views", False)
+
+    try:
+        (etag, sync_json, view_logs) = await pools.run_query(prepare_sync, current_user, last_updated, projected_views, request.headers.get("if-none-match"))
+    except cold_storage.ColdStorageError as e:
+        raise RequestError("Error loading game: " + str(e), 500)
+
+    if sync_json is None:
+        return not_modified(etag)
+
+    game_ids = list(view_logs.keys())
+
+    try:
+        projections = await asyncio.gather(*[pools.run_engine(engine_pool.project_views, view_logs[game_id], current_user.email) for game_id in game_ids])
+    except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+        raise RequestError("Error loading game: " + str(e), 400)
+
+    flask_app.add_game_views(sync_json, {game_id: view for (game_id, (_, view)) in zip(game_ids, projections)})
+
+    response = success(server_sync_time=server_sync_time_string, **sync_json)
+    response.headers["etag"] = etag
+    return response
+
+def prepare_sync(current_user, last_updated, projected_views, if_none_match):
+    sync_rows = flask_app.load_sync_rows(current_user, last_updated)
+    etag = flask_app.sync_etag(current_user, last_updated, projected_views, sync_rows)
+
+    if http_caching.entity_tag_matches(if_none_match, etag):
+        return (etag, None, None)
+
+    (sync_json, view_logs) = flask_app.load_sync(current_user, last_updated, projected_views, sync_rows)
+    return (etag, sync_json, view_logs)
+
+def load_game(game_id, allow_cold_storage=False):
+    game = Game.get_or_none(Game.id == game_id)
+    if game is None:
+        raise RequestError("Unknown game", 400)
+
+    # Only finished games are ever moved to cold storage
+    if game.in_cold_storage and not allow_cold_storage:
+        raise RequestError("Game is over", 400)
+
+    return game
+
+def prepare_action(game_id, current_user, action_json):
+    game = load_game(game_id)
+
+    try:
+        action = game.check_action_for_user(current_user, action_json)
+    except ActionRejectedError as e:
+        raise RequestError(str(e), 400)
+
+    return (game, action, game.load_log())
+
+def append_action(game, action, applied_action):
+    try:
+        game.append_action(action, applied_action)
+    except ActionRejectedError as e:
+        raise RequestError(str(e), 400)
+
+def notify_players(game):
+    flask_app.notify_players(game)
+    flask_app.enqueue_bot_turn(game)
+
+async def add_action_to_game(request, current_user):
+    body = request.json()
+
+    game_id = body.get("game")
+    if game_id is None:
+        raise RequestError("Game required", 400)
+
+    action_json = body.get("action")
+    if action_json is None:
+        raise RequestError("Action required", 400)
+
+    (game, action, game_log) = await pools.run_query(prepare_action, game_id, current_user, action_json)
+
+    try:
+        applied_action = await pools.run_engine(engine_pool.apply_action, game_log, action_json)
+    except engine_pool.LoadError as e:
+        raise RequestError("Error loading game: " + str(e), 400)
+    except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+        raise RequestError("Error applying new action: " + str(e), 400)
+
+    await pools.run_query(append_action, game, action, applied_action)
+
+    run_in_background(pools.run_query(notify_players, game))
+
+    return success()
+
+def prepare_lay_down(game_id, current_user):
+    game = load_game(game_id)
+
+    # Checked again on the replayed game, but this saves replaying it
+    if game.current_user_id != current_user.id:
+        raise RequestError("Not your turn", 400)
+
+    return game.load_log()
+
+async def find_lay_down_for_game(request, current_user):
+    body = request.json()
+
+    game_id = body.get("game")
+    if game_id is None:
+        raise RequestError("Game required", 400)
+
+    try:
+        goal = solver.LayDownGoal(body.get("goal", solver.LayDownGoal.FEWEST_CARDS.value))
+    except ValueError:
+        raise RequestError("Unknown lay down goal", 400)
+
+    use_discard_pile = body.get("use_discard_pile", False)
+
+    game_log = await pools.run_query(prepare_lay_down, game_id, current_user)
+
+    try:
+        lay_down_result = await pools.run_engine(engine_pool.find_lay_down_in_log, game_log, current_user.email, use_discard_pile, goal)
+    except engine_pool.LoadError as e:
+        raise RequestError("Error loading game: " + str(e), 400)
+
+    if lay_down_result.error is not None:
+        raise RequestError(lay_down_result.error, 400)
+    elif lay_down_result.action_json is None:
+        return success(action=None)
+    else:
+        return success(action=lay_down_result.action_json, points=lay_down_result.points)
+
+def prepare_view(game_id, current_user, since):
+    game = load_game(game_id, allow_cold_storage=True)
+
+    if UserGame.get_or_none(UserGame.user == current_user, UserGame.game == game) is None:
+        raise RequestError("User is not a part of this game", 400)
+
+    try:
+        # Opening a game in cold storage puts it back in the database
+        if game.in_cold_storage:
+            cold_storage.rehydrate_game(game, flask_app.cold_store_for_game(game))
+    except cold_storage.ColdStorageError as e:
+        raise RequestError("Error loading game: " + str(e), 500)
+
+    return game.load_log(since)
+
+async def view_game(request, current_user):
+    body = request.json()
+
+    game_id = body.get("game")
+    if game_id is None:
+        raise RequestError("Game required", 400)
+
+    since = body.get("since")
+    if (since is not None) and ((type(since) is not int) or (since < 0)):
+        raise RequestError("Invalid view version", 400)
+
+    game_log = await pools.run_query(prepare_view, game_id, current_user, since)
+
+    try:
+        (since_view, view) = await pools.run_engine(engine_pool.project_views, game_log, current_user.email, since)
+    except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+        raise RequestError("Error loading game: " + str(e), 400)
+
+    # Clients asking about a version we can't diff from get the whole view
+    if since_view is None:
+        return success(view=view)
+    else:
+        return success(delta=views.diff_views(since_view, view))
+
+ROUTES = {
+    "/api/sync": sync_user,
+    "/api/game/add_action": add_action_to_game,
+    "/api/game/find_lay_down": find_lay_down_for_game,
+    "/api/game/view": view_game
+}
+
+# Every route here replays games, so each has a cap on how many run at once,
+# and the ones that change games are rate limited too, as in the Flask app
+RATE_LIMITED_ROUTES = {"/api/game/add_action"}
+
+#
+# Requests and Responses
+#
+
+class Request(object):
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1") for (name, value) in scope["headers"]}
+
+    def json(self):
+        try:
+            body = json.loads(self.body)
+        except ValueError:
+            body = None
+
+        if type(body) is not dict:
+            raise RequestError("Could not decode body as JSON", 400)
+
+        return body
+
+class Response(object):
+
+    def __init__(self, body_json, code, headers=None):
+        self.body_json = body_json
+        self.code = code
+        self.headers = headers or {}
+
+    def encode(self):
+        # Encoded the same way as the Flask app's responses, so clients can't
+        # tell which app answered
+        if self.body_json is None:
+            return b""
+
+        return flask_app.response_encoder.encode(self.body_json)
+
+def not_modified(etag):
+    return Response(None, 304, {"etag": etag})
+
+def error(message, code):
+    return Response({"success": False, "message": message}, code)
+
+def success(*args, **kwargs):
+    response_json = {"success": True}
+
+    for (key, value) in kwargs.items():
+        response_json[key] = value
+
+    return Response(response_json, 200)
+
+def too_many_requests(rejection):
+    response = error("Too many requests", 429)
+    response.headers["retry-after"] = rejection.retry_after_header
+    return response
+
+async def read_body(receive):
+    body = b""
+
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+
+        if not message.get("more_body", False):
+            return body
+
+async def send_response(send, response, accept_encoding=None):
+    body = response.encode()
+    headers = dict(response.headers)
+
+    # Compressed the same way as the Flask app's responses too, on the
+    # thread pool since zlib lets go of the GIL
+    compressor = flask_app.compressor
+    if (response.body_json is not None) and compressor.should_compress(body):
+        headers["vary"] = "Accept-Encoding"
+
+        coding = compressor.negotiate(accept_encoding)
+        if coding is not None:
+            body = await pools.run_in_thread(compressor.compress, body, coding)
+            headers["content-encoding"] = coding
+
+            if "etag" in headers:
+                headers["etag"] = http_caching.coded_entity_tag(headers["etag"], coding)
+
+    if response.body_json is not None:
+        headers["content-type"] = "application/json"
+        headers["content-length"] = str(len(body))
+
+    headers["access-control-allow-origin"] = "*"
+
+    await send({
+        "type": "http.response.start",
+        "status": response.code,
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for (name, value) in headers.items()]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+#
+# Flask Bridge
+#
+
+# Every other route is served by the Flask app as a WSGI app on the thread
+# pool, so the two can't drift apart
+
+def wsgi_environ(scope, body):
+    (server_name, server_port) = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+
+    for (name, value) in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = (environ[key] + "," + value) if key in environ else value
+
+    return environ
+
+def call_flask_app(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for (name, value) in headers]
+        return lambda data: None
+
+    result = flask_app.app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+    return (response["status"], response["headers"], body)
+
+async def forward_to_flask_app(scope, body, send):
+    (status, headers, body) = await pools.run_in_thread(call_flask_app, wsgi_environ(scope, body))
+
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+#
+# ASGI
+#
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
+    elif scope["type"] == "http":
+        await handle_request(scope, receive, send)
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            flask_app.start_background_services()
+            pools.start()
+            await pools.warm_up()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if len(background_tasks) > 0:
+                await asyncio.wait(list(background_tasks))
+
+            pools.stop()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def handle_request(scope, receive, send):
+    body = await read_body(receive)
+    handler = ROUTES.get(scope["path"])
+
+    if (handler is None) or (scope["method"] != "POST"):
+        await forward_to_flask_app(scope, body, send)
+        return
+
+    request = Request(scope, body)
+
+    rejection = check_rates(request, scope["path"], handler.__name__)
+    if rejection is None:
+        rejection = enter(handler.__name__)
+
+    if rejection is not None:
+        await send_response(send, too_many_requests(rejection))
+        return
+
+    try:
+        current_user = await authenticate(request)
+        response = await handler(request, current_user)
+    except RequestError as e:
+        response = error(e.message, e.code)
+    finally:
+        leave(handler.__name__)
+
+    await send_response(send, response, request.headers.get("accept-encoding"))
+
+def check_rates(request, path, endpoint):
+    # On the event loop, before the request waits for a database thread, so
+    # it's turned away just as fast when the pool is busy
+    admission_control = flask_app.admission_control
+    if (admission_control is None) or (path not in RATE_LIMITED_ROUTES):
+        return None
+
+    try:
+        body = json.loads(request.body)
+    except ValueError:
+        body = None
+
+    return admission_control.check_rates(endpoint, flask_app.rate_limit_keys(request.headers.get("x-app-token"), body))
+
+def enter(endpoint):
+    if flask_app.admission_control is None:
+        return None
+
+    return flask_app.admission_control.enter(endpoint)
+
+def leave(endpoint):
+    if flask_app.admission_control is not None:
+        flask_app.admission_control.leave(endpoint)
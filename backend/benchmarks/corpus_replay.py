@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import corpus
+import engine
+
+def main(test_case_path, copies, process_count):
+    try:
+        test_case_file = open(test_case_path, "r")
+        test_case = json.load(test_case_file)
+    except (IOError, ValueError) as e:
+        print("Couldn't read the given test case file: " + str(e))
+        sys.exit(1)
+
+    player_names = test_case["players"]
+    initial_state_json = {
+        "decks": {current_round.value: test_case[current_round.value + "_deck"] for current_round in engine.Round}
+    }
+    initial_state = json.dumps(initial_state_json)
+    action_contents = [json.dumps(action_json) for action_json in test_case["actions"]]
+
+    corpus_path = os.path.join(tempfile.mkdtemp(), "games" + corpus.CORPUS_EXTENSION)
+    with corpus.CorpusWriter(corpus_path) as writer:
+        for game_id in range(0, copies):
+            writer.add_game(game_id, player_names, initial_state_json, test_case["actions"])
+
+    print("Corpus: %d games in %.1fKB (%.0f bytes per game)" % (copies, os.path.getsize(corpus_path) / 1024.0, os.path.getsize(corpus_path) / float(copies)))
+
+    # Stored games, the way the backend reads them
+    start_time = time.perf_counter()
+    for _ in range(0, copies):
+        engine_game = engine.Engine(player_names)
+        engine_game.start_game_with_initial_state(json.loads(initial_state))
+        for action_content in action_contents:
+            engine_game.apply_action(json.loads(action_content))
+    json_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with corpus.Corpus(corpus_path) as game_corpus:
+        for corpus_game in game_corpus.games():
+            corpus_game.replay()
+    corpus_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    corpus.map_corpus(corpus_path, count_rounds, process_count)
+    parallel_time = time.perf_counter() - start_time
+
+    print("JSON replay:     %.2fms per game" % (json_time * 1000.0 / copies))
+    print("Corpus replay:   %.2fms per game (%.1fx faster)" % (corpus_time * 1000.0 / copies, json_time / corpus_time))
+    print("Corpus parallel: %.2fms per game (%.1fx faster, %s processes)" % (parallel_time * 1000.0 / copies, json_time / parallel_time, process_count or os.cpu_count()))
+
+def count_rounds(corpus_game):
+    return len(corpus_game.replay().players[0].points)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("    python %s <TEST_CASE_PATH> [<COPIES>] [<PROCESSES>]" % os.path.split(__file__)[1])
+        sys.exit(1)
+
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    process_count = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    main(sys.argv[1], copies, process_count)
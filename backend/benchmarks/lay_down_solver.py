@@ -0,0 +1,54 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import engine
+import solver
+
+# Times solver.find_lay_down on random 26 card hands from five decks, in a
+# random round, with the top of the discard pile offered about a third of the
+# time. Each hand is solved a few times and the fastest kept, so the numbers
+# are the solver's rather than the machine's.
+#
+#     python3 benchmarks/lay_down_solver.py 2000
+
+HAND_SIZE = 26
+REPEATS = 3
+
+def main(hand_count, seed):
+    generator = random.Random(seed)
+    cards = engine.cards_from_codes(engine.standard_deck_codes(5))
+    rules = engine.DEFAULT_RULES.compile()
+    rounds = list(engine.Round)
+
+    durations = {goal: [] for goal in solver.LayDownGoal}
+
+    for _ in range(0, hand_count):
+        hand = generator.sample(cards, HAND_SIZE)
+        current_round = generator.choice(rounds)
+        discard_pile_top = generator.choice(cards) if generator.random() < 0.3 else None
+
+        for goal in solver.LayDownGoal:
+            fastest = None
+
+            for _ in range(0, REPEATS):
+                start_time = time.perf_counter()
+                solver.find_lay_down(hand, current_round, discard_pile_top, goal, rules)
+                duration = time.perf_counter() - start_time
+
+                fastest = duration if fastest is None else min(fastest, duration)
+
+            durations[goal].append(fastest)
+
+    for (goal, goal_durations) in durations.items():
+        goal_durations.sort()
+        percentile = lambda fraction: goal_durations[min(len(goal_durations) - 1, int(len(goal_durations) * fraction))] * 1000000.0
+        print("%-12s p50=%.0fus p90=%.0fus p99=%.0fus max=%.0fus" % (goal.value, percentile(0.5), percentile(0.9), percentile(0.99), goal_durations[-1] * 1000000.0))
+
+if __name__ == "__main__":
+    hand_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    main(hand_count, seed)
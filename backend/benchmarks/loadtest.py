@@ -0,0 +1,200 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.parse
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import engine
+import policies
+
+# Plays games against a running server the way the apps do: every client
+# signs up two players, starts a game between them and plays both sides,
+# keeping its own copy of the game to choose moves with. After each action
+# the first player fetches the changes to their view, and every few actions
+# they sync. Works against either server:
+#
+#     python3 app.py
+#     uvicorn async_app:app --port 5000
+
+SYNC_EVERY = 10
+
+#
+# HTTP
+#
+
+class Connection(object):
+
+    # A bare HTTP/1.1 keep-alive connection, so the client itself stays out
+    # of the way of the numbers
+
+    def __init__(self, url):
+        parsed_url = urllib.parse.urlsplit(url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port or 80
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        (self.reader, self.writer) = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def post(self, path, body_json, token=None):
+        if self.writer is None:
+            await self.open()
+
+        body = json.dumps(body_json).encode("utf-8")
+        headers = [
+            "POST %s HTTP/1.1" % path,
+            "Host: %s:%d" % (self.host, self.port),
+            "Content-Type: application/json",
+            "Content-Length: %d" % len(body)
+        ]
+        if token is not None:
+            headers.append("X-App-Token: " + token)
+
+        self.writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        status = int(status_line.split(b" ")[1])
+
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+
+            (name, value) = line.decode("latin-1").split(":", 1)
+            response_headers[name.strip().lower()] = value.strip()
+
+        if "content-length" in response_headers:
+            response_body = await self.reader.readexactly(int(response_headers["content-length"]))
+        else:
+            response_body = await self.reader.read()
+
+        if (response_headers.get("connection", "").lower() == "close") or not status_line.startswith(b"HTTP/1.1"):
+            self.close()
+
+        return (status, json.loads(response_body))
+
+#
+# Stats
+#
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = 0
+
+    def add(self, path, latency):
+        self.latencies.setdefault(path, []).append(latency)
+
+    @property
+    def request_count(self):
+        return sum([len(latencies) for latencies in self.latencies.values()])
+
+    def describe(self, duration):
+        lines = ["%d requests in %.1fs: %.1f requests/s, %d errors" % (self.request_count, duration, self.request_count / duration, self.errors)]
+
+        for (path, latencies) in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            percentile = lambda fraction: latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000.0
+            lines.append("    %-24s %6d  p50=%.1fms p95=%.1fms p99=%.1fms" % (path, len(latencies), percentile(0.5), percentile(0.95), percentile(0.99)))
+
+        return "\n".join(lines)
+
+#
+# Clients
+#
+
+class Client(object):
+
+    def __init__(self, url, stats):
+        self.connection = Connection(url)
+        self.stats = stats
+        self.policy = policies.GreedyPolicy()
+
+    async def request(self, path, body_json, token=None):
+        start_time = time.perf_counter()
+        (status, response_json) = await self.connection.post(path, body_json, token)
+        self.stats.add(path, time.perf_counter() - start_time)
+
+        if status != 200:
+            self.stats.errors += 1
+            raise RuntimeError("%s failed: %s" % (path, response_json.get("message")))
+
+        return response_json
+
+    async def sign_up(self):
+        email = "loadtest-%s@handandfoot" % uuid.uuid4().hex
+        response_json = await self.request("/api/signup", {"first_name": "Load", "last_name": "Test", "email": email, "password": uuid.uuid4().hex})
+        return (email, response_json["token"])
+
+    async def start_game(self):
+        (owner_email, owner_token) = await self.sign_up()
+        (player_email, player_token) = await self.sign_up()
+        self.tokens = {owner_email: owner_token, player_email: player_token}
+        self.owner_token = owner_token
+
+        response_json = await self.request("/api/game/create", {"title": "Load Test", "users": [player_email]}, owner_token)
+        self.game_id = response_json["game_id"]
+        await self.request("/api/game/accept", {"game": self.game_id}, player_token)
+
+        response_json = await self.request("/api/sync", {"last_updated": "2000-01-01 00:00:00 -0000"}, owner_token)
+        game_json = [game_json for game_json in response_json["games"] if game_json["id"] == self.game_id][0]
+
+        self.game_engine = engine.Engine([owner_email, player_email])
+        self.game_engine.start_game_with_initial_state(json.loads(game_json["initial_state"]))
+        self.version = 0
+
+    async def play_turn(self):
+        action = self.policy.choose_action(self.game_engine.game, self.game_engine.current_player)
+        action_json = action.to_json()
+
+        await self.request("/api/game/add_action", {"game": self.game_id, "action": action_json}, self.tokens[action.player_name])
+        self.game_engine.apply_action(action_json)
+        self.version += 1
+
+        await self.request("/api/game/view", {"game": self.game_id, "since": self.version - 1}, self.owner_token)
+
+        if self.version % SYNC_EVERY == 0:
+            await self.request("/api/sync", {"last_updated": "2000-01-01 00:00:00 -0000", "projected_views": True}, self.owner_token)
+
+    async def run(self, deadline):
+        await self.start_game()
+
+        while time.perf_counter() < deadline:
+            if self.game_engine.is_finished:
+                await self.start_game()
+
+            await self.play_turn()
+
+        self.connection.close()
+
+async def run_load_test(url, client_count, duration):
+    stats = Stats()
+    clients = [Client(url, stats) for _ in range(0, client_count)]
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client.run(start_time + duration) for client in clients])
+
+    print(stats.describe(time.perf_counter() - start_time))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("    python %s <SERVER_URL> [<CLIENTS>] [<SECONDS>]" % os.path.split(__file__)[1])
+        sys.exit(1)
+
+    client_count = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 30.0
+    asyncio.run(run_load_test(sys.argv[1], client_count, duration))
@@ -0,0 +1,48 @@
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import engine
+
+def main(test_case_path, iterations):
+    try:
+        test_case_file = open(test_case_path, "r")
+        test_case = json.load(test_case_file)
+    except (IOError, ValueError) as e:
+        print("Couldn't read the given test case file: " + str(e))
+        sys.exit(1)
+
+    player_names = test_case["players"]
+    actions_json = test_case["actions"]
+
+    decode_time = 0.0
+    apply_time = 0.0
+
+    for _ in range(0, iterations):
+        decks = {current_round: engine.Deck.from_json(test_case[current_round.value + "_deck"]) for current_round in engine.Round}
+        game = engine.Game(player_names, decks)
+
+        start_time = time.perf_counter()
+        actions = [engine.Action.from_json(action_json) for action_json in actions_json]
+        decode_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for action in actions:
+            game.apply_action(action)
+        apply_time += time.perf_counter() - start_time
+
+    action_count = len(actions_json) * iterations
+    print("Decode: %.2fus per action" % (decode_time * 1000000.0 / action_count))
+    print("Apply:  %.2fus per action" % (apply_time * 1000000.0 / action_count))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("    python %s <TEST_CASE_PATH> [<ITERATIONS>]" % os.path.split(__file__)[1])
+        sys.exit(1)
+
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    main(sys.argv[1], iterations)
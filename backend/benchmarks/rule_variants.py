@@ -0,0 +1,74 @@
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import analytics
+import engine
+import policies
+
+PLAYER_NAMES = ["player_0", "player_1", "player_2"]
+MAX_ACTIONS = 5000
+
+POINTS_SCALES = [0.5, 1.0, 1.5]
+COMPLETE_BOOK_SIZES = [6, 7, 8]
+NATURAL_SURPLUSES = [1, 2]
+
+def main(games_per_variant):
+    variants = []
+    for (points_scale, complete_book_size, natural_surplus) in itertools.product(POINTS_SCALES, COMPLETE_BOOK_SIZES, NATURAL_SURPLUSES):
+        points_needed = {current_round: int(current_round.points_needed * points_scale) for current_round in engine.Round}
+        variants.append(engine.RuleSet(points_needed=points_needed, complete_book_size=complete_book_size, natural_surplus=natural_surplus))
+
+    policy = policies.GreedyPolicy()
+    game_records = []
+    action_count = 0
+
+    start_time = time.perf_counter()
+    for (variant_index, rules) in enumerate(variants):
+        for game_index in range(0, games_per_variant):
+            random.seed((variant_index * games_per_variant) + game_index)
+            (game_record, game_action_count) = play_game(rules, policy)
+            game_records.append(game_record)
+            action_count += game_action_count
+    play_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    encoded_games = analytics.encode_games(game_records)
+    encoded_points = analytics.score_games(encoded_games)
+    score_time = time.perf_counter() - start_time
+
+    totals = encoded_points.total.sum(axis=2)
+
+    print("points_needed  book  surplus  avg_points  avg_rounds")
+    for (variant_index, rules) in enumerate(variants):
+        game_slice = slice(variant_index * games_per_variant, (variant_index + 1) * games_per_variant)
+        average_points = totals[game_slice].sum() / (games_per_variant * len(PLAYER_NAMES))
+        average_rounds = encoded_games.round_mask[game_slice].sum() / games_per_variant
+
+        print("%13d  %4d  %7d  %10.0f  %10.1f" % (rules.points_needed[engine.Round.NINETY], rules.complete_book_size, rules.natural_surplus, average_points, average_rounds))
+
+    print("Played %d games under %d variants in %.1fs (%.1fus per action)" % (len(game_records), len(variants), play_time, play_time * 1000000.0 / action_count))
+    print("Scored every game in %.1fms" % (score_time * 1000.0))
+
+def play_game(rules, policy):
+    engine_game = engine.Engine(PLAYER_NAMES)
+    initial_state_json = engine_game.generate_initial_game_state(rules)
+    decks = {current_round: engine.Deck.from_json(initial_state_json["decks"][current_round.value]) for current_round in engine.Round}
+
+    game = analytics.RecordingGame(PLAYER_NAMES, decks, rules)
+    action_count = 0
+
+    while (game.round is not None) and (action_count < MAX_ACTIONS):
+        action = policy.choose_action(game, game.player_iterator.current_player)
+        game.apply_action(action)
+        action_count += 1
+
+    return (analytics.GameRecord(len(PLAYER_NAMES), game.round_records, rules), action_count)
+
+if __name__ == "__main__":
+    games_per_variant = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    main(games_per_variant)
@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import analytics
+import engine
+
+def main(test_case_path, copies):
+    try:
+        test_case_file = open(test_case_path, "r")
+        test_case = json.load(test_case_file)
+    except (IOError, ValueError) as e:
+        print("Couldn't read the given test case file: " + str(e))
+        sys.exit(1)
+
+    initial_state_json = {
+        "decks": {current_round.value: test_case[current_round.value + "_deck"] for current_round in analytics.ROUNDS}
+    }
+
+    game_record = analytics.GameRecord.from_replay(test_case["players"], initial_state_json, test_case["actions"])
+    game_records = [game_record] * copies
+
+    players = build_players(game_records)
+
+    start_time = time.perf_counter()
+    for (player, current_round) in players:
+        player.calculate_points(current_round)
+    loop_time = time.perf_counter() - start_time
+
+    encoded_games = analytics.encode_games(game_records)
+
+    start_time = time.perf_counter()
+    encoded_points = analytics.score_games(encoded_games)
+    analytics.calculate_round_statistics(encoded_games, encoded_points)
+    vectorized_time = time.perf_counter() - start_time
+
+    print("Player.calculate_points: %.1fms for %d player-rounds" % (loop_time * 1000.0, len(players)))
+    print("analytics.score_games:   %.1fms (%.0fx faster)" % (vectorized_time * 1000.0, loop_time / vectorized_time))
+
+def build_players(game_records):
+    players = []
+
+    for game_record in game_records:
+        for (current_round, round_record) in game_record.round_records.items():
+            for player_index in range(0, game_record.player_count):
+                player = engine.Player("player_%d" % player_index)
+                player.hand = [engine.Card.from_code(code) for code in round_record.hands[player_index]]
+                player.foot = [engine.Card.from_code(code) for code in round_record.feet[player_index]]
+
+                for book_codes in round_record.books[player_index].values():
+                    book = engine.Book([engine.Card.from_code(code) for code in book_codes])
+                    player.books[current_round][book.rank] = book
+
+                players.append((player, current_round))
+
+    return players
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("    python %s <TEST_CASE_PATH> [<COPIES>]" % os.path.split(__file__)[1])
+        sys.exit(1)
+
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    main(sys.argv[1], copies)
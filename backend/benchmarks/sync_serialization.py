@@ -0,0 +1,88 @@
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import engine
+import engine_pool
+import serialization
+
+from models import User
+from models import Game
+from models import Action
+
+# Times encoding a full sync the old way, every row through the encoder on
+# every request, against fragments from a cold and a warm cache, for each
+# installed backend. Run it from the backend directory like the app, since
+# models reads secrets.yaml:
+#
+#     python3 benchmarks/sync_serialization.py 100 200
+
+def build_sync_rows(game_count, actions_per_game):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    player_names = ["player_%d@handandfoot" % i for i in range(0, 4)]
+
+    users = [User(id=i + 1, first_name="Player", last_name=str(i), email=player_name, created=now, last_updated=now) for (i, player_name) in enumerate(player_names)]
+    games = []
+    actions = []
+
+    for game_id in range(1, game_count + 1):
+        (initial_state, _) = engine_pool.create_initial_state(player_names)
+        games.append(Game(id=game_id, title="Game %d" % game_id, initial_state=initial_state, current_user=1, action_count=actions_per_game, created=now, last_updated=now))
+
+        for sequence in range(1, actions_per_game + 1):
+            content = json.dumps(engine.DrawFromDeckAction(player_names[sequence % 4]).to_json())
+            actions.append(Action(id=len(actions) + 1, content=content, game=game_id, sequence=sequence, created=now))
+
+    return (users, games, actions)
+
+def sync_json_from_rows(users, games, actions):
+    return {
+        "success": True,
+        "games": [game.to_json() for game in games],
+        "actions": [action.to_json() for action in actions],
+        "users": [user.to_json() for user in users]
+    }
+
+def sync_json_from_fragments(fragment_cache, users, games, actions):
+    return {
+        "success": True,
+        "games": [fragment_cache.fragment(game, (game.last_updated, game.action_count)) for game in games],
+        "actions": [fragment_cache.fragment(action, action.sequence) for action in actions],
+        "users": [fragment_cache.fragment(user, user.last_updated) for user in users]
+    }
+
+def time_per_sync(function, iterations):
+    start_time = time.perf_counter()
+    for _ in range(0, iterations):
+        body = function()
+
+    return ((time.perf_counter() - start_time) * 1000.0 / iterations, len(body))
+
+def main(game_count, actions_per_game, iterations):
+    (users, games, actions) = build_sync_rows(game_count, actions_per_game)
+    print("Sync of %d games and %d actions" % (len(games), len(actions)))
+
+    for backend_name in sorted(serialization.BACKENDS.keys()):
+        encoder = serialization.Encoder(backend_name)
+
+        (milliseconds, size) = time_per_sync(lambda: encoder.encode(sync_json_from_rows(users, games, actions)), iterations)
+        print("    %-7s whole:      %7.2fms  %d bytes" % (backend_name, milliseconds, size))
+
+        # A fresh cache every time, then one that already has every row
+        (milliseconds, size) = time_per_sync(lambda: encoder.encode(sync_json_from_fragments(serialization.FragmentCache(encoder), users, games, actions)), iterations)
+        print("    %-7s cold cache: %7.2fms" % (backend_name, milliseconds))
+
+        fragment_cache = serialization.FragmentCache(encoder)
+        (milliseconds, size) = time_per_sync(lambda: encoder.encode(sync_json_from_fragments(fragment_cache, users, games, actions)), iterations)
+        print("    %-7s warm cache: %7.2fms" % (backend_name, milliseconds))
+
+if __name__ == "__main__":
+    game_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    actions_per_game = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    main(game_count, actions_per_game, iterations)
@@ -0,0 +1,102 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+import peewee
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import models
+
+from models import User
+from models import UserSearchTerm
+
+# Compares the old substring search with the term index, on a scratch SQLite
+# database so a million made up users never go near the real one. Run it
+# from the backend directory like the app, since models reads secrets.yaml:
+#
+#     python3 benchmarks/user_search.py 1000000
+#
+# Each sampled name is searched the way the search screen sends it, one
+# prefix at a time as it's typed, for the first page of results.
+
+FIRST_NAMES = ["James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda", "William", "Elizabeth", "David", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen", "Christopher", "Nancy", "Daniel", "Lisa", "Matthew", "Betty", "Anthony", "Margaret", "Mark", "Sandra", "Donald", "Ashley", "Steven", "Kimberly", "Paul", "Emily", "Andrew", "Donna", "Joshua", "Michelle"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin", "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson", "Walker", "Young", "Allen", "King", "Wright", "Scott", "Torres", "Nguyen", "Hill", "Flores"]
+SYLLABLES = ["ka", "ro", "mi", "tel", "an", "dor", "vi", "sa", "len", "qu", "bra", "ith", "os", "ne", "zu", "har", "li", "mon", "ev", "ta"]
+
+PAGE_SIZE = 25
+
+def made_up_name(generator):
+    # Common names, with a made up one now and then so the index isn't
+    # just a few hundred distinct terms
+    if generator.random() < 0.3:
+        return "".join(generator.choice(SYLLABLES) for _ in range(0, generator.randint(2, 4))).capitalize()
+    else:
+        return None
+
+def fill_database(user_count, generator, batch_size=10000):
+    for start in range(0, user_count, batch_size):
+        user_rows = []
+        for user_number in range(start, min(start + batch_size, user_count)):
+            first_name = made_up_name(generator) or generator.choice(FIRST_NAMES)
+            last_name = made_up_name(generator) or generator.choice(LAST_NAMES)
+            user_rows.append({"email": "user%d@handandfoot" % user_number, "first_name": first_name, "last_name": last_name, "password_hash": ""})
+
+        with models.db.atomic():
+            for rows in peewee.chunked(user_rows, 1000):
+                User.insert_many(rows).execute()
+
+    UserSearchTerm.index_all_users(batch_size)
+
+def substring_search(search_term):
+    # What search_for_user did before the index
+    full_name = peewee.fn.LOWER(User.first_name.concat(" ").concat(User.last_name))
+    return list(User.select().where(full_name % ("%" + search_term.lower() + "%")).order_by(full_name).limit(PAGE_SIZE))
+
+def indexed_search(search_term):
+    return UserSearchTerm.search(search_term, None, 0, PAGE_SIZE)
+
+def time_searches(search, search_terms):
+    latencies = []
+
+    for search_term in search_terms:
+        start_time = time.perf_counter()
+        search(search_term)
+        latencies.append(time.perf_counter() - start_time)
+
+    latencies.sort()
+    percentile = lambda fraction: latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000.0
+    return "p50=%.2fms p95=%.2fms max=%.2fms" % (percentile(0.5), percentile(0.95), latencies[-1] * 1000.0)
+
+def main(user_count, name_count, database_path):
+    # SQLite only uses an index for LIKE when it's case sensitive, which is
+    # fine here since terms are already case folded
+    database = peewee.SqliteDatabase(database_path, pragmas={"journal_mode": "off", "synchronous": "off", "cache_size": -262144, "case_sensitive_like": "on"})
+    database.bind([User, UserSearchTerm])
+    models.db = database
+    database.create_tables([User, UserSearchTerm])
+
+    generator = random.Random(0)
+
+    start_time = time.perf_counter()
+    fill_database(user_count, generator)
+    print("Created and indexed %d users in %.1fs, %d terms" % (user_count, time.perf_counter() - start_time, UserSearchTerm.select().count()))
+
+    # Every prefix of a sampled name, as it would be typed
+    sampled_users = User.select().order_by(peewee.fn.RANDOM()).limit(name_count)
+    search_terms = []
+    for user in sampled_users:
+        full_name = user.first_name + " " + user.last_name
+        search_terms += [full_name[:length] for length in range(1, len(full_name) + 1)]
+
+    for (name, search) in [("substring", substring_search), ("indexed", indexed_search)]:
+        print("%-10s %5d searches  %s" % (name, len(search_terms), time_searches(search, search_terms)))
+
+if __name__ == "__main__":
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    name_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    database_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(tempfile.mkdtemp(), "user_search.db")
+
+    main(user_count, name_count, database_path)
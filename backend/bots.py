@@ -0,0 +1,230 @@
+import queue
+import threading
+
+import engine
+import policies
+
+from models import db
+from models import User
+from models import Game
+from models import ActionRejectedError
+from models import ActionConflictError
+
+DEFAULT_POLICY_NAME = "heuristic"
+
+# How many times in a row a bot's move is retried when another action beat
+# it to the game
+MAX_CONFLICT_RETRIES = 3
+
+#
+# Worker Pool
+#
+
+# Bots play on their own threads so request workers never wait on a policy.
+# A game is only ever held by one worker at a time, and that worker keeps
+# playing until it's a human's turn again.
+#
+# A move the game turns down is swapped for the plainest one there is: a draw
+# from the deck, or the greedy policy's discard. A game where even that is
+# turned down is set aside until someone else moves in it, so the poller
+# doesn't pick it up again every few seconds.
+
+class BotWorkerPool(object):
+
+    def __init__(self, worker_count=4, poll_seconds=5.0, metrics_sink=None, notify=None):
+        self.worker_count = worker_count
+        self.poll_seconds = poll_seconds
+        self.metrics_sink = metrics_sink
+        self.notify = notify
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.requeued = set()
+        self.stuck_games = {}
+        self.fallback_policy = policies.GreedyPolicy()
+        self.policies = {}
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def start(self, logger):
+        self.logger = logger
+
+        for i in range(0, self.worker_count):
+            self.start_thread(self.run_worker, "bot-worker-%d" % i)
+
+        self.start_thread(self.run_poller, "bot-poller")
+
+    def start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+
+        for _ in range(0, self.worker_count):
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def enqueue_game(self, game_id):
+        with self.lock:
+            if game_id in self.in_flight:
+                # The worker holding the game may already be on its way out,
+                # so have it look again once it's done
+                self.requeued.add(game_id)
+                return False
+
+            self.in_flight.add(game_id)
+
+        self.queue.put(game_id)
+        return True
+
+    def policy_named(self, policy_name):
+        # Policies don't keep any per-game state, so each one is shared by
+        # every worker
+        with self.lock:
+            policy = self.policies.get(policy_name)
+            if policy is None:
+                policy = policies.policy_named(policy_name)
+                self.policies[policy_name] = policy
+
+            return policy
+
+    #
+    # Polling
+    #
+
+    def run_poller(self):
+        while not self.stopping.wait(self.poll_seconds):
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.warning("Couldn't poll for bot games: " + str(e))
+
+    def poll(self):
+        # Catches games that were never enqueued, like ones that were waiting
+        # on a bot when the server restarted
+        with db.connection_context():
+            games = (Game
+                .select(Game.id, Game.action_count)
+                .join(User, on=(Game.current_user == User.id))
+                .where((User.is_bot == True) & (Game.finished == False)))
+
+            game_ids = [game.id for game in games if not self.is_stuck(game)]
+
+        for game_id in game_ids:
+            self.enqueue_game(game_id)
+
+    #
+    # Playing
+    #
+
+    def run_worker(self):
+        while True:
+            game_id = self.queue.get()
+            if game_id is None:
+                break
+
+            try:
+                with db.connection_context():
+                    self.play_game(game_id)
+            except Exception as e:
+                self.logger.exception("Bot failed to play game %d: %s" % (game_id, str(e)))
+            finally:
+                with self.lock:
+                    if game_id in self.requeued:
+                        self.requeued.discard(game_id)
+                        self.queue.put(game_id)
+                    else:
+                        self.in_flight.discard(game_id)
+
+    def is_stuck(self, game):
+        # Stuck games are tried again once anything has moved in them
+        with self.lock:
+            stuck_action_count = self.stuck_games.get(game.id)
+            if stuck_action_count is None:
+                return False
+
+            if stuck_action_count == game.action_count:
+                return True
+
+            del self.stuck_games[game.id]
+            return False
+
+    def play_game(self, game_id):
+        game = Game.get_or_none(Game.id == game_id)
+        if (game is None) or not game.have_all_players_accepted_invite or self.is_stuck(game):
+            return
+
+        game.load_state()
+        conflict_count = 0
+
+        while not self.stopping.is_set() and not game.game_engine.is_finished:
+            bot = User.get(User.email == game.game_engine.current_player.name)
+            if not bot.is_bot:
+                return
+
+            player = game.game_engine.current_player
+            action = self.policy_named(bot.bot_policy or DEFAULT_POLICY_NAME).choose_action(game.game_engine.game, player)
+            if action is None:
+                return
+
+            # Submitting replays the game from storage, which leaves
+            # game.game_engine up to date for the next move
+            try:
+                game.add_action_for_user(bot, action.to_json(), self.metrics_sink)
+                conflict_count = 0
+            except ActionConflictError:
+                conflict_count += 1
+                if conflict_count > MAX_CONFLICT_RETRIES:
+                    self.logger.warning("Bot gave up on game %d after %d conflicts" % (game_id, conflict_count))
+                    return
+
+                game = Game.get_by_id(game_id)
+                game.load_state()
+                continue
+            except ActionRejectedError as e:
+                self.logger.warning("Bot action rejected in game %d: %s" % (game_id, str(e)))
+
+                game = self.play_fallback_action(game_id, bot)
+                if game is None:
+                    with self.lock:
+                        self.stuck_games[game_id] = Game.get_by_id(game_id).action_count
+
+                    self.logger.warning("Bot is stuck in game %d until someone else moves" % game_id)
+                    return
+
+            if self.notify is not None:
+                self.notify(game)
+
+    def play_fallback_action(self, game_id, bot):
+        # The rejected action may have been half applied, so the game is
+        # loaded again before anything else is picked. Returns the game to
+        # carry on with, or None if the fallback was turned down too.
+        game = Game.get_by_id(game_id)
+        game.load_state()
+        player = game.game_engine.current_player
+
+        if player.can_draw_from_deck:
+            action = engine.DrawFromDeckAction(player.name)
+        else:
+            action = self.fallback_policy.choose_discard(game.game_engine.game, player)
+
+        if action is None:
+            return None
+
+        try:
+            game.add_action_for_user(bot, action.to_json(), self.metrics_sink)
+        except ActionConflictError:
+            # Someone else moved, so the bot looks at the game again
+            game = Game.get_by_id(game_id)
+            game.load_state()
+        except ActionRejectedError as e:
+            self.logger.warning("Bot fallback action rejected in game %d: %s" % (game_id, str(e)))
+            return None
+
+        return game
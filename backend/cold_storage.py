@@ -0,0 +1,327 @@
+import datetime
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import engine_pool
+
+from models import db
+from models import Game
+from models import GameSnapshot
+from models import GameArchive
+
+class ColdStorageError(Exception):
+    pass
+
+#
+# Archive Files
+#
+
+# An archive file holds the records of a batch of finished games. Each record
+# is compressed on its own, and a sorted index of (game id, offset, length) at
+# the end of the file lets a reader find one with a binary search over the
+# memory-mapped file, without reading or decompressing anything else.
+#
+# Header: magic, format version, record count, index offset
+# Records: zlib-compressed JSON, one after another
+# Index: one entry per record, sorted by game id
+
+ARCHIVE_MAGIC = b"HFGAMES\x00"
+ARCHIVE_VERSION = 1
+ARCHIVE_EXTENSION = ".hfg"
+
+HEADER_FORMAT = struct.Struct("<8sIIQ")
+INDEX_ENTRY_FORMAT = struct.Struct("<QQI")
+
+def write_archive_file(path, records):
+    # Written to a temporary file first, so a crash never leaves a partial
+    # archive under a name that games point at
+    temporary_path = path + ".tmp"
+    index = []
+
+    with open(temporary_path, "wb") as archive_file:
+        archive_file.write(HEADER_FORMAT.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, 0))
+
+        for (game_id, record_json) in sorted(records.items()):
+            record_bytes = zlib.compress(json.dumps(record_json, separators=(",", ":"), default=str).encode("utf-8"), 9)
+            index.append((game_id, archive_file.tell(), len(record_bytes)))
+            archive_file.write(record_bytes)
+
+        index_offset = archive_file.tell()
+        for entry in index:
+            archive_file.write(INDEX_ENTRY_FORMAT.pack(*entry))
+
+        archive_file.seek(0)
+        archive_file.write(HEADER_FORMAT.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(index), index_offset))
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+
+    os.replace(temporary_path, path)
+
+class ArchiveFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ColdStorageError("Empty archive file: " + path)
+
+        (magic, version, count, index_offset) = HEADER_FORMAT.unpack_from(self.map, 0)
+        if (magic != ARCHIVE_MAGIC) or (version != ARCHIVE_VERSION):
+            self.close()
+            raise ColdStorageError("Not an archive file: " + path)
+
+        self.count = count
+        self.index_offset = index_offset
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def index_entry(self, position):
+        return INDEX_ENTRY_FORMAT.unpack_from(self.map, self.index_offset + (position * INDEX_ENTRY_FORMAT.size))
+
+    @property
+    def game_ids(self):
+        return [self.index_entry(position)[0] for position in range(0, self.count)]
+
+    def read(self, game_id):
+        low = 0
+        high = self.count
+
+        while low < high:
+            middle = (low + high) // 2
+            (entry_game_id, offset, length) = self.index_entry(middle)
+
+            if entry_game_id < game_id:
+                low = middle + 1
+            elif entry_game_id > game_id:
+                high = middle
+            else:
+                return json.loads(zlib.decompress(self.map[offset:(offset + length)]).decode("utf-8"))
+
+        return None
+
+#
+# Storage
+#
+
+class ColdStorage(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.files = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    def close(self):
+        with self.lock:
+            for archive_file in self.files.values():
+                archive_file.close()
+
+            self.files = {}
+
+    def archive_file_named(self, name):
+        # Files are never changed once written, so each is mapped once and
+        # shared by every request
+        with self.lock:
+            archive_file = self.files.get(name)
+            if archive_file is None:
+                path = os.path.join(self.directory, name)
+                if not os.path.exists(path):
+                    raise ColdStorageError("Missing archive file: " + name)
+
+                archive_file = ArchiveFile(path)
+                self.files[name] = archive_file
+
+            return archive_file
+
+    def write_records(self, records):
+        first_game_id = min(records.keys())
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d%H%M%S%f")
+        name = "games-%s-%d%s" % (timestamp, first_game_id, ARCHIVE_EXTENSION)
+
+        write_archive_file(os.path.join(self.directory, name), records)
+        return name
+
+    def load_record(self, game):
+        if game.cold_archive is None:
+            raise ColdStorageError("Game %d isn't in cold storage" % game.id)
+
+        record = self.archive_file_named(game.cold_archive).read(game.id)
+        if record is None:
+            raise ColdStorageError("Game %d is missing from %s" % (game.id, game.cold_archive))
+
+        return record
+
+#
+# Records
+#
+
+# A record is everything needed to put a game back: its final Game.to_json,
+# its initial state, its whole action log as kept by GameArchive, and the
+# snapshot at the end of the game so it never needs replaying.
+
+def game_record(game):
+    archive = GameArchive.get_or_none(GameArchive.game == game)
+    snapshot = game.latest_snapshot
+
+    if (archive is None) or (snapshot is None) or (snapshot.sequence != game.action_count):
+        raise ColdStorageError("Game %d hasn't been compacted and archived" % game.id)
+
+    return {
+        "game": game.to_json(),
+        "initial_state": game.initial_state,
+        "actions": archive.load_actions_json(),
+        "snapshot": {
+            "sequence": snapshot.sequence,
+            "state": snapshot.state
+        }
+    }
+
+def record_actions(game, record):
+    return GameArchive.actions_from_json(game.id, record["actions"])
+
+def record_log(game, record):
+    return engine_pool.GameLog(game.player_names, None, record["snapshot"]["state"], record["snapshot"]["sequence"], [])
+
+#
+# Archiving
+#
+
+# Archiving leaves a stub behind: the Game row keeps everything sync and
+# UserGame lookups need, but its initial state, archived log and snapshots
+# are only in the archive file. Rehydrating puts them back so the game can be
+# loaded like any other, and the next archiving pass turns it back into a
+# stub without writing it out again.
+
+def games_ready_for_cold_storage(min_age_seconds, limit=None):
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=min_age_seconds)
+
+    query = (Game
+        .select()
+        .where(
+            (Game.finished == True) &
+            (Game.archived == True) &
+            (Game.in_cold_storage == False) &
+            (Game.last_updated < cutoff) &
+            (Game.rehydrated.is_null() | (Game.rehydrated < cutoff)))
+        .order_by(Game.id))
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
+
+def move_games_to_cold_storage(storage, games, logger=None):
+    # Games that were rehydrated are already in an archive file, so only new
+    # ones are written out
+    records = {}
+    stubbed_games = []
+
+    for game in games:
+        if game.cold_archive is None:
+            try:
+                records[game.id] = game_record(game)
+            except ColdStorageError as e:
+                if logger is not None:
+                    logger.warning(str(e))
+                continue
+
+        stubbed_games.append(game)
+
+    if len(records) > 0:
+        name = storage.write_records(records)
+
+        # Read everything back before any hot rows are deleted
+        archive_file = storage.archive_file_named(name)
+        for game_id in records.keys():
+            if archive_file.read(game_id) is None:
+                raise ColdStorageError("Game %d didn't make it into %s" % (game_id, name))
+
+        for game in stubbed_games:
+            if game.id in records:
+                game.cold_archive = name
+
+    for game in stubbed_games:
+        replace_game_with_stub(game)
+
+    return len(stubbed_games)
+
+def replace_game_with_stub(game):
+    with db.atomic():
+        GameSnapshot.delete().where(GameSnapshot.game == game).execute()
+        GameArchive.delete().where(GameArchive.game == game).execute()
+
+        # Only games that haven't changed since they were read are stubbed
+        Game.update(initial_state="", cold_archive=game.cold_archive, in_cold_storage=True).where(
+            (Game.id == game.id) & (Game.finished == True) & (Game.archived == True)).execute()
+
+    game.initial_state = ""
+    game.in_cold_storage = True
+
+def rehydrate_game(game, storage):
+    if not game.in_cold_storage:
+        return
+
+    record = storage.load_record(game)
+    rehydrated = datetime.datetime.now(datetime.timezone.utc)
+
+    with db.atomic():
+        GameArchive.create_from_json(game, record["actions"])
+        GameSnapshot(game=game, sequence=record["snapshot"]["sequence"], state=record["snapshot"]["state"]).save()
+
+        Game.update(initial_state=record["initial_state"], in_cold_storage=False, rehydrated=rehydrated).where(Game.id == game.id).execute()
+
+    game.initial_state = record["initial_state"]
+    game.in_cold_storage = False
+    game.rehydrated = rehydrated
+
+#
+# Background Archiver
+#
+
+class ColdStorageArchiver(object):
+
+    def __init__(self, storage, poll_seconds=3600.0, batch_size=1000, min_age_seconds=604800):
+        self.storage = storage
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.min_age_seconds = min_age_seconds
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self, logger):
+        self.logger = logger
+        self.thread = threading.Thread(target=self.run, name="cold-storage-archiver", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.poll_seconds):
+            try:
+                with db.connection_context():
+                    self.archive_pending_games()
+            except Exception as e:
+                self.logger.warning("Couldn't move games to cold storage: " + str(e))
+
+    def archive_pending_games(self):
+        games = list(games_ready_for_cold_storage(self.min_age_seconds, self.batch_size))
+        if len(games) == 0:
+            return 0
+
+        return move_games_to_cold_storage(self.storage, games, self.logger)
@@ -0,0 +1,161 @@
+import json
+import threading
+
+import engine
+
+from models import db
+from models import Game
+from models import Action
+from models import GameSnapshot
+from models import GameArchive
+
+class CompactionError(Exception):
+    pass
+
+#
+# Compaction
+#
+
+# Every action that ends a round records its sequence number on the game. The
+# compactor replays everything up to that point from the latest snapshot,
+# checking each action's state hash on the way, and saves a new snapshot
+# there. Reads then only replay the current round. Once a finished game is
+# compacted its whole log is compressed into a GameArchive and the hot rows
+# are deleted.
+
+def compact_game(game, archive_finished_games=True):
+    if Action.select().where((Action.game == game) & Action.sequence.is_null()).exists():
+        raise CompactionError("Game %d has actions without sequence numbers" % game.id)
+
+    snapshot = game.latest_snapshot
+    target_sequence = game.round_end_sequence
+
+    if (snapshot is None) or (snapshot.sequence < target_sequence):
+        game_engine = engine.Engine(game.player_names)
+
+        if snapshot is None:
+            game_engine.start_game_with_initial_state(json.loads(game.initial_state))
+            sequence = 0
+        else:
+            game_engine.start_game_with_snapshot(json.loads(snapshot.state))
+            sequence = snapshot.sequence
+
+        actions = Action.select().where((Action.game == game) & (Action.sequence > sequence) & (Action.sequence <= target_sequence)).order_by(Action.sequence)
+
+        for action in actions:
+            sequence += 1
+            if action.sequence != sequence:
+                raise CompactionError("Game %d is missing action %d" % (game.id, sequence))
+
+            game_engine.apply_action(action.load_content_json())
+
+            if (action.state_hash is not None) and (action.state_hash != engine.state_hash_string(game_engine.game.state_hash)):
+                raise CompactionError("Game %d doesn't match its state hash at action %d" % (game.id, sequence))
+
+        if sequence != target_sequence:
+            raise CompactionError("Game %d is missing actions before %d" % (game.id, target_sequence))
+
+        GameSnapshot(game=game, sequence=target_sequence, state=json.dumps(game_engine.game.to_snapshot_json())).save()
+
+    # Updated directly so this never overwrites a move saved in the meantime
+    Game.update(compacted_sequence=target_sequence).where(Game.id == game.id).execute()
+    game.compacted_sequence = target_sequence
+
+    if archive_finished_games and game.finished and (target_sequence == game.action_count):
+        archive_game(game)
+
+def archive_game(game):
+    with db.atomic():
+        actions = list(Action.select().where(Action.game == game).order_by(Action.sequence))
+        GameArchive.create_for_game(game, actions)
+        Action.delete().where(Action.game == game).execute()
+        Game.update(archived=True).where(Game.id == game.id).execute()
+
+    game.archived = True
+
+def games_needing_compaction(limit=None):
+    query = Game.select().where(Game.round_end_sequence > Game.compacted_sequence).order_by(Game.id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
+
+#
+# Migration
+#
+
+def assign_action_sequences(game):
+    # Numbers and hashes the actions of a game saved before the event log
+    # existed, in the order they were created
+    game.load_initial_state()
+    engine_game = game.game_engine.game
+
+    with db.atomic():
+        for action in Action.select().where(Action.game == game).order_by(Action.created, Action.id):
+            previous_round = engine_game.round
+            game.apply_action(action)
+
+            action.sequence = game.sequence
+            action.state_hash = engine.state_hash_string(engine_game.state_hash)
+            action.save()
+
+            if engine_game.round != previous_round:
+                game.round_end_sequence = game.sequence
+
+        game.action_count = game.sequence
+        game.finished = game.game_engine.is_finished
+        game.save()
+
+def assign_all_action_sequences():
+    games = Game.select().join(Action).where(Action.sequence.is_null()).distinct()
+
+    for game in games:
+        assign_action_sequences(game)
+
+#
+# Background Compactor
+#
+
+class Compactor(object):
+
+    def __init__(self, poll_seconds=30.0, batch_size=100, archive_finished_games=True):
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.archive_finished_games = archive_finished_games
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self, logger):
+        self.logger = logger
+        self.thread = threading.Thread(target=self.run, name="compactor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.poll_seconds):
+            try:
+                with db.connection_context():
+                    self.compact_pending_games()
+            except Exception as e:
+                self.logger.warning("Couldn't compact games: " + str(e))
+
+    def compact_pending_games(self):
+        compacted_count = 0
+
+        for game in games_needing_compaction(self.batch_size):
+            if self.stopping.is_set():
+                break
+
+            try:
+                compact_game(game, self.archive_finished_games)
+                compacted_count += 1
+            except (CompactionError, engine.IllegalActionError, engine.IllegalSetupError) as e:
+                self.logger.warning("Couldn't compact game %d: %s" % (game.id, str(e)))
+
+        return compacted_count
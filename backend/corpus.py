@@ -0,0 +1,375 @@
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+
+import engine
+
+class CorpusError(Exception):
+    pass
+
+#
+# Format
+#
+
+# A corpus packs many finished games into one file so they can be replayed
+# without parsing any JSON. Cards are one-byte codes, players are indices into
+# the game's player list, and each action is a type byte and a player byte
+# followed by its fields. A sorted index of (game id, offset, length) at the
+# end of the file lets a reader jump straight to any game.
+#
+# Header: magic, format version, game count, index offset
+# Game: player names, rules JSON, shuffle seed, one deck per round, actions
+# Index: one entry per game, sorted by game id
+#
+# Strings are a 16-bit length followed by UTF-8 bytes, and card lists are a
+# 16-bit length followed by card codes.
+
+CORPUS_MAGIC = b"HFCORPUS"
+CORPUS_VERSION = 1
+CORPUS_EXTENSION = ".hfc"
+
+HEADER_FORMAT = struct.Struct("<8sIIQ")
+INDEX_ENTRY_FORMAT = struct.Struct("<QQI")
+LENGTH_FORMAT = struct.Struct("<H")
+ACTION_COUNT_FORMAT = struct.Struct("<I")
+
+ROUNDS = list(engine.Round)
+
+# Field kinds
+RANK_FIELD = "rank"
+CARD_FIELD = "card"
+CARDS_FIELD = "cards"
+BOOKS_FIELD = "books"
+
+# An action's type byte is its position in this list, so new actions must
+# only ever be added to the end
+ACTION_LAYOUTS = [
+    (engine.DrawFromDeckAction, []),
+    (engine.DrawFromDiscardPileAndAddToBookAction, [("book_rank", RANK_FIELD)]),
+    (engine.DrawFromDiscardPileAndStartBookAction, [("cards", CARDS_FIELD)]),
+    (engine.DiscardCardAction, [("card", CARD_FIELD)]),
+    (engine.LayDownInitialBooksAction, [("books", BOOKS_FIELD)]),
+    (engine.DrawFromDiscardPileAndLayDownInitialBooksAction, [("partial_book", CARDS_FIELD), ("books", BOOKS_FIELD)]),
+    (engine.StartBookAction, [("cards", CARDS_FIELD)]),
+    (engine.AddCardsFromHandToBookAction, [("cards", CARDS_FIELD), ("book_rank", RANK_FIELD)])
+]
+
+ACTION_TYPE_CODES = {action_class: code for (code, (action_class, _)) in enumerate(ACTION_LAYOUTS)}
+
+#
+# Writing
+#
+
+def encode_string(string):
+    string_bytes = string.encode("utf-8")
+    return LENGTH_FORMAT.pack(len(string_bytes)) + string_bytes
+
+def encode_cards(cards):
+    return LENGTH_FORMAT.pack(len(cards)) + bytes(card.code for card in cards)
+
+def encode_action(action, player_indices):
+    (action_class, fields) = ACTION_LAYOUTS[ACTION_TYPE_CODES[type(action)]]
+    encoded = bytearray((ACTION_TYPE_CODES[action_class], player_indices[action.player_name]))
+
+    for (field_name, field_kind) in fields:
+        value = getattr(action, field_name)
+
+        if field_kind == RANK_FIELD:
+            encoded.append(engine.RANK_INDICES[value])
+        elif field_kind == CARD_FIELD:
+            encoded.append(value.code)
+        elif field_kind == CARDS_FIELD:
+            encoded += encode_cards(value)
+        elif field_kind == BOOKS_FIELD:
+            encoded += LENGTH_FORMAT.pack(len(value))
+            for cards in value:
+                encoded += encode_cards(cards)
+
+    return encoded
+
+def encode_game(player_names, initial_state_json, actions_json):
+    player_indices = {player_name: i for (i, player_name) in enumerate(player_names)}
+    rules_json = initial_state_json.get("rules")
+
+    encoded = bytearray()
+    encoded.append(len(player_names))
+    for player_name in player_names:
+        encoded += encode_string(player_name)
+
+    encoded += encode_string(json.dumps(rules_json, separators=(",", ":")) if rules_json is not None else "")
+    encoded += encode_string(initial_state_json.get("shuffle_seed", ""))
+
+    for current_round in ROUNDS:
+        encoded += encode_cards(engine.Deck.from_json(initial_state_json["decks"][current_round.value]).cards)
+
+    encoded += ACTION_COUNT_FORMAT.pack(len(actions_json))
+    for action_json in actions_json:
+        action = engine.Action.from_json(action_json)
+        if action.player_name not in player_indices:
+            raise CorpusError("Action for unknown player: " + action.player_name)
+
+        encoded += encode_action(action, player_indices)
+
+    return encoded
+
+class CorpusWriter(object):
+
+    # Games are streamed to disk as they're added, and only the index is kept
+    # in memory until the corpus is closed
+
+    def __init__(self, path):
+        self.path = path
+        self.temporary_path = path + ".tmp"
+        self.file = open(self.temporary_path, "wb")
+        self.file.write(HEADER_FORMAT.pack(CORPUS_MAGIC, CORPUS_VERSION, 0, 0))
+        self.index = []
+        self.game_ids = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_game(self, game_id, player_names, initial_state_json, actions_json):
+        if game_id in self.game_ids:
+            raise CorpusError("Game %d is already in the corpus" % game_id)
+
+        encoded = encode_game(player_names, initial_state_json, actions_json)
+        self.index.append((game_id, self.file.tell(), len(encoded)))
+        self.game_ids.add(game_id)
+        self.file.write(encoded)
+
+    def close(self):
+        index_offset = self.file.tell()
+        for entry in sorted(self.index):
+            self.file.write(INDEX_ENTRY_FORMAT.pack(*entry))
+
+        self.file.seek(0)
+        self.file.write(HEADER_FORMAT.pack(CORPUS_MAGIC, CORPUS_VERSION, len(self.index), index_offset))
+        self.file.close()
+
+        os.replace(self.temporary_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temporary_path)
+
+#
+# Reading
+#
+
+class Corpus(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise CorpusError("Empty corpus file: " + path)
+
+        (magic, version, game_count, index_offset) = HEADER_FORMAT.unpack_from(self.map, 0)
+        if (magic != CORPUS_MAGIC) or (version != CORPUS_VERSION):
+            self.close()
+            raise CorpusError("Not a corpus file: " + path)
+
+        self.view = memoryview(self.map)
+        self.game_count = game_count
+        self.index_offset = index_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.game_count
+
+    def close(self):
+        if hasattr(self, "view"):
+            self.view.release()
+
+        try:
+            self.map.close()
+        except BufferError:
+            # Games that are still around keep their part of the file mapped,
+            # and it's unmapped once the last of them is gone
+            pass
+
+        self.file.close()
+
+    def index_entry(self, position):
+        return INDEX_ENTRY_FORMAT.unpack_from(self.map, self.index_offset + (position * INDEX_ENTRY_FORMAT.size))
+
+    @property
+    def game_ids(self):
+        return [self.index_entry(position)[0] for position in range(0, self.game_count)]
+
+    def game_at(self, position):
+        (game_id, offset, length) = self.index_entry(position)
+        return CorpusGame(game_id, self.view[offset:(offset + length)])
+
+    def game(self, game_id):
+        low = 0
+        high = self.game_count
+
+        while low < high:
+            middle = (low + high) // 2
+            entry_game_id = self.index_entry(middle)[0]
+
+            if entry_game_id < game_id:
+                low = middle + 1
+            elif entry_game_id > game_id:
+                high = middle
+            else:
+                return self.game_at(middle)
+
+        return None
+
+    def games(self, start=0, stop=None):
+        if stop is None:
+            stop = self.game_count
+
+        for position in range(start, min(stop, self.game_count)):
+            yield self.game_at(position)
+
+class CorpusGame(object):
+
+    # Wraps a slice of the mapped file without copying it. Only the player
+    # names and the offsets of the decks and actions are read up front.
+
+    def __init__(self, game_id, view):
+        self.game_id = game_id
+        self.view = view
+
+        player_count = view[0]
+        offset = 1
+
+        self.player_names = []
+        for _ in range(0, player_count):
+            (player_name, offset) = self.read_string(offset)
+            self.player_names.append(player_name)
+
+        (rules_string, offset) = self.read_string(offset)
+        self.rules = engine.RuleSet.from_json(json.loads(rules_string)) if len(rules_string) > 0 else engine.DEFAULT_RULES
+
+        (self.shuffle_seed, offset) = self.read_string(offset)
+
+        self.deck_slices = []
+        for _ in ROUNDS:
+            card_count = LENGTH_FORMAT.unpack_from(view, offset)[0]
+            offset += LENGTH_FORMAT.size
+            self.deck_slices.append((offset, offset + card_count))
+            offset += card_count
+
+        self.action_count = ACTION_COUNT_FORMAT.unpack_from(view, offset)[0]
+        self.actions_offset = offset + ACTION_COUNT_FORMAT.size
+
+    def read_string(self, offset):
+        length = LENGTH_FORMAT.unpack_from(self.view, offset)[0]
+        offset += LENGTH_FORMAT.size
+        return (str(self.view[offset:(offset + length)], "utf-8"), offset + length)
+
+    def deck_codes(self, current_round):
+        (start, stop) = self.deck_slices[ROUNDS.index(current_round)]
+        return self.view[start:stop]
+
+    @property
+    def decks(self):
+        decks = {}
+
+        for (current_round, (start, stop)) in zip(ROUNDS, self.deck_slices):
+            deck = engine.Deck()
+            deck.cards = engine.cards_from_codes(self.view[start:stop])
+            decks[current_round] = deck
+
+        return decks
+
+    @property
+    def actions(self):
+        view = self.view
+        cards_by_code = engine.CARDS_BY_CODE
+        player_names = self.player_names
+        offset = self.actions_offset
+
+        def read_cards(offset):
+            card_count = view[offset] | (view[offset + 1] << 8)
+            offset += 2
+            return ([cards_by_code[code] for code in view[offset:(offset + card_count)]], offset + card_count)
+
+        for _ in range(0, self.action_count):
+            (action_class, fields) = ACTION_LAYOUTS[view[offset]]
+            arguments = [player_names[view[offset + 1]]]
+            offset += 2
+
+            for (_, field_kind) in fields:
+                if field_kind == RANK_FIELD:
+                    arguments.append(engine.CARD_RANKS[view[offset]])
+                    offset += 1
+                elif field_kind == CARD_FIELD:
+                    arguments.append(cards_by_code[view[offset]])
+                    offset += 1
+                elif field_kind == CARDS_FIELD:
+                    (cards, offset) = read_cards(offset)
+                    arguments.append(cards)
+                elif field_kind == BOOKS_FIELD:
+                    book_count = view[offset] | (view[offset + 1] << 8)
+                    offset += 2
+
+                    books = []
+                    for _ in range(0, book_count):
+                        (cards, offset) = read_cards(offset)
+                        books.append(cards)
+
+                    arguments.append(books)
+
+            yield action_class(*arguments)
+
+    def start_game(self, game_class=engine.Game):
+        # Any engine.Game subclass works, like analytics.RecordingGame
+        return game_class(self.player_names, self.decks, rules=self.rules, shuffle_seed=self.shuffle_seed)
+
+    def replay(self, game_class=engine.Game):
+        game = self.start_game(game_class)
+
+        for action in self.actions:
+            game.apply_action(action)
+
+        return game
+
+#
+# Bulk Replay
+#
+
+# Each worker maps the corpus itself, so games are never pickled between
+# processes and the operating system shares the pages between them. Only
+# whatever the function returns is sent back.
+
+def map_corpus(path, function, process_count=None, chunk_size=256):
+    with Corpus(path) as corpus:
+        game_count = len(corpus)
+
+    chunks = [(path, function, start, min(start + chunk_size, game_count)) for start in range(0, game_count, chunk_size)]
+
+    if process_count == 1:
+        chunk_results = [map_corpus_chunk(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(process_count) as pool:
+            chunk_results = pool.map(map_corpus_chunk, chunks)
+
+    return [result for chunk_result in chunk_results for result in chunk_result]
+
+def map_corpus_chunk(chunk):
+    (path, function, start, stop) = chunk
+
+    with Corpus(path) as corpus:
+        return [function(corpus_game) for corpus_game in corpus.games(start, stop)]
@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+
+import cold_storage
+import corpus
+
+from models import db
+from models import Game
+from models import GameArchive
+
+#
+# Exporting
+#
+
+# Games are read from wherever their log currently lives: the actions table,
+# a GameArchive, or a cold storage archive file.
+
+def stored_game(game, cold_store=None):
+    if game.in_cold_storage:
+        if cold_store is None:
+            raise cold_storage.ColdStorageError("Game %d is in cold storage, which wasn't given" % game.id)
+
+        record = cold_store.load_record(game)
+        return (record["initial_state"], [action_json[4] for action_json in record["actions"]])
+
+    if game.archived:
+        archive = GameArchive.get(GameArchive.game == game)
+        return (game.initial_state, [action_json[4] for action_json in archive.load_actions_json()])
+
+    return (game.initial_state, [action.content for action in game.actions])
+
+def export_games(path, games, cold_store=None):
+    with corpus.CorpusWriter(path) as writer:
+        for game in games:
+            (initial_state, action_contents) = stored_game(game, cold_store)
+            actions_json = [json.loads(action_content) for action_content in action_contents]
+            writer.add_game(game.id, game.player_names, json.loads(initial_state), actions_json)
+
+        return len(writer.index)
+
+def export_finished_games(path, cold_store=None):
+    games = Game.select().where(Game.finished == True).order_by(Game.id)
+    return export_games(path, games, cold_store)
+
+#
+# Main
+#
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("    python %s <CORPUS_PATH> [<COLD_STORAGE_DIRECTORY>]" % os.path.split(__file__)[1])
+        sys.exit(1)
+
+    cold_store = cold_storage.ColdStorage(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    with db.connection_context():
+        game_count = export_finished_games(sys.argv[1], cold_store)
+
+    print("Exported %d games to %s" % (game_count, sys.argv[1]))
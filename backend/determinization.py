@@ -0,0 +1,165 @@
+import random
+
+import engine
+
+#
+# Determinization
+#
+
+# A player can see their own hand, every book and the discard pile. Everything
+# else (opponents' hands and feet, their own foot and the order of the deck)
+# is hidden. A determinizer collects the hidden cards into one pool when it's
+# created, and each sample deals a fresh shuffle of that pool back into the
+# same places, so every sampled world has the same card counts as the real one.
+
+class Determinizer(object):
+
+    def __init__(self, game, viewer_name, known_cards=None, rng=None):
+        if game.round is None:
+            raise ValueError("Can't sample a finished game")
+
+        viewer = game.get_player_named(viewer_name)
+        if viewer is None:
+            raise ValueError("Unknown player: " + viewer_name)
+
+        if known_cards is None:
+            known_cards = {}
+
+        self.game = game
+        self.viewer = viewer
+        self.random = rng if rng is not None else random.Random()
+
+        # Reshuffles follow the game's seed, so samples get their own
+        self.shuffle_seed = "%032x" % self.random.getrandbits(128)
+
+        # Hidden cards counted by code, so known cards can be taken out of the
+        # pool without comparing Card objects
+        hidden_counts = [0] * engine.CARD_CODE_COUNT
+        hidden_cards = [None] * engine.CARD_CODE_COUNT
+
+        def add_hidden_cards(cards):
+            for card in cards:
+                code = card.code
+                hidden_counts[code] += 1
+                hidden_cards[code] = card
+
+        self.hand_sizes = []
+        self.foot_sizes = []
+        self.pinned_cards = []
+
+        for player in game.players:
+            if player is viewer:
+                self.hand_sizes.append(None)
+                self.pinned_cards.append(None)
+            else:
+                add_hidden_cards(player.hand)
+                self.hand_sizes.append(len(player.hand))
+                self.pinned_cards.append([])
+
+            add_hidden_cards(player.foot)
+            self.foot_sizes.append(len(player.foot))
+
+        deck = game.deck
+        add_hidden_cards(deck.cards)
+        self.deck_size = len(deck.cards)
+
+        # Cards we know an opponent is holding stay in their hand
+        for (player_name, cards) in known_cards.items():
+            player = game.get_player_named(player_name)
+            if (player is None) or (player is viewer):
+                raise ValueError("Known cards must belong to an opponent")
+
+            player_index = game.players.index(player)
+            if len(cards) > self.hand_sizes[player_index]:
+                raise ValueError("More known cards than cards in hand")
+
+            for card in cards:
+                code = card.code
+                if hidden_counts[code] == 0:
+                    raise ValueError("Known card isn't hidden: " + str(card))
+
+                hidden_counts[code] -= 1
+                self.pinned_cards[player_index].append(card)
+
+        # After the discard pile has been shuffled back in, the deck can only
+        # hold cards that came from it
+        if deck.replenished_cards is not None:
+            replenished_counts = [0] * engine.CARD_CODE_COUNT
+            for card in deck.replenished_cards:
+                replenished_counts[card.code] += 1
+
+            self.deck_pool = []
+            for code in range(0, engine.CARD_CODE_COUNT):
+                card_count = min(hidden_counts[code], replenished_counts[code])
+                self.deck_pool.extend([hidden_cards[code]] * card_count)
+                hidden_counts[code] -= card_count
+        else:
+            self.deck_pool = None
+
+        self.pool = []
+        for code in range(0, engine.CARD_CODE_COUNT):
+            self.pool.extend([hidden_cards[code]] * hidden_counts[code])
+
+        if self.deck_pool is not None:
+            # The deck's share of the replenished cards is picked each sample,
+            # and the rest are dealt with everything else
+            self.base_pool = list(self.pool)
+            self.pool.extend(self.deck_pool[self.deck_size:])
+
+        # Later rounds are dealt from decks nobody has seen, so one shuffle of
+        # each is as good as the real order and is shared by every sample
+        self.future_decks = {}
+        future_round = game.round.next_round
+        while future_round is not None:
+            future_cards = list(game.decks[future_round].cards)
+            self.random.shuffle(future_cards)
+            self.future_decks[future_round] = future_cards
+            future_round = future_round.next_round
+
+    @property
+    def hidden_card_count(self):
+        return len(self.pool) + (0 if self.deck_pool is None else self.deck_size)
+
+    def sample(self):
+        shuffle = self.random.shuffle
+
+        if self.deck_pool is not None:
+            shuffle(self.deck_pool)
+            self.pool[:len(self.base_pool)] = self.base_pool
+            self.pool[len(self.base_pool):] = self.deck_pool[self.deck_size:]
+
+        shuffle(self.pool)
+
+        sampled_game = self.game.copy()
+        sampled_game.shuffle_seed = self.shuffle_seed
+        pool = self.pool
+        offset = 0
+
+        for (player_index, player) in enumerate(sampled_game.players):
+            hand_size = self.hand_sizes[player_index]
+            if hand_size is not None:
+                pinned_cards = self.pinned_cards[player_index]
+                dealt_count = hand_size - len(pinned_cards)
+                player.hand = pinned_cards + pool[offset:(offset + dealt_count)]
+                offset += dealt_count
+
+            foot_size = self.foot_sizes[player_index]
+            player.foot = pool[offset:(offset + foot_size)]
+            offset += foot_size
+
+        if self.deck_pool is not None:
+            sampled_game.deck.cards = self.deck_pool[:self.deck_size]
+        else:
+            sampled_game.deck.cards = pool[offset:(offset + self.deck_size)]
+
+        for (future_round, future_cards) in self.future_decks.items():
+            future_deck = engine.Deck()
+            future_deck.cards = list(future_cards)
+            sampled_game.decks[future_round] = future_deck
+
+        sampled_game.reset_state_hash()
+        return sampled_game
+
+    def samples(self, sample_count):
+        for _ in range(0, sample_count):
+            yield self.sample()
@@ -1,8 +1,10 @@
 import abc
+import copy
 import enum
 import json
 import random
 import sys
+import time
 
 #
 # Errors
@@ -44,47 +46,70 @@ class CardRank(enum.Enum):
     ACE = "ace"
     JOKER = "joker"
 
+CARD_SUITS = list(CardSuit)
+CARD_RANKS = list(CardRank)
+
+SUIT_INDICES = {suit: i for (i, suit) in enumerate(CARD_SUITS)}
+RANK_INDICES = {rank: i for (i, rank) in enumerate(CARD_RANKS)}
+
+CARD_CODE_COUNT = len(CARD_RANKS) * len(CARD_SUITS)
+
 class Card(object):
+    __slots__ = ["suit", "rank", "code", "is_wild", "can_start_book", "point_value"]
 
     @staticmethod
     def from_json(card_json):
-        return Card(CardSuit(card_json["suit"]), CardRank(card_json["rank"]))
+        card = CARDS_BY_JSON_VALUES.get((card_json["suit"], card_json["rank"]))
 
-    def __init__(self, suit, rank):
-        self.suit = suit
-        self.rank = rank
+        if card is None:
+            card = Card(CardSuit(card_json["suit"]), CardRank(card_json["rank"]))
 
-    @property
-    def is_wild(self):
-        return ((self.rank == CardRank.TWO) or (self.rank == CardRank.JOKER))
+        return card
 
-    @property
-    def can_start_book(self):
-        return ((not self.is_wild) and (self.rank != CardRank.THREE))
+    @staticmethod
+    def from_code(code):
+        return Card(CARD_SUITS[code % len(CARD_SUITS)], CARD_RANKS[code // len(CARD_SUITS)])
 
-    @property
-    def point_value(self):
-        if self.rank in [CardRank.TWO]:
+    @staticmethod
+    def calculate_point_value(suit, rank):
+        if rank in [CardRank.TWO]:
             return 20
-        elif self.rank in [CardRank.THREE]:
-            if self.suit.is_red:
+        elif rank in [CardRank.THREE]:
+            if suit.is_red:
                 return -100
             else:
                 return 0
-        elif self.rank in [CardRank.FOUR, CardRank.FIVE, CardRank.SIX, CardRank.SEVEN, CardRank.EIGHT]:
+        elif rank in [CardRank.FOUR, CardRank.FIVE, CardRank.SIX, CardRank.SEVEN, CardRank.EIGHT]:
             return 5
-        elif self.rank in [CardRank.NINE, CardRank.TEN, CardRank.JACK, CardRank.QUEEN, CardRank.KING]:
+        elif rank in [CardRank.NINE, CardRank.TEN, CardRank.JACK, CardRank.QUEEN, CardRank.KING]:
             return 10
-        elif self.rank in [CardRank.ACE]:
+        elif rank in [CardRank.ACE]:
             return 20
-        elif self.rank in [CardRank.JOKER]:
+        elif rank in [CardRank.JOKER]:
             return 50
         else:
-            raise ValueError("Unknown rank: %s" % self.rank)
+            raise ValueError("Unknown rank: %s" % rank)
+
+    def __init__(self, suit, rank):
+        self.suit = suit
+        self.rank = rank
+
+        # Cards never change, so what the engine asks about them most often
+        # is worked out once
+        self.code = (RANK_INDICES[rank] * len(CARD_SUITS)) + SUIT_INDICES[suit]
+        self.is_wild = ((rank == CardRank.TWO) or (rank == CardRank.JOKER))
+        self.can_start_book = ((not self.is_wild) and (rank != CardRank.THREE))
+        self.point_value = Card.calculate_point_value(suit, rank)
 
     def __eq__(self, other):
         return ((self.suit == other.suit) and (self.rank == other.rank))
 
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
     def __str__(self):
         return "<Card (%s, %s)>" % (self.rank, self.suit)
 
@@ -94,29 +119,55 @@ class Card(object):
             "rank": self.rank.value
         }
 
+# Cards are never modified once they're created, so parsed cards are shared
+CARDS_BY_JSON_VALUES = {(suit.value, rank.value): Card(suit, rank) for rank in CARD_RANKS for suit in CARD_SUITS}
+CARDS_BY_CODE = [CARDS_BY_JSON_VALUES[(CARD_SUITS[code % len(CARD_SUITS)].value, CARD_RANKS[code // len(CARD_SUITS)].value)] for code in range(0, CARD_CODE_COUNT)]
+
+CARD_JSON_BY_CODE = [card.to_json() for card in CARDS_BY_CODE]
+CARD_CODES_BY_JSON_VALUES = {json_values: card.code for (json_values, card) in CARDS_BY_JSON_VALUES.items()}
+
+def cards_to_codes(cards):
+    return [card.code for card in cards]
+
+def cards_from_codes(codes):
+    return [CARDS_BY_CODE[code] for code in codes]
+
+# Every deck of a given size starts out the same, so the codes for each size
+# are built once and new decks are copies of them. Rules limit how many
+# standard decks a game has, which keeps this to a handful of templates.
+DECK_TEMPLATES = {}
+
+def standard_deck_codes(standard_deck_count):
+    if (standard_deck_count < 1) or (standard_deck_count > MAX_STANDARD_DECK_COUNT):
+        raise IllegalSetupError("Games are dealt from between 1 and %d standard decks" % MAX_STANDARD_DECK_COUNT)
+
+    template = DECK_TEMPLATES.get(standard_deck_count)
+
+    if template is None:
+        standard_deck = [Card(suit, rank).code for suit in CardSuit for rank in CardRank if rank != CardRank.JOKER]
+        standard_deck += [Card(CardSuit.SPADES, CardRank.JOKER).code] * 2
+
+        template = tuple(standard_deck * standard_deck_count)
+        DECK_TEMPLATES[standard_deck_count] = template
+
+    return template
+
 class Deck(object):
 
     @staticmethod
     def from_json(deck_json):
         deck = Deck()
-
-        for card_json in deck_json["cards"]:
-            deck.cards.append(Card.from_json(card_json))
-
+        deck.cards = [Card.from_json(card_json) for card_json in deck_json["cards"]]
         return deck
 
     def __init__(self, standard_deck_count=None):
-        self.cards = []
+        self.replenished_cards = None
+        self.cards_hash = None
 
         if standard_deck_count is not None:
-            for _ in range(0, standard_deck_count):
-                for suit in CardSuit:
-                    for rank in CardRank:
-                        if rank != CardRank.JOKER:
-                            self.cards.append(Card(suit, rank))
-
-                self.cards.append(Card(CardSuit.SPADES, CardRank.JOKER))
-                self.cards.append(Card(CardSuit.SPADES, CardRank.JOKER))
+            self.cards = cards_from_codes(standard_deck_codes(standard_deck_count))
+        else:
+            self.cards = []
 
     @property
     def is_empty(self):
@@ -126,32 +177,144 @@ class Deck(object):
     def card_count(self):
         return len(self.cards)
 
-    def shuffle(self):
-        random.shuffle(self.cards)
+    @property
+    def hash(self):
+        # Worked out the first time it's needed, then kept up to date as
+        # cards are drawn
+        if self.cards_hash is None:
+            self.cards_hash = stack_hash(DECK_PLACE, self.cards)
+
+        return self.cards_hash
+
+    def shuffle(self, rng=random):
+        rng.shuffle(self.cards)
+        self.cards_hash = None
 
     def draw(self):
         if self.is_empty:
             return None
-        else:
-            return self.cards.pop()
 
-    def replenish_cards_and_shuffle(self, cards):
+        card = self.cards.pop()
+        if self.cards_hash is not None:
+            self.cards_hash -= stack_card_key(DECK_PLACE, len(self.cards), card.code)
+
+        return card
+
+    def draw_cards(self, count):
+        # The same cards in the same order as calling draw count times, taken
+        # off the end of the deck in one slice
+        split_index = max(0, len(self.cards) - count)
+
+        cards = self.cards[split_index:]
+        del self.cards[split_index:]
+
+        if self.cards_hash is not None:
+            for (position, card) in enumerate(cards, split_index):
+                self.cards_hash -= stack_card_key(DECK_PLACE, position, card.code)
+
+        cards.reverse()
+
+        return cards
+
+    def replenish_cards_and_shuffle(self, cards, rng=random):
+        # Everyone saw these cards go into the discard pile, so what's left in
+        # the deck is public even though its order isn't
+        self.replenished_cards = list(cards)
         self.cards = cards
-        self.shuffle()
+        self.shuffle(rng)
+
+    def copy(self):
+        deck = Deck()
+        deck.cards = list(self.cards)
+        deck.replenished_cards = self.replenished_cards
+        deck.cards_hash = self.cards_hash
+        return deck
 
     def to_json(self):
         return {
-            "cards": [card.to_json() for card in self.cards]
+            "cards": [CARD_JSON_BY_CODE[card.code] for card in self.cards]
+        }
+
+    @staticmethod
+    def from_codes(codes, replenished_codes=None):
+        deck = Deck()
+        deck.cards = cards_from_codes(codes)
+
+        if replenished_codes is not None:
+            deck.replenished_cards = cards_from_codes(replenished_codes)
+
+        return deck
+
+    def to_snapshot_json(self):
+        return {
+            "cards": cards_to_codes(self.cards),
+            "replenished_cards": cards_to_codes(self.replenished_cards) if self.replenished_cards is not None else None
         }
 
+# A game only plays from one round's deck at a time, so decks for rounds that
+# haven't started are kept as bytes of card codes and only turned into cards
+# the first time they're looked up
+
+class RoundDecks(dict):
+
+    @staticmethod
+    def from_json(decks_json):
+        round_decks = RoundDecks()
+
+        for (round_value, deck_json) in decks_json.items():
+            codes = bytes([CARD_CODES_BY_JSON_VALUES[(card_json["suit"], card_json["rank"])] for card_json in deck_json["cards"]])
+            round_decks.pending_decks[Round(round_value)] = (codes, None)
+
+        return round_decks
+
+    @staticmethod
+    def from_snapshot_json(decks_json):
+        round_decks = RoundDecks()
+
+        for (round_value, deck_json) in decks_json.items():
+            replenished_codes = deck_json["replenished_cards"]
+            if replenished_codes is not None:
+                replenished_codes = bytes(replenished_codes)
+
+            round_decks.pending_decks[Round(round_value)] = (bytes(deck_json["cards"]), replenished_codes)
+
+        return round_decks
+
+    def __init__(self, decks=None):
+        super().__init__(decks if decks is not None else {})
+        self.pending_decks = {}
+
+    def __missing__(self, current_round):
+        pending_deck = self.pending_decks.pop(current_round, None)
+        if pending_deck is None:
+            raise KeyError(current_round)
+
+        deck = Deck.from_codes(*pending_deck)
+        self[current_round] = deck
+        return deck
+
+    def is_loaded(self, current_round):
+        return (current_round in self)
+
+    def copy(self):
+        # Pending decks are immutable bytes, so copies share them
+        round_decks = RoundDecks(self)
+        round_decks.pending_decks = dict(self.pending_decks)
+        return round_decks
+
 #
 # Book
 #
 
 class Book(object):
 
-    def __init__(self, initial_cards):
-        if len(initial_cards) < 3:
+    def __init__(self, initial_cards, rules=None):
+        if rules is None:
+            rules = DEFAULT_RULES.compile()
+
+        self.rules = rules
+
+        if len(initial_cards) < rules.minimum_book_size:
             raise IllegalActionError("Not enough cards to start a book")
 
         if len([card for card in initial_cards if card.can_start_book]) == 0:
@@ -188,7 +351,7 @@ class Book(object):
 
     @property
     def is_complete(self):
-        return (len(self.cards) >= 7)
+        return (len(self.cards) >= self.rules.complete_book_size)
 
     @property
     def cards_value(self):
@@ -199,10 +362,27 @@ class Book(object):
         if not self.is_complete:
             return 0
 
-        if self.is_natural:
-            return 500
-        else:
-            return 300
+        return self.rules.book_values[self.is_natural]
+
+    @property
+    def can_add_wild_card(self):
+        return (self.wild_count < self.rules.max_wild_counts[self.natural_count])
+
+    @staticmethod
+    def from_snapshot_json(book_json, rules):
+        # Snapshots keep the cards in the order they were played
+        book = Book.__new__(Book)
+        book.rules = rules
+        book.rank = CardRank(book_json["rank"])
+        book.cards = cards_from_codes(book_json["cards"])
+        return book
+
+    def copy(self):
+        book = Book.__new__(Book)
+        book.rules = self.rules
+        book.rank = self.rank
+        book.cards = list(self.cards)
+        return book
 
     def add_card(self, card):
         if card.is_wild:
@@ -211,7 +391,7 @@ class Book(object):
             self.add_natural_card(card)
 
     def add_wild_card(self, card):
-        if self.wild_count >= (self.natural_count - 1):
+        if not self.can_add_wild_card:
             raise IllegalActionError("Too many wilds in book to add another")
 
         self.cards.append(card)
@@ -228,6 +408,82 @@ class Book(object):
             "cards": [card.to_json() for card in self.cards]
         }
 
+    def to_snapshot_json(self):
+        return {
+            "rank": self.rank.value,
+            "cards": cards_to_codes(self.cards)
+        }
+
+class BookStatus(object):
+    __slots__ = ["natural_count", "unnatural_count", "complete_natural_count", "complete_unnatural_count", "cards_needed", "book_states"]
+
+    # What a player's books in one round come to, kept up to date as cards
+    # are added so going out can be checked without looking at every book:
+    # how many are natural and unnatural, how many of each are complete, and
+    # how many cards each open book still needs. Books only ever gain cards,
+    # so each one's last (is_natural, is_complete) is enough to update them.
+
+    @staticmethod
+    def from_books(round_books):
+        status = BookStatus()
+        for book in round_books.values():
+            status.update_book(book)
+
+        return status
+
+    def __init__(self):
+        self.natural_count = 0
+        self.unnatural_count = 0
+        self.complete_natural_count = 0
+        self.complete_unnatural_count = 0
+        self.cards_needed = {}
+        self.book_states = {}
+
+    def copy(self):
+        status = BookStatus.__new__(BookStatus)
+        status.natural_count = self.natural_count
+        status.unnatural_count = self.unnatural_count
+        status.complete_natural_count = self.complete_natural_count
+        status.complete_unnatural_count = self.complete_unnatural_count
+        status.cards_needed = dict(self.cards_needed)
+        status.book_states = dict(self.book_states)
+        return status
+
+    def update_book(self, book):
+        previous_state = self.book_states.get(book.rank)
+        if previous_state is not None:
+            self.count_book(previous_state, -1)
+
+        state = (book.is_natural, book.is_complete)
+        self.book_states[book.rank] = state
+        self.count_book(state, 1)
+
+        if state[1]:
+            self.cards_needed.pop(book.rank, None)
+        else:
+            self.cards_needed[book.rank] = book.rules.complete_book_size - book.card_count
+
+    def count_book(self, state, change):
+        (is_natural, is_complete) = state
+
+        if is_natural:
+            self.natural_count += change
+            if is_complete:
+                self.complete_natural_count += change
+        else:
+            self.unnatural_count += change
+            if is_complete:
+                self.complete_unnatural_count += change
+
+    def to_json(self):
+        return {
+            "natural_books": self.natural_count,
+            "unnatural_books": self.unnatural_count,
+            "complete_natural_books": self.complete_natural_count,
+            "complete_unnatural_books": self.complete_unnatural_count,
+            "cards_needed": {rank.value: cards_needed for (rank, cards_needed) in self.cards_needed.items()}
+        }
+
 #
 # Round
 #
@@ -264,12 +520,269 @@ class Round(enum.Enum):
         else:
             raise ValueError("Unknown round")
 
+ROUND_INDICES = {current_round: i for (i, current_round) in enumerate(Round)}
+
+#
+# Rules
+#
+
+MAX_PLAYER_COUNT = 6
+MAX_EXTRA_DECK_COUNT = 4
+MAX_STANDARD_DECK_COUNT = MAX_PLAYER_COUNT + MAX_EXTRA_DECK_COUNT
+STANDARD_DECK_SIZE = 54
+
+# The largest each rule can be, so a house variant can't ask for a deck or a
+# table of wild counts that takes the process down
+RULE_MAXIMUMS = {
+    "hand_size": 100,
+    "foot_size": 100,
+    "minimum_book_size": 100,
+    "complete_book_size": 100,
+    "natural_book_value": 100000,
+    "unnatural_book_value": 100000,
+    "going_out_bonus": 100000,
+    "natural_surplus": 100,
+    "extra_deck_count": MAX_EXTRA_DECK_COUNT
+}
+
+MAX_POINTS_NEEDED = 100000
+
+# Cards a player draws to start their first turn, which the deck has to
+# have left after dealing
+FIRST_DRAW_SIZE = 2
+
+class RuleSet(object):
+
+    @staticmethod
+    def from_json(rules_json):
+        if (type(rules_json) is not dict) or (type(rules_json.get("points_needed", {})) is not dict):
+            raise IllegalSetupError("Rules must be an object")
+
+        points_needed = {}
+        for (round_value, round_points_needed) in rules_json.get("points_needed", {}).items():
+            try:
+                points_needed[Round(round_value)] = round_points_needed
+            except ValueError:
+                raise IllegalSetupError("Unknown round: " + str(round_value))
+
+        return RuleSet(
+            points_needed=points_needed,
+            hand_size=rules_json.get("hand_size", 13),
+            foot_size=rules_json.get("foot_size", 13),
+            minimum_book_size=rules_json.get("minimum_book_size", 3),
+            complete_book_size=rules_json.get("complete_book_size", 7),
+            natural_book_value=rules_json.get("natural_book_value", 500),
+            unnatural_book_value=rules_json.get("unnatural_book_value", 300),
+            going_out_bonus=rules_json.get("going_out_bonus", 100),
+            natural_surplus=rules_json.get("natural_surplus", 1),
+            extra_deck_count=rules_json.get("extra_deck_count", 1)
+        )
+
+    def __init__(self, points_needed=None, hand_size=13, foot_size=13, minimum_book_size=3, complete_book_size=7, natural_book_value=500, unnatural_book_value=300, going_out_bonus=100, natural_surplus=1, extra_deck_count=1):
+        # Rounds that aren't given keep their usual threshold
+        self.points_needed = {current_round: current_round.points_needed for current_round in Round}
+        if points_needed is not None:
+            self.points_needed.update(points_needed)
+
+        self.hand_size = hand_size
+        self.foot_size = foot_size
+        self.minimum_book_size = minimum_book_size
+        self.complete_book_size = complete_book_size
+        self.natural_book_value = natural_book_value
+        self.unnatural_book_value = unnatural_book_value
+        self.going_out_bonus = going_out_bonus
+
+        # How many more naturals than wilds a book must always have
+        self.natural_surplus = natural_surplus
+
+        # Games are dealt from one standard deck per player plus this many
+        self.extra_deck_count = extra_deck_count
+
+        self.validate()
+        self.compiled_rules = None
+
+    def validate(self):
+        numbers = [self.hand_size, self.foot_size, self.minimum_book_size, self.complete_book_size, self.natural_book_value, self.unnatural_book_value, self.going_out_bonus, self.natural_surplus, self.extra_deck_count]
+        numbers += list(self.points_needed.values())
+
+        for number in numbers:
+            if (type(number) is not int) or (number < 0):
+                raise IllegalSetupError("Rules must be non-negative whole numbers")
+
+        for (name, maximum) in RULE_MAXIMUMS.items():
+            if getattr(self, name) > maximum:
+                raise IllegalSetupError("%s can be at most %d" % (name.replace("_", " ").capitalize(), maximum))
+
+        if max(self.points_needed.values()) > MAX_POINTS_NEEDED:
+            raise IllegalSetupError("Points needed can be at most %d" % MAX_POINTS_NEEDED)
+
+        if (self.hand_size < 1) or (self.foot_size < 1):
+            raise IllegalSetupError("Hands and feet need at least one card")
+
+        if self.minimum_book_size < 1:
+            raise IllegalSetupError("Books need at least one card")
+
+        if self.complete_book_size < self.minimum_book_size:
+            raise IllegalSetupError("Complete books can't be smaller than new ones")
+
+        if self.natural_surplus < 1:
+            raise IllegalSetupError("Books need more naturals than wilds")
+
+        # Every hand and foot has to be dealt with the first draw still left
+        # in the deck, for every number of players
+        for player_count in range(2, MAX_PLAYER_COUNT + 1):
+            dealt_card_count = player_count * (self.hand_size + self.foot_size) + FIRST_DRAW_SIZE
+            if dealt_card_count > self.standard_deck_count(player_count) * STANDARD_DECK_SIZE:
+                raise IllegalSetupError("Hands and feet are too big to deal to %d players" % player_count)
+
+    def standard_deck_count(self, player_count):
+        return (player_count + self.extra_deck_count)
+
+    def compile(self):
+        if self.compiled_rules is None:
+            self.compiled_rules = CompiledRules(self)
+
+        return self.compiled_rules
+
+    def to_json(self):
+        return {
+            "points_needed": {current_round.value: round_points_needed for (current_round, round_points_needed) in self.points_needed.items()},
+            "hand_size": self.hand_size,
+            "foot_size": self.foot_size,
+            "minimum_book_size": self.minimum_book_size,
+            "complete_book_size": self.complete_book_size,
+            "natural_book_value": self.natural_book_value,
+            "unnatural_book_value": self.unnatural_book_value,
+            "going_out_bonus": self.going_out_bonus,
+            "natural_surplus": self.natural_surplus,
+            "extra_deck_count": self.extra_deck_count
+        }
+
+# The engine only ever reads compiled rules: plain attributes and tables built
+# once per game, so a house variant costs the same per action as the defaults
+
+class CompiledRules(object):
+    __slots__ = ["rule_set", "points_needed", "hand_size", "foot_size", "minimum_book_size", "complete_book_size", "book_values", "going_out_bonus", "max_wild_counts"]
+
+    def __init__(self, rule_set):
+        self.rule_set = rule_set
+        self.points_needed = dict(rule_set.points_needed)
+        self.hand_size = rule_set.hand_size
+        self.foot_size = rule_set.foot_size
+        self.minimum_book_size = rule_set.minimum_book_size
+        self.complete_book_size = rule_set.complete_book_size
+        self.going_out_bonus = rule_set.going_out_bonus
+
+        # Indexed by whether the book is natural
+        self.book_values = (rule_set.unnatural_book_value, rule_set.natural_book_value)
+
+        # The most wilds a book can hold, indexed by how many naturals it has
+        max_natural_count = rule_set.standard_deck_count(MAX_PLAYER_COUNT) * len(CardSuit)
+        self.max_wild_counts = [max(0, natural_count - rule_set.natural_surplus) for natural_count in range(0, max_natural_count + 1)]
+
+DEFAULT_RULES = RuleSet()
+
+#
+# State Hashing
+#
+
+# Game.state_hash is Zobrist-style: every place a card can be has a 64-bit key
+# for each card, and a game's hash is the sum of the keys for where each of
+# its cards is, so moving a card takes out one key and puts in another. Keys
+# are summed rather than XORed because a game holds several copies of most
+# cards. Hands, feet and books are sets as far as the rules care, so their
+# keys only depend on the card. The deck and discard pile are stacks, so
+# their keys depend on the card's position too.
+#
+# Keys come from a fixed mixing function rather than a random generator, so
+# every process agrees on them and hashes can be stored.
+
+HASH_MASK = (1 << 64) - 1
+
+def mix_hash(value):
+    # The splitmix64 finalizer
+    value = (value + 0x9E3779B97F4A7C15) & HASH_MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & HASH_MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & HASH_MASK
+    return (value ^ (value >> 31))
+
+HAND_PLACE = 1
+FOOT_PLACE = 2
+BOOK_PLACE = 3
+DECK_PLACE = 4
+DISCARD_PILE_PLACE = 5
+TURN_PLACE = 6
+SEAT_PLACE = 7
+ROUND_PLACE = 8
+POINTS_PLACE = 9
+
+HAND_KEYS = [mix_hash((HAND_PLACE << 48) | code) for code in range(0, CARD_CODE_COUNT)]
+FOOT_KEYS = [mix_hash((FOOT_PLACE << 48) | code) for code in range(0, CARD_CODE_COUNT)]
+
+# Indexed by round, then the rank of the book
+BOOK_KEYS = {
+    current_round: {
+        rank: [mix_hash((BOOK_PLACE << 48) | (ROUND_INDICES[current_round] << 24) | (RANK_INDICES[rank] << 8) | code) for code in range(0, CARD_CODE_COUNT)]
+        for rank in CARD_RANKS
+    }
+    for current_round in Round
+}
+
+# Player hashes don't depend on where the player sits, so they're multiplied
+# by an odd key for their seat when they're added into the game's
+SEAT_KEYS = [mix_hash((SEAT_PLACE << 48) | seat) | 1 for seat in range(0, MAX_PLAYER_COUNT)]
+
+# Indexed by seat, then cards drawn from the deck, cards drawn from the
+# discard pile and whether the player has laid down, packed into one number
+TURN_KEYS = [[mix_hash((TURN_PLACE << 48) | (seat << 8) | turn_state) for turn_state in range(0, 32)] for seat in range(0, MAX_PLAYER_COUNT)]
+
+STACK_KEYS = {DECK_PLACE: [], DISCARD_PILE_PLACE: []}
+STACK_KEY_ROWS = 64
+
+def stack_card_key(place, position, code):
+    keys = STACK_KEYS[place]
+    index = (position * CARD_CODE_COUNT) + code
+
+    # Stacks can be as tall as every card in the game, so keys for more
+    # positions are made as they're needed
+    while index >= len(keys):
+        first_position = len(keys) // CARD_CODE_COUNT
+        for new_position in range(first_position, first_position + STACK_KEY_ROWS):
+            keys.extend([mix_hash((place << 48) | (new_position << 8) | new_code) for new_code in range(0, CARD_CODE_COUNT)])
+
+    return keys[index]
+
+def stack_hash(place, cards):
+    return sum([stack_card_key(place, position, card.code) for (position, card) in enumerate(cards)])
+
+def points_hash(seat, current_round, points):
+    points_hash = (POINTS_PLACE << 48) | (seat << 8) | ROUND_INDICES[current_round]
+
+    for points_value in (points.in_hand, points.in_foot, points.in_books, points.laid_down, points.for_going_out):
+        points_hash = mix_hash(points_hash ^ (points_value & HASH_MASK))
+
+    return points_hash
+
+def state_hash_string(state_hash):
+    # How hashes are stored alongside actions
+    return "%016x" % state_hash
+
 #
 # Player
 #
 
 class Points(object):
 
+    @staticmethod
+    def from_json(points_json):
+        points = Points()
+        points.in_hand = points_json["in_hand"]
+        points.in_foot = points_json["in_foot"]
+        points.in_books = points_json["in_books"]
+        points.laid_down = points_json["laid_down"]
+        points.for_going_out = points_json["for_going_out"]
+        return points
+
     def __init__(self):
         self.in_hand = 0
         self.in_foot = 0
@@ -277,6 +790,19 @@ class Points(object):
         self.laid_down = 0
         self.for_going_out = 0
 
+    def copy(self):
+        points = Points()
+        points.in_hand = self.in_hand
+        points.in_foot = self.in_foot
+        points.in_books = self.in_books
+        points.laid_down = self.laid_down
+        points.for_going_out = self.for_going_out
+        return points
+
+    @property
+    def total(self):
+        return (self.in_hand + self.in_foot + self.in_books + self.laid_down + self.for_going_out)
+
     def to_json(self):
         return {
             "in_hand": self.in_hand,
@@ -288,8 +814,32 @@ class Points(object):
 
 class Player(object):
 
-    def __init__(self, name):
+    @staticmethod
+    def from_snapshot_json(player_json, rules):
+        player = Player(player_json["name"], rules)
+        player.hand = cards_from_codes(player_json["hand"])
+        player.foot = cards_from_codes(player_json["foot"])
+
+        for (round_value, books_json) in player_json["books"].items():
+            round_books = player.books[Round(round_value)]
+            for book_json in books_json:
+                book = Book.from_snapshot_json(book_json, rules)
+                round_books[book.rank] = book
+
+        for (round_value, points_json) in player_json["points"].items():
+            player.points[Round(round_value)] = Points.from_json(points_json)
+
+        player.cards_drawn_from_deck = player_json["cards_drawn_from_deck"]
+        player.cards_drawn_from_discard_pile = player_json["cards_drawn_from_discard_pile"]
+        player.has_laid_down_this_round = player_json["has_laid_down_this_round"]
+        return player
+
+    def __init__(self, name, rules=None):
+        if rules is None:
+            rules = DEFAULT_RULES.compile()
+
         self.name = name
+        self.rules = rules
         self.hand = []
         self.foot = []
 
@@ -311,12 +861,67 @@ class Player(object):
         self.cards_drawn_from_discard_pile = 0
         self.has_laid_down_this_round = False
 
+        # The sum of the hash keys for every card in the player's hand, foot
+        # and books, or None until it's first needed
+        self.cards_hash = None
+
+        # Book statuses by round, each built the first time it's needed
+        self.book_statuses = {}
+
     def set_hand_and_foot(self, hand, foot):
-        if len(hand) != 13 or len(foot) != 13:
+        if len(hand) != self.rules.hand_size or len(foot) != self.rules.foot_size:
             raise IllegalSetupError("Initial hand or foot not sized correctly")
 
         self.hand = hand
         self.foot = foot
+        self.cards_hash = None
+
+    def copy(self, current_round):
+        player = Player.__new__(Player)
+        player.name = self.name
+        player.rules = self.rules
+        player.hand = list(self.hand)
+        player.foot = list(self.foot)
+
+        # Books from earlier rounds can't change anymore, so they're shared
+        player.books = {books_round: dict(round_books) for (books_round, round_books) in self.books.items()}
+        if current_round is not None:
+            player.books[current_round] = {rank: book.copy() for (rank, book) in self.books[current_round].items()}
+
+        player.points = {points_round: points.copy() for (points_round, points) in self.points.items()}
+        player.cards_drawn_from_deck = self.cards_drawn_from_deck
+        player.cards_drawn_from_discard_pile = self.cards_drawn_from_discard_pile
+        player.has_laid_down_this_round = self.has_laid_down_this_round
+        player.cards_hash = self.cards_hash
+
+        player.book_statuses = dict(self.book_statuses)
+        if current_round in self.book_statuses:
+            player.book_statuses[current_round] = self.book_statuses[current_round].copy()
+
+        return player
+
+    @property
+    def hash(self):
+        if self.cards_hash is None:
+            cards_hash = sum([HAND_KEYS[card.code] for card in self.hand]) + sum([FOOT_KEYS[card.code] for card in self.foot])
+
+            for (current_round, round_books) in self.books.items():
+                for book in round_books.values():
+                    book_keys = BOOK_KEYS[current_round][book.rank]
+                    cards_hash += sum([book_keys[card.code] for card in book.cards])
+
+            self.cards_hash = cards_hash
+
+        return self.cards_hash
+
+    @property
+    def turn_state(self):
+        return (self.cards_drawn_from_deck | (self.cards_drawn_from_discard_pile << 2) | (self.has_laid_down_this_round << 4))
+
+    def reset_hash(self):
+        # For anything that changes the hand, foot or books directly
+        self.cards_hash = None
+        self.book_statuses = {}
 
     @property
     def can_draw_from_deck(self):
@@ -339,45 +944,87 @@ class Player(object):
         return ((self.cards_drawn_from_deck + self.cards_drawn_from_discard_pile) == 2)
 
     def can_go_out(self, current_round):
-        return (self.has_natural_book(current_round) and self.has_unnatural_book(current_round) and self.is_in_foot)
+        return (self.is_in_foot and self.has_natural_book(current_round) and self.has_unnatural_book(current_round))
 
     def has_natural_book(self, current_round):
-        return (len([book for book in self.books[current_round].values() if book.is_natural]) > 0)
+        return (self.book_status(current_round).natural_count > 0)
 
     def has_unnatural_book(self, current_round):
-        return (len([book for book in self.books[current_round].values() if not book.is_natural]) > 0)
+        return (self.book_status(current_round).unnatural_count > 0)
+
+    def book_status(self, current_round):
+        status = self.book_statuses.get(current_round)
+        if status is None:
+            status = BookStatus.from_books(self.books[current_round])
+            self.book_statuses[current_round] = status
+
+        return status
+
+    def update_book_status(self, book, current_round):
+        # Only statuses that have been built need keeping up
+        status = self.book_statuses.get(current_round)
+        if status is not None:
+            status.update_book(book)
+
+    def turn_status(self, current_round):
+        # How close the player is to going out, for clients to show
+        status_json = self.book_status(current_round).to_json()
+        status_json["is_in_foot"] = self.is_in_foot
+        status_json["can_go_out"] = self.can_go_out(current_round)
+        return status_json
 
     def add_card_to_hand_from_deck(self, card):
         self.hand.append(card)
         self.cards_drawn_from_deck += 1
 
+        if self.cards_hash is not None:
+            self.cards_hash += HAND_KEYS[card.code]
+
     def add_card_to_hand_from_discard_pile(self, card):
         self.hand.append(card)
         self.cards_drawn_from_discard_pile += 1
 
+        if self.cards_hash is not None:
+            self.cards_hash += HAND_KEYS[card.code]
+
     def remove_card_from_hand(self, card):
         try:
             self.hand.remove(card)
         except ValueError:
             raise IllegalActionError("Card not in hand")
 
+        if self.cards_hash is not None:
+            self.cards_hash -= HAND_KEYS[card.code]
+
     def add_cards_from_hand_to_book(self, cards, book_rank, current_round):
         if book_rank not in self.books[current_round]:
             raise IllegalActionError("Player doesn't have a book for the given card")
 
+        book = self.books[current_round][book_rank]
+        book_keys = BOOK_KEYS[current_round][book_rank]
+
         for card in cards:
             self.remove_card_from_hand(card)
-            self.books[current_round][book_rank].add_card(card)
+            book.add_card(card)
+            self.update_book_status(book, current_round)
+
+            if self.cards_hash is not None:
+                self.cards_hash += book_keys[card.code]
 
     def add_card_from_discard_pile_to_book(self, card, book_rank, current_round):
         if book_rank not in self.books[current_round]:
             raise IllegalActionError("Player doesn't have a book for the given card")
 
-        self.books[current_round][book_rank].add_card(card)
+        book = self.books[current_round][book_rank]
+        book.add_card(card)
+        self.update_book_status(book, current_round)
         self.cards_drawn_from_discard_pile += 1
 
+        if self.cards_hash is not None:
+            self.cards_hash += BOOK_KEYS[current_round][book_rank][card.code]
+
     def start_book(self, cards, current_round):
-        book = Book(cards)
+        book = Book(cards, self.rules)
 
         if book.rank in self.books[current_round]:
             raise IllegalActionError("Player already has a book of the given rank")
@@ -386,11 +1033,20 @@ class Player(object):
             self.remove_card_from_hand(card)
 
         self.books[current_round][book.rank] = book
+        self.update_book_status(book, current_round)
+
+        if self.cards_hash is not None:
+            book_keys = BOOK_KEYS[current_round][book.rank]
+            self.cards_hash += sum([book_keys[card.code] for card in book.cards])
 
     def laid_down(self):
         self.has_laid_down_this_round = True
 
     def pick_up_foot(self):
+        if self.cards_hash is not None:
+            self.cards_hash -= sum([HAND_KEYS[card.code] for card in self.hand])
+            self.cards_hash += sum([HAND_KEYS[card.code] - FOOT_KEYS[card.code] for card in self.foot])
+
         self.hand = self.foot
         self.foot = []
 
@@ -409,7 +1065,7 @@ class Player(object):
         self.points[current_round].laid_down = sum([book.cards_value for book in self.books[current_round].values()])
 
     def add_bonus_for_going_out(self, current_round):
-        self.points[current_round].for_going_out = 100
+        self.points[current_round].for_going_out = self.rules.going_out_bonus
 
     def to_json(self):
         books_json = {}
@@ -430,88 +1086,240 @@ class Player(object):
             "points": points_json
         }
 
+    def to_snapshot_json(self):
+        return {
+            "name": self.name,
+            "hand": cards_to_codes(self.hand),
+            "foot": cards_to_codes(self.foot),
+            "books": {current_round.value: [book.to_snapshot_json() for book in round_books.values()] for (current_round, round_books) in self.books.items()},
+            "points": {points_round.value: points.to_json() for (points_round, points) in self.points.items()},
+            "cards_drawn_from_deck": self.cards_drawn_from_deck,
+            "cards_drawn_from_discard_pile": self.cards_drawn_from_discard_pile,
+            "has_laid_down_this_round": self.has_laid_down_this_round
+        }
+
 #
 # Actions
 #
 
 class Action(abc.ABC):
+    __slots__ = ["player_name"]
+
+    action_classes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Action.action_classes[cls.action_type] = cls
 
     @staticmethod
     def from_json(action_json):
         action_type = action_json["type"]
 
-        if action_type == "draw_from_deck":
-            return DrawFromDeckAction(action_json["player"])
-        elif action_type == "draw_from_discard_pile_and_add_to_book":
-            book_rank = CardRank(action_json["book_rank"])
-            return DrawFromDiscardPileAndAddToBookAction(action_json["player"], book_rank)
-        elif action_type == "draw_from_discard_pile_and_start_book":
-            cards = [Card.from_json(card_json) for card_json in action_json["cards"]]
-            return DrawFromDiscardPileAndStartBookAction(action_json["player"], cards)
-        elif action_type == "discard_card":
-            card = Card.from_json(action_json["card"])
-            return DiscardCardAction(action_json["player"], card)
-        elif action_type == "lay_down_initial_books":
-            books = [[Card.from_json(card_json) for card_json in cards_json] for cards_json in action_json["books"]]
-            return LayDownInitialBooksAction(action_json["player"], books)
-        elif action_type == "draw_from_discard_pile_and_lay_down_initial_books":
-            partial_book = [Card.from_json(card_json) for card_json in action_json["partial_book"]]
-            books = [[Card.from_json(card_json) for card_json in cards_json] for cards_json in action_json["books"]]
-            return DrawFromDiscardPileAndLayDownInitialBooksAction(action_json["player"], partial_book, books)
-        elif action_type == "start_book":
-            cards = [Card.from_json(card_json) for card_json in action_json["cards"]]
-            return StartBookAction(action_json["player"], cards)
-        elif action_type == "add_cards_from_hand_to_book":
-            cards = [Card.from_json(card_json) for card_json in action_json["cards"]]
-            book_rank = CardRank(action_json["book_rank"])
-            return AddCardsFromHandToBookAction(action_json["player"], cards, book_rank)
-        else:
+        action_class = Action.action_classes.get(action_type)
+        if action_class is None:
             raise ValueError("Unknown action type: " + action_type)
 
+        return action_class.from_json(action_json)
+
     def __init__(self, player_name):
         self.player_name = player_name
 
+    @abc.abstractmethod
+    def apply(self, game, player):
+        pass
+
+    def to_json(self):
+        return {
+            "type": self.action_type,
+            "player": self.player_name
+        }
+
 class DrawFromDeckAction(Action):
+    __slots__ = []
+    action_type = "draw_from_deck"
+
+    @staticmethod
+    def from_json(action_json):
+        return DrawFromDeckAction(action_json["player"])
+
     def __init__(self, player_name):
         super().__init__(player_name)
 
+    def apply(self, game, player):
+        game.apply_draw_from_deck_action(player)
+
 class DrawFromDiscardPileAndAddToBookAction(Action):
+    __slots__ = ["book_rank"]
+    action_type = "draw_from_discard_pile_and_add_to_book"
+
+    @staticmethod
+    def from_json(action_json):
+        book_rank = CardRank(action_json["book_rank"])
+        return DrawFromDiscardPileAndAddToBookAction(action_json["player"], book_rank)
+
     def __init__(self, player_name, book_rank):
         super().__init__(player_name)
         self.book_rank = book_rank
 
+    def apply(self, game, player):
+        game.apply_draw_from_discard_pile_and_add_to_book_action(player, self.book_rank)
+
+    def to_json(self):
+        action_json = super().to_json()
+        action_json["book_rank"] = self.book_rank.value
+        return action_json
+
 class DrawFromDiscardPileAndStartBookAction(Action):
+    __slots__ = ["cards"]
+    action_type = "draw_from_discard_pile_and_start_book"
+
+    @staticmethod
+    def from_json(action_json):
+        cards = [Card.from_json(card_json) for card_json in action_json["cards"]]
+        return DrawFromDiscardPileAndStartBookAction(action_json["player"], cards)
+
     def __init__(self, player_name, cards):
         super().__init__(player_name)
         self.cards = cards
 
+    def apply(self, game, player):
+        game.apply_draw_from_discard_pile_and_start_book_action(player, self.cards)
+
+    def to_json(self):
+        action_json = super().to_json()
+        action_json["cards"] = [card.to_json() for card in self.cards]
+        return action_json
+
 class DiscardCardAction(Action):
+    __slots__ = ["card"]
+    action_type = "discard_card"
+
+    @staticmethod
+    def from_json(action_json):
+        card = Card.from_json(action_json["card"])
+        return DiscardCardAction(action_json["player"], card)
+
     def __init__(self, player_name, card):
         super().__init__(player_name)
         self.card = card
 
+    def apply(self, game, player):
+        game.apply_discard_card_action(player, self.card)
+
+    def to_json(self):
+        action_json = super().to_json()
+        action_json["card"] = self.card.to_json()
+        return action_json
+
 class LayDownInitialBooksAction(Action):
+    __slots__ = ["books"]
+    action_type = "lay_down_initial_books"
+
+    @staticmethod
+    def from_json(action_json):
+        books = [[Card.from_json(card_json) for card_json in cards_json] for cards_json in action_json["books"]]
+        return LayDownInitialBooksAction(action_json["player"], books)
+
     def __init__(self, player_name, books):
         super().__init__(player_name)
         self.books = books
 
+    def apply(self, game, player):
+        game.apply_lay_down_initial_books_action(player, self.books)
+
+    def to_json(self):
+        action_json = super().to_json()
+        action_json["books"] = [[card.to_json() for card in book] for book in self.books]
+        return action_json
+
 class DrawFromDiscardPileAndLayDownInitialBooksAction(Action):
+    __slots__ = ["partial_book", "books"]
+    action_type = "draw_from_discard_pile_and_lay_down_initial_books"
+
+    @staticmethod
+    def from_json(action_json):
+        partial_book = [Card.from_json(card_json) for card_json in action_json["partial_book"]]
+        books = [[Card.from_json(card_json) for card_json in cards_json] for cards_json in action_json["books"]]
+        return DrawFromDiscardPileAndLayDownInitialBooksAction(action_json["player"], partial_book, books)
+
     def __init__(self, player_name, partial_book, books):
         super().__init__(player_name)
         self.partial_book = partial_book
         self.books = books
 
+    def apply(self, game, player):
+        game.apply_draw_from_discard_pile_and_lay_down_initial_books_action(player, self.partial_book, self.books)
+
+    def to_json(self):
+        action_json = super().to_json()
+        action_json["partial_book"] = [card.to_json() for card in self.partial_book]
+        action_json["books"] = [[card.to_json() for card in book] for book in self.books]
+        return action_json
+
 class StartBookAction(Action):
+    __slots__ = ["cards"]
+    action_type = "start_book"
+
+    @staticmethod
+    def from_json(action_json):
+        cards = [Card.from_json(card_json) for card_json in action_json["cards"]]
+        return StartBookAction(action_json["player"], cards)
+
     def __init__(self, player_name, cards):
         super().__init__(player_name)
         self.cards = cards
 
+    def apply(self, game, player):
+        game.apply_start_book_action(player, self.cards)
+
+    def to_json(self):
+        action_json = super().to_json()
+        action_json["cards"] = [card.to_json() for card in self.cards]
+        return action_json
+
 class AddCardsFromHandToBookAction(Action):
+    __slots__ = ["cards", "book_rank"]
+    action_type = "add_cards_from_hand_to_book"
+
+    @staticmethod
+    def from_json(action_json):
+        cards = [Card.from_json(card_json) for card_json in action_json["cards"]]
+        book_rank = CardRank(action_json["book_rank"])
+        return AddCardsFromHandToBookAction(action_json["player"], cards, book_rank)
+
     def __init__(self, player_name, cards, book_rank):
         super().__init__(player_name)
         self.cards = cards
         self.book_rank = book_rank
 
+    def apply(self, game, player):
+        game.apply_add_cards_from_hand_to_book_action(player, self.cards, self.book_rank)
+
+    def to_json(self):
+        action_json = super().to_json()
+        action_json["cards"] = [card.to_json() for card in self.cards]
+        action_json["book_rank"] = self.book_rank.value
+        return action_json
+
+#
+# Instrumentation
+#
+
+class MetricsSink(object):
+    enabled = False
+
+    def action_applied(self, action_type, duration):
+        pass
+
+    def illegal_action(self, action_type, reason):
+        pass
+
+    def deck_reshuffled(self):
+        pass
+
+    def round_ended_by_empty_deck(self):
+        pass
+
 #
 # Game
 #
@@ -534,24 +1342,66 @@ class PlayerIterator(object):
 
 class Game(object):
 
+    @staticmethod
+    def from_snapshot_json(snapshot_json, metrics_sink=None):
+        rules = RuleSet.from_json(snapshot_json["rules"])
+
+        # Build an empty game around the snapshot without dealing any cards
+        game = Game.__new__(Game)
+        game.metrics_sink = metrics_sink if metrics_sink is not None else MetricsSink()
+        game.rules = rules.compile()
+        game.shuffle_seed = snapshot_json["shuffle_seed"]
+        game.reshuffle_count = snapshot_json["reshuffle_count"]
+        game.round = Round(snapshot_json["round"]) if snapshot_json["round"] is not None else None
+
+        game.decks = RoundDecks.from_snapshot_json(snapshot_json["decks"])
+
+        game.discard_pile = cards_from_codes(snapshot_json["discard_pile"])
+        game.players = [Player.from_snapshot_json(player_json, game.rules) for player_json in snapshot_json["players"]]
+        game.player_iterator = PlayerIterator(game.players)
+        game.player_iterator.index = snapshot_json["current_player_index"]
+
+        game.discard_pile_hash = None
+        game.finished_rounds_hash = None
+        return game
+
     @property
     def deck(self):
         return self.decks[self.round]
 
-    def __init__(self, player_names, decks):
+    def __init__(self, player_names, decks, metrics_sink=None, rules=None, shuffle_seed=""):
         if len(player_names) < 2:
             raise IllegalSetupError("Not enough players")
 
-        if len(player_names) > 6:
+        if len(player_names) > MAX_PLAYER_COUNT:
             raise IllegalSetupError("Too many players")
 
-        self.decks = decks
+        if metrics_sink is None:
+            metrics_sink = MetricsSink()
+
+        if rules is None:
+            rules = DEFAULT_RULES
+
+        self.metrics_sink = metrics_sink
+        self.rules = rules.compile()
+
+        # Shuffling the discard pile back into the deck has to come out the
+        # same every time a game is replayed
+        self.shuffle_seed = shuffle_seed
+        self.reshuffle_count = 0
+
+        self.decks = decks if isinstance(decks, RoundDecks) else RoundDecks(decks)
         self.discard_pile = []
         self.round = Round.NINETY
 
+        # Parts of the state hash kept up to date as the game goes, or None
+        # until they're first needed
+        self.discard_pile_hash = 0
+        self.finished_rounds_hash = 0
+
         self.players = []
         for player_name in player_names:
-            self.players.append(Player(player_name))
+            self.players.append(Player(player_name, self.rules))
 
         self.player_iterator = PlayerIterator(self.players)
 
@@ -561,18 +1411,47 @@ class Game(object):
         for player in self.players:
             player.calculate_points(self.round)
 
-    def deal_cards_to_player(self, player):
-        hand = []
-        for _ in range(0, 13):
-            hand.append(self.deck.draw())
-
-        foot = []
-        for _ in range(0, 13):
-            foot.append(self.deck.draw())
+    def copy(self):
+        # Copies everything that can still change, so a search can play the
+        # copy forward without touching this game. Subclasses keep any extra
+        # attributes they've added.
+        game = copy.copy(self)
+        game.metrics_sink = MetricsSink()
+
+        game.decks = self.decks.copy()
+        future_round = self.round
+        while future_round is not None:
+            if self.decks.is_loaded(future_round):
+                game.decks[future_round] = self.decks[future_round].copy()
+            future_round = future_round.next_round
+
+        game.discard_pile = list(self.discard_pile)
+        game.players = [player.copy(self.round) for player in self.players]
+        game.player_iterator = PlayerIterator(game.players)
+        game.player_iterator.index = self.player_iterator.index
+        return game
 
+    def deal_cards_to_player(self, player):
+        hand = self.deck.draw_cards(self.rules.hand_size)
+        foot = self.deck.draw_cards(self.rules.foot_size)
         player.set_hand_and_foot(hand, foot)
 
     def apply_action(self, action):
+        if not self.metrics_sink.enabled:
+            self.apply_action_without_metrics(action)
+            return
+
+        start_time = time.perf_counter()
+
+        try:
+            self.apply_action_without_metrics(action)
+        except IllegalActionError as e:
+            self.metrics_sink.illegal_action(action.action_type, str(e))
+            raise
+
+        self.metrics_sink.action_applied(action.action_type, time.perf_counter() - start_time)
+
+    def apply_action_without_metrics(self, action):
         if self.round is None:
             raise IllegalActionError("Game is over")
 
@@ -583,26 +1462,10 @@ class Game(object):
         if not self.player_iterator.is_current_player(player):
             raise IllegalActionError("Not your turn")
 
-        if type(action) is DrawFromDeckAction:
-            self.apply_draw_from_deck_action(player)
-        elif type(action) is DrawFromDiscardPileAndAddToBookAction:
-            self.apply_draw_from_discard_pile_and_add_to_book_action(player, action.book_rank)
-        elif type(action) is DrawFromDiscardPileAndStartBookAction:
-            self.apply_draw_from_discard_pile_and_start_book_action(player, action.cards)
-        elif type(action) is DiscardCardAction:
-            self.apply_discard_card_action(player, action.card)
-        elif type(action) is LayDownInitialBooksAction:
-            self.apply_lay_down_initial_books_action(player, action.books)
-        elif type(action) is DrawFromDiscardPileAndLayDownInitialBooksAction:
-            self.apply_draw_from_discard_pile_and_lay_down_initial_books_action(player, action.partial_book, action.books)
-        elif type(action) is StartBookAction:
-            self.apply_start_book_action(player, action.cards)
-        elif type(action) is AddCardsFromHandToBookAction:
-            self.apply_add_cards_from_hand_to_book_action(player, action.cards, action.book_rank)
-        else:
-            raise ValueError("Unknown action type")
+        action.apply(self, player)
 
-        player.calculate_points(self.round)
+        if self.round is not None:
+            player.calculate_points(self.round)
 
     def get_player_named(self, player_name):
         for player in self.players:
@@ -611,6 +1474,24 @@ class Game(object):
 
         return None
 
+    def take_top_of_discard_pile(self):
+        card = self.discard_pile.pop()
+
+        if self.discard_pile_hash is not None:
+            self.discard_pile_hash -= stack_card_key(DISCARD_PILE_PLACE, len(self.discard_pile), card.code)
+
+        return card
+
+    def add_to_discard_pile(self, card):
+        if self.discard_pile_hash is not None:
+            self.discard_pile_hash += stack_card_key(DISCARD_PILE_PLACE, len(self.discard_pile), card.code)
+
+        self.discard_pile.append(card)
+
+    def clear_discard_pile(self):
+        self.discard_pile = []
+        self.discard_pile_hash = 0
+
     def apply_draw_from_deck_action(self, player):
         if not player.can_draw_from_deck:
             raise IllegalActionError("Cannot draw from the deck")
@@ -618,11 +1499,17 @@ class Game(object):
         player.add_card_to_hand_from_deck(self.deck.draw())
 
         if self.deck.is_empty:
-            self.deck.replenish_cards_and_shuffle(self.discard_pile)
-            self.discard_pile = []
+            self.reshuffle_count += 1
+            shuffle_random = random.Random("%s:%d" % (self.shuffle_seed, self.reshuffle_count))
+
+            self.deck.replenish_cards_and_shuffle(self.discard_pile, shuffle_random)
+            self.clear_discard_pile()
 
             if self.deck.is_empty:
+                self.metrics_sink.round_ended_by_empty_deck()
                 self.end_round_with_player_going_out(None)
+            else:
+                self.metrics_sink.deck_reshuffled()
 
     def apply_draw_from_discard_pile_and_add_to_book_action(self, player, book_rank):
         if not player.can_draw_from_discard_pile or not player.has_laid_down_this_round:
@@ -631,7 +1518,7 @@ class Game(object):
         if len(self.discard_pile) == 0:
             raise IllegalActionError("Discard pile is empty")
 
-        card = self.discard_pile.pop()
+        card = self.take_top_of_discard_pile()
         player.add_card_from_discard_pile_to_book(card, book_rank, self.round)
 
     def apply_draw_from_discard_pile_and_start_book_action(self, player, cards):
@@ -641,7 +1528,7 @@ class Game(object):
         if len(self.discard_pile) == 0:
             raise IllegalActionError("Discard pile is empty")
 
-        card = self.discard_pile.pop()
+        card = self.take_top_of_discard_pile()
         cards.append(card)
 
         player.add_card_to_hand_from_discard_pile(card)
@@ -655,7 +1542,7 @@ class Game(object):
             raise IllegalActionError("Cannot end turn yet")
 
         player.remove_card_from_hand(card)
-        self.discard_pile.append(card)
+        self.add_to_discard_pile(card)
 
         if player.is_hand_empty and player.is_in_foot:
             if not player.can_go_out(self.round):
@@ -673,10 +1560,10 @@ class Game(object):
         if player.has_laid_down_this_round:
             raise IllegalActionError("Already laid down this round")
 
-        books = [Book(book_cards) for book_cards in books_cards]
+        books = [Book(book_cards, self.rules) for book_cards in books_cards]
         points_in_books = sum([book.cards_value for book in books])
 
-        if points_in_books < self.round.points_needed:
+        if points_in_books < self.rules.points_needed[self.round]:
             raise IllegalActionError("Not enough points to lay down")
 
         for book_cards in books_cards:
@@ -697,14 +1584,14 @@ class Game(object):
         if len(self.discard_pile) == 0:
             raise IllegalActionError("Discard pile is empty")
 
-        card = self.discard_pile.pop()
+        card = self.take_top_of_discard_pile()
         complete_partial_book = partial_book_cards + [card]
         initial_books_cards = books_cards + [complete_partial_book]
 
-        books = [Book(book_cards) for book_cards in initial_books_cards]
+        books = [Book(book_cards, self.rules) for book_cards in initial_books_cards]
         points_in_books = sum([book.cards_value for book in books])
 
-        if points_in_books < self.round.points_needed:
+        if points_in_books < self.rules.points_needed[self.round]:
             raise IllegalActionError("Not enough points to lay down")
 
         player.add_card_to_hand_from_discard_pile(card)
@@ -736,7 +1623,16 @@ class Game(object):
             player.calculate_points(self.round)
             player.round_ended()
 
-        self.discard_pile = []
+        # A finished round's points can't change anymore, and they're all
+        # that's left of it once new hands are dealt
+        if self.finished_rounds_hash is not None:
+            for (seat, player) in enumerate(self.players):
+                self.finished_rounds_hash += points_hash(seat, self.round, player.points[self.round])
+
+        # Nothing looks at a finished round's deck again
+        self.decks.pop(self.round, None)
+
+        self.clear_discard_pile()
         self.round = self.round.next_round
 
         if self.round is not None:
@@ -750,46 +1646,127 @@ class Game(object):
             "players": [player.to_json() for player in self.players]
         }
 
+    def to_snapshot_json(self):
+        # Everything needed to carry on from here, including the hidden parts
+        # of the game, with cards stored as codes
+        decks_json = {}
+        future_round = self.round
+        while future_round is not None:
+            decks_json[future_round.value] = self.decks[future_round].to_snapshot_json()
+            future_round = future_round.next_round
+
+        return {
+            "rules": self.rules.rule_set.to_json(),
+            "shuffle_seed": self.shuffle_seed,
+            "reshuffle_count": self.reshuffle_count,
+            "round": self.round.value if self.round is not None else None,
+            "decks": decks_json,
+            "discard_pile": cards_to_codes(self.discard_pile),
+            "players": [player.to_snapshot_json() for player in self.players],
+            "current_player_index": self.player_iterator.index
+        }
+
+    @property
+    def state_hash(self):
+        # Covers every card's place and the turn state, which is all the rest
+        # of the game state is worked out from. Each part is kept up to date
+        # as cards move, so reading it only adds them up.
+        if self.discard_pile_hash is None:
+            self.discard_pile_hash = stack_hash(DISCARD_PILE_PLACE, self.discard_pile)
+
+        if self.finished_rounds_hash is None:
+            self.finished_rounds_hash = self.calculate_finished_rounds_hash()
+
+        round_index = 255 if self.round is None else ROUND_INDICES[self.round]
+        state_hash = mix_hash((ROUND_PLACE << 48) | (round_index << 40) | (self.player_iterator.index << 32) | self.reshuffle_count)
+        state_hash += self.discard_pile_hash + self.finished_rounds_hash
+
+        if self.round is not None:
+            state_hash += self.deck.hash
+
+        for (seat, player) in enumerate(self.players):
+            state_hash += (player.hash * SEAT_KEYS[seat]) + TURN_KEYS[seat][player.turn_state]
+
+        return (state_hash & HASH_MASK)
+
+    def calculate_finished_rounds_hash(self):
+        finished_rounds_hash = 0
+
+        for current_round in Round:
+            if current_round == self.round:
+                break
+
+            for (seat, player) in enumerate(self.players):
+                finished_rounds_hash += points_hash(seat, current_round, player.points[current_round])
+
+        return finished_rounds_hash
+
+    def reset_state_hash(self):
+        # For anything that moves cards around without going through the
+        # game, like dealing a guess at the hidden cards
+        self.discard_pile_hash = None
+
+        for player in self.players:
+            player.reset_hash()
+
+        if self.round is not None:
+            self.deck.cards_hash = None
+
 #
 # Engine
 #
 
 class Engine(object):
 
-    def __init__(self, player_names):
+    def __init__(self, player_names, metrics_sink=None):
         self.player_names = player_names
+        self.metrics_sink = metrics_sink
 
     @property
     def current_player(self):
         return self.game.player_iterator.current_player
 
-    def generate_initial_game_state(self):
-        standard_deck_count = len(self.player_names) + 1
+    @property
+    def is_finished(self):
+        return (self.game.round is None)
+
+    def generate_initial_game_state(self, rules=None):
+        if rules is None:
+            rules = DEFAULT_RULES
 
-        decks = {
-            Round.NINETY.value: Deck(standard_deck_count),
-            Round.ONE_TWENTY.value: Deck(standard_deck_count),
-            Round.ONE_FIFTY.value: Deck(standard_deck_count),
-            Round.ONE_EIGHTY.value: Deck(standard_deck_count)
-        }
+        template = standard_deck_codes(rules.standard_deck_count(len(self.player_names)))
 
-        for (current_round, deck) in decks.items():
-            deck.shuffle()
-            decks[current_round] = deck.to_json()
+        # Shuffling the codes and looking up each card's JSON skips building
+        # decks of cards that would only be thrown away
+        decks = {}
+        for current_round in Round:
+            codes = list(template)
+            random.shuffle(codes)
+            decks[current_round.value] = {"cards": [CARD_JSON_BY_CODE[code] for code in codes]}
 
         return {
-            "decks": decks
+            "decks": decks,
+            "rules": rules.to_json(),
+            "shuffle_seed": "%032x" % random.getrandbits(128)
         }
 
     def start_game_with_initial_state(self, initial_state):
-        decks = {
-            Round.NINETY: Deck.from_json(initial_state["decks"][Round.NINETY.value]),
-            Round.ONE_TWENTY: Deck.from_json(initial_state["decks"][Round.ONE_TWENTY.value]),
-            Round.ONE_FIFTY: Deck.from_json(initial_state["decks"][Round.ONE_FIFTY.value]),
-            Round.ONE_EIGHTY: Deck.from_json(initial_state["decks"][Round.ONE_EIGHTY.value])
-        }
+        decks = RoundDecks.from_json(initial_state["decks"])
+
+        # Games created before rules were configurable use the defaults
+        rules_json = initial_state.get("rules")
+        rules = RuleSet.from_json(rules_json) if rules_json is not None else None
+
+        self.game = Game(self.player_names, decks, self.metrics_sink, rules, initial_state.get("shuffle_seed", ""))
 
-        self.game = Game(self.player_names, decks)
+    def start_game_with_snapshot(self, snapshot_json):
+        self.game = Game.from_snapshot_json(snapshot_json, self.metrics_sink)
+
+    def set_metrics_sink(self, metrics_sink):
+        # Replays run without a sink, and it's set just before the actions
+        # that should be counted, so earlier actions aren't counted again
+        self.metrics_sink = metrics_sink
+        self.game.metrics_sink = metrics_sink if metrics_sink is not None else MetricsSink()
 
     def apply_action(self, action_json):
         action = Action.from_json(action_json)
@@ -799,7 +1776,7 @@ class Engine(object):
 # Testing Support
 #
 
-def main(test_case):
+def run_test_case(test_case):
     player_names = test_case["players"]
     actions_json = test_case["actions"]
 
@@ -810,7 +1787,10 @@ def main(test_case):
         Round.ONE_EIGHTY: Deck.from_json(test_case["one_eighty_deck"]),
     }
 
-    game = Game(player_names, decks)
+    rules_json = test_case.get("rules")
+    rules = RuleSet.from_json(rules_json) if rules_json is not None else None
+
+    game = Game(player_names, decks, None, rules)
     actions = [Action.from_json(action_json) for action_json in actions_json]
 
     for i, action in enumerate(actions):
@@ -823,7 +1803,10 @@ def main(test_case):
             sys.stderr.write("Unknown error applying action %d: %s\n" % (i, e))
             break
 
-    final_state_json = game.to_json()
+    return game.to_json()
+
+def main(test_case):
+    final_state_json = run_test_case(test_case)
     print(json.dumps(final_state_json, indent=4))
 
 if __name__ == "__main__":
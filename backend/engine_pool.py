@@ -0,0 +1,164 @@
+import json
+
+import engine
+import solver
+import views
+
+class LoadError(Exception):
+    pass
+
+#
+# Game Logs
+#
+
+# A game log is everything needed to rebuild a game without the database:
+# where to start (the latest snapshot, or the initial state for games that
+# don't have one) and the actions after it, all still as stored text. Logs
+# are plain data, so the replay can happen in another process and the
+# parsing goes with it.
+
+class GameLog(object):
+
+    def __init__(self, player_names, initial_state, snapshot_state, sequence, action_contents):
+        self.player_names = player_names
+        self.initial_state = initial_state
+        self.snapshot_state = snapshot_state
+        self.sequence = sequence
+        self.action_contents = action_contents
+
+    @property
+    def final_sequence(self):
+        return (self.sequence + len(self.action_contents))
+
+def start_engine(game_log):
+    game_engine = engine.Engine(game_log.player_names)
+
+    if game_log.snapshot_state is not None:
+        game_engine.start_game_with_snapshot(json.loads(game_log.snapshot_state))
+    else:
+        game_engine.start_game_with_initial_state(json.loads(game_log.initial_state))
+
+    return game_engine
+
+def replay_game(game_log):
+    game_engine = start_engine(game_log)
+
+    for action_content in game_log.action_contents:
+        game_engine.apply_action(json.loads(action_content))
+
+    return game_engine
+
+#
+# Work
+#
+
+# Everything a request needs from the engine, as functions of a log. The
+# synchronous app calls them directly and the async app runs them in a
+# process pool, so only logs and JSON-ready results cross between processes.
+
+def project_views(game_log, viewer_name, since=None):
+    # Projects the view at `since` on the way past, so the caller can send
+    # just the changes
+    game_engine = start_engine(game_log)
+    engine_game = game_engine.game
+    sequence = game_log.sequence
+    since_view = None
+
+    if since == sequence:
+        since_view = views.project_game(engine_game, viewer_name, sequence)
+
+    for action_content in game_log.action_contents:
+        game_engine.apply_action(json.loads(action_content))
+        sequence += 1
+
+        if sequence == since:
+            since_view = views.project_game(engine_game, viewer_name, sequence)
+
+    return (since_view, views.project_game(engine_game, viewer_name, sequence))
+
+class AppliedAction(object):
+
+    def __init__(self, state_hash, round_ended, current_player_name, finished, round_points=None):
+        self.state_hash = state_hash
+        self.round_ended = round_ended
+        self.current_player_name = current_player_name
+        self.finished = finished
+
+        # Each player's total for the round the action ended, in seat order
+        self.round_points = round_points
+
+def applied_action(game_engine, previous_round):
+    engine_game = game_engine.game
+    round_ended = (engine_game.round != previous_round)
+    round_points = [player.points[previous_round].total for player in engine_game.players] if round_ended else None
+
+    return AppliedAction(engine.state_hash_string(engine_game.state_hash), round_ended, game_engine.current_player.name, game_engine.is_finished, round_points)
+
+def apply_action(game_log, action_json):
+    try:
+        game_engine = replay_game(game_log)
+    except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+        raise LoadError(str(e))
+
+    previous_round = game_engine.game.round
+    game_engine.apply_action(action_json)
+
+    return applied_action(game_engine, previous_round)
+
+class LayDownResult(object):
+
+    def __init__(self, error=None, action_json=None, points=None):
+        self.error = error
+        self.action_json = action_json
+        self.points = points
+
+def find_lay_down(engine_game, player_name, use_discard_pile, goal):
+    if engine_game.round is None:
+        return LayDownResult(error="Game is over")
+
+    player = engine_game.get_player_named(player_name)
+    if player is None:
+        return LayDownResult(error="User is not a part of this game")
+
+    # Only for the player whose turn it is, so nobody gets hints while they
+    # wait
+    if not engine_game.player_iterator.is_current_player(player):
+        return LayDownResult(error="Not your turn")
+
+    discard_pile_top = None
+    if use_discard_pile:
+        if len(engine_game.discard_pile) == 0:
+            return LayDownResult(error="Discard pile is empty")
+
+        discard_pile_top = engine_game.discard_pile[-1]
+
+    lay_down = solver.find_lay_down(player.hand, engine_game.round, discard_pile_top, goal, engine_game.rules)
+
+    if lay_down is None:
+        return LayDownResult()
+    else:
+        return LayDownResult(action_json=lay_down.to_action_json(player.name), points=lay_down.points)
+
+def find_lay_down_in_log(game_log, player_name, use_discard_pile, goal):
+    try:
+        game_engine = replay_game(game_log)
+    except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+        raise LoadError(str(e))
+
+    return find_lay_down(game_engine.game, player_name, use_discard_pile, goal)
+
+#
+# Setup
+#
+
+def create_initial_state(player_names, rules=None):
+    # What a new game is saved with: its initial state, and the snapshot
+    # round one loads from, which stores every deck as card codes instead of
+    # the much larger initial state. Both come back as stored text, so bulk
+    # creation can deal games in a process pool.
+    game_engine = engine.Engine(player_names)
+
+    initial_game_state_json = game_engine.generate_initial_game_state(rules)
+    game_engine.start_game_with_initial_state(initial_game_state_json)
+
+    return (json.dumps(initial_game_state_json), json.dumps(game_engine.game.to_snapshot_json()))
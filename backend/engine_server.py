@@ -0,0 +1,286 @@
+import collections
+import json
+import sys
+
+import engine
+import policies
+import serialization
+import views
+
+#
+# Setup
+#
+
+# A long-running engine for test harnesses, bots and anything else that would
+# otherwise start Python and parse a game from scratch for every question. It
+# reads one JSON request per line on stdin and answers each with one JSON line
+# on stdout, in order:
+#
+#     python3 engine_server.py [<MAX_GAMES>]
+#
+#     > {"id": 1, "command": "new_game", "game": "g1", "players": ["a", "b"]}
+#     < {"action_count":0,"current_player":"a","game":"g1","id":1,"round":"ninety",...,"success":true}
+#     > {"id": 2, "command": "apply_action", "game": "g1", "action": {"type": "draw_from_deck", "player": "a"}}
+#
+# Games are kept in memory by the ID they were created with, and the least
+# recently used are dropped past MAX_GAMES. Responses echo the request's id
+# and are encoded like the app's: sorted keys, no spaces.
+
+DEFAULT_MAX_GAMES = 1000
+
+class ServerError(Exception):
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+#
+# Games
+#
+
+class ServerGame(object):
+
+    # A game and what it was started from, with every action since. An
+    # action that turns out to be illegal can leave the game half applied,
+    # so it's replayed from the start to put it back.
+
+    def __init__(self, player_names, initial_state=None, snapshot=None):
+        self.player_names = player_names
+        self.initial_state = initial_state
+        self.snapshot = snapshot
+        self.actions_json = []
+        self.start()
+
+    def start(self):
+        self.game_engine = engine.Engine(self.player_names)
+
+        if self.snapshot is not None:
+            self.game_engine.start_game_with_snapshot(self.snapshot)
+        else:
+            self.game_engine.start_game_with_initial_state(self.initial_state)
+
+    @property
+    def game(self):
+        return self.game_engine.game
+
+    def apply_action(self, action_json):
+        try:
+            self.game_engine.apply_action(action_json)
+        except Exception:
+            self.start()
+            for previous_action_json in self.actions_json:
+                self.game_engine.apply_action(previous_action_json)
+
+            raise
+
+        self.actions_json.append(action_json)
+
+    def summary_json(self):
+        game = self.game
+
+        return {
+            "action_count": len(self.actions_json),
+            "round": None if game.round is None else game.round.value,
+            "current_player": None if game.round is None else game.player_iterator.current_player.name,
+            "state_hash": engine.state_hash_string(game.state_hash)
+        }
+
+    def player_named(self, player_name):
+        player = self.game.get_player_named(player_name)
+        if player is None:
+            raise ServerError("Unknown player: " + str(player_name))
+
+        return player
+
+#
+# Commands
+#
+
+# Each command takes the request and returns what goes in the response
+# besides its id and success
+
+def new_game(server, request):
+    game_id = require(request, "game")
+    player_names = require(request, "players")
+
+    if (type(player_names) is not list) or (len(player_names) < 2) or (len(player_names) > engine.MAX_PLAYER_COUNT):
+        raise ServerError("Games need between 2 and %d players" % engine.MAX_PLAYER_COUNT)
+
+    # Games without a starting point are dealt here, with the given rules
+    initial_state = request.get("initial_state")
+    snapshot = request.get("snapshot")
+    for (key, value) in (("initial_state", initial_state), ("snapshot", snapshot)):
+        if (value is not None) and (type(value) is not dict):
+            raise ServerError(key.replace("_", " ").capitalize() + " must be an object")
+
+    if (initial_state is None) and (snapshot is None):
+        rules_json = request.get("rules")
+        rules = engine.RuleSet.from_json(rules_json) if rules_json is not None else None
+        initial_state = engine.Engine(player_names).generate_initial_game_state(rules)
+
+    server_game = ServerGame(player_names, initial_state, snapshot)
+    server.add_game(game_id, server_game)
+
+    response_json = server_game.summary_json()
+    response_json["game"] = game_id
+    if request.get("include_initial_state", False):
+        response_json["initial_state"] = server_game.initial_state
+
+    return response_json
+
+def apply_action(server, request):
+    server_game = server.game_for(request)
+
+    # A whole turn or replay can come at once, and stops at the first action
+    # that can't be applied
+    actions_json = request.get("actions")
+    if actions_json is None:
+        actions_json = [require(request, "action")]
+
+    for (i, action_json) in enumerate(actions_json):
+        try:
+            server_game.apply_action(action_json)
+        except engine.IllegalActionError as e:
+            raise ServerError("Illegal action %d: %s" % (i, e))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ServerError("Invalid action %d: %s" % (i, e))
+
+    return server_game.summary_json()
+
+def query_state(server, request):
+    server_game = server.game_for(request)
+    response_json = server_game.summary_json()
+
+    # The full state, or only what one player can see
+    viewer_name = request.get("viewer")
+    if viewer_name is None:
+        response_json["state"] = server_game.game.to_json()
+    else:
+        server_game.player_named(viewer_name)
+        response_json["view"] = views.project_game(server_game.game, viewer_name, len(server_game.actions_json))
+
+    return response_json
+
+def list_legal_actions(server, request):
+    server_game = server.game_for(request)
+    game = server_game.game
+
+    if game.round is None:
+        return {"actions": []}
+
+    player_name = request.get("player", game.player_iterator.current_player.name)
+    player = server_game.player_named(player_name)
+
+    return {"actions": [action.to_json() for action in policies.legal_actions(game, player)]}
+
+def take_snapshot(server, request):
+    server_game = server.game_for(request)
+    response_json = server_game.summary_json()
+    response_json["snapshot"] = server_game.game.to_snapshot_json()
+    return response_json
+
+def drop_game(server, request):
+    game_id = require(request, "game")
+    return {"dropped": server.games.pop(game_id, None) is not None}
+
+def run_test_case(server, request):
+    # The same as running engine.py on the test case, without the process
+    return {"final_state": engine.run_test_case(require(request, "test_case"))}
+
+COMMANDS = {
+    "new_game": new_game,
+    "apply_action": apply_action,
+    "state": query_state,
+    "legal_actions": list_legal_actions,
+    "snapshot": take_snapshot,
+    "drop_game": drop_game,
+    "run_test_case": run_test_case
+}
+
+def require(request, key):
+    value = request.get(key)
+    if value is None:
+        raise ServerError(key.replace("_", " ").capitalize() + " required")
+
+    return value
+
+#
+# Server
+#
+
+class EngineServer(object):
+
+    def __init__(self, max_games=DEFAULT_MAX_GAMES):
+        self.max_games = max_games
+        self.games = collections.OrderedDict()
+        self.encoder = serialization.Encoder()
+
+    def add_game(self, game_id, server_game):
+        self.games.pop(game_id, None)
+        self.games[game_id] = server_game
+
+        while len(self.games) > self.max_games:
+            self.games.popitem(last=False)
+
+    def game_for(self, request):
+        game_id = require(request, "game")
+
+        server_game = self.games.get(game_id)
+        if server_game is None:
+            raise ServerError("Unknown game")
+
+        self.games.move_to_end(game_id)
+        return server_game
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+
+        if type(request) is not dict:
+            return {"id": None, "success": False, "message": "Could not decode request as JSON"}
+
+        response_json = self.handle_request(request)
+        response_json["id"] = request.get("id")
+        return response_json
+
+    def handle_request(self, request):
+        command = COMMANDS.get(request.get("command"))
+        if command is None:
+            return {"success": False, "message": "Unknown command: " + str(request.get("command"))}
+
+        try:
+            response_json = command(self, request)
+        except ServerError as e:
+            return {"success": False, "message": e.message}
+        except engine.IllegalSetupError as e:
+            return {"success": False, "message": "Illegal setup: " + str(e)}
+        except (KeyError, TypeError, ValueError) as e:
+            return {"success": False, "message": "Invalid request: " + str(e)}
+        except Exception as e:
+            # Anything else a malformed starting point or action can raise
+            # deep in the engine. One bad request mustn't end the server and
+            # every game it holds, and a game is put back the way it was
+            # before any action that fails.
+            return {"success": False, "message": "Could not handle request: %s: %s" % (type(e).__name__, e)}
+
+        response_json["success"] = True
+        return response_json
+
+    def serve(self, input_file, output_file):
+        for line in input_file:
+            if not line.strip():
+                continue
+
+            output_file.write(self.encoder.encode(self.handle_line(line)) + b"\n")
+            output_file.flush()
+
+#
+# Main
+#
+
+if __name__ == "__main__":
+    max_games = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MAX_GAMES
+
+    EngineServer(max_games).serve(sys.stdin, sys.stdout.buffer)
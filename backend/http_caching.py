@@ -0,0 +1,120 @@
+import gzip
+import hashlib
+
+import werkzeug.http
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#
+# Content Coding
+#
+
+# Large responses are compressed for clients that accept it. Brotli is used
+# when it's installed and the client takes it, since it's smaller than gzip
+# for about the same time at a low quality. Small responses go out as they
+# are, since compressing them saves less than the headers cost.
+
+def parse_accept_encoding(accept_encoding):
+    # "gzip, deflate;q=0.5, br" as {"gzip": 1.0, "deflate": 0.5, "br": 1.0}
+    qualities = {}
+
+    for item in (accept_encoding or "").split(","):
+        (coding, _, parameters) = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        quality = 1.0
+        (name, _, value) = parameters.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+
+        qualities[coding] = quality
+
+    return qualities
+
+class Compressor(object):
+
+    def __init__(self, min_bytes=1024, gzip_level=6, brotli_quality=4):
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+        self.codings = ["gzip"]
+        if brotli is not None:
+            self.codings.insert(0, "br")
+
+    def negotiate(self, accept_encoding):
+        # The coding the client likes best, preferring ours on a tie, or None
+        # to send the body as it is
+        qualities = parse_accept_encoding(accept_encoding)
+
+        best_coding = None
+        best_quality = 0.0
+        for coding in self.codings:
+            quality = qualities.get(coding, qualities.get("*", 0.0))
+            if quality > best_quality:
+                best_coding = coding
+                best_quality = quality
+
+        return best_coding
+
+    def should_compress(self, body):
+        return len(body) >= self.min_bytes
+
+    def compress(self, body, coding):
+        if coding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        elif coding == "gzip":
+            # No file name or time in the header, so the same body always
+            # compresses to the same bytes
+            return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+        else:
+            raise ValueError("Unknown content coding: " + coding)
+
+#
+# Entity Tags
+#
+
+# Tags are made from the versions of the rows in a response rather than its
+# bytes, so a request can be answered with 304 Not Modified before anything
+# else is loaded or encoded. A compressed response has the coding added to
+# its tag, since it's different bytes, and that is ignored when comparing.
+
+def entity_tag(*versions):
+    digest = hashlib.blake2b(digest_size=16)
+
+    for version in versions:
+        digest.update(repr(version).encode("utf-8"))
+        digest.update(b"\0")
+
+    return '"' + digest.hexdigest() + '"'
+
+def coded_entity_tag(etag, coding):
+    return etag[:-1] + "-" + coding + '"'
+
+def uncoded_entity_tag(etag):
+    (tag, _, coding) = etag.rpartition("-")
+    if tag and (coding in ("gzip", "br")):
+        return tag
+
+    return etag
+
+def entity_tag_matches(if_none_match, etag):
+    # If-None-Match is compared weakly, so a W/ on the client's tags doesn't
+    # matter
+    if not if_none_match:
+        return False
+
+    etags = werkzeug.http.parse_etags(if_none_match)
+    if etags.star_tag:
+        return True
+
+    unquoted_etag = werkzeug.http.unquote_etag(etag)[0]
+    return any(uncoded_entity_tag(client_etag) == unquoted_etag for client_etag in etags.as_set(include_weak=True))
@@ -0,0 +1,115 @@
+import threading
+
+import engine
+
+#
+# Histograms
+#
+
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25]
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for (i, upper_bound) in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+                break
+
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        cumulative_counts = []
+        running_count = 0
+
+        for bucket_count in self.bucket_counts:
+            running_count += bucket_count
+            cumulative_counts.append(running_count)
+
+        return cumulative_counts
+
+#
+# Engine Metrics
+#
+
+class PrometheusMetricsSink(engine.MetricsSink):
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.action_latencies = {}
+        self.illegal_actions = {}
+        self.deck_reshuffles = 0
+        self.rounds_ended_by_empty_deck = 0
+
+    def action_applied(self, action_type, duration):
+        with self.lock:
+            histogram = self.action_latencies.get(action_type)
+            if histogram is None:
+                histogram = Histogram(LATENCY_BUCKETS)
+                self.action_latencies[action_type] = histogram
+
+            histogram.observe(duration)
+
+    def illegal_action(self, action_type, reason):
+        with self.lock:
+            key = (action_type, reason)
+            self.illegal_actions[key] = self.illegal_actions.get(key, 0) + 1
+
+    def deck_reshuffled(self):
+        with self.lock:
+            self.deck_reshuffles += 1
+
+    def round_ended_by_empty_deck(self):
+        with self.lock:
+            self.rounds_ended_by_empty_deck += 1
+
+    def render(self):
+        with self.lock:
+            lines = []
+
+            lines.append("# HELP handandfoot_actions_total Actions applied by the engine, by action type.")
+            lines.append("# TYPE handandfoot_actions_total counter")
+            for (action_type, histogram) in sorted(self.action_latencies.items()):
+                lines.append("handandfoot_actions_total{type=\"%s\"} %d" % (escape_label_value(action_type), histogram.count))
+
+            lines.append("# HELP handandfoot_action_duration_seconds Time spent applying actions, by action type.")
+            lines.append("# TYPE handandfoot_action_duration_seconds histogram")
+            for (action_type, histogram) in sorted(self.action_latencies.items()):
+                label = escape_label_value(action_type)
+
+                for (upper_bound, cumulative_count) in zip(histogram.buckets, histogram.cumulative_counts()):
+                    lines.append("handandfoot_action_duration_seconds_bucket{type=\"%s\",le=\"%g\"} %d" % (label, upper_bound, cumulative_count))
+
+                lines.append("handandfoot_action_duration_seconds_bucket{type=\"%s\",le=\"+Inf\"} %d" % (label, histogram.count))
+                lines.append("handandfoot_action_duration_seconds_sum{type=\"%s\"} %f" % (label, histogram.sum))
+                lines.append("handandfoot_action_duration_seconds_count{type=\"%s\"} %d" % (label, histogram.count))
+
+            lines.append("# HELP handandfoot_illegal_actions_total Actions rejected by the engine, by action type and reason.")
+            lines.append("# TYPE handandfoot_illegal_actions_total counter")
+            for ((action_type, reason), count) in sorted(self.illegal_actions.items()):
+                lines.append("handandfoot_illegal_actions_total{type=\"%s\",reason=\"%s\"} %d" % (escape_label_value(action_type), escape_label_value(reason), count))
+
+            lines.append("# HELP handandfoot_deck_reshuffles_total Times the discard pile was shuffled back into the deck.")
+            lines.append("# TYPE handandfoot_deck_reshuffles_total counter")
+            lines.append("handandfoot_deck_reshuffles_total %d" % self.deck_reshuffles)
+
+            lines.append("# HELP handandfoot_rounds_ended_by_empty_deck_total Rounds that ended because the deck ran out.")
+            lines.append("# TYPE handandfoot_rounds_ended_by_empty_deck_total counter")
+            lines.append("handandfoot_rounds_ended_by_empty_deck_total %d" % self.rounds_ended_by_empty_deck)
+
+            return "\n".join(lines) + "\n"
+
+#
+# Helpers
+#
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
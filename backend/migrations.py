@@ -0,0 +1,87 @@
+import playhouse.migrate
+
+from models import db
+from models import User
+from models import Game
+from models import Action
+
+#
+# Schema Migrations
+#
+
+# create_tables only creates tables that are missing, so columns added to
+# tables that already existed are added here, before the new code serves any
+# requests:
+#
+#     python3 migrations.py
+#
+# Each migration lists the columns and indexes one change added, taken from
+# the models so their types and defaults always match. Anything that's already
+# there is skipped, so running this again, or on a database made by
+# create_tables, does nothing. The README covers filling in data for rows from
+# before each change.
+
+MIGRATIONS = [
+    ("Bot players", [
+        (User, "is_bot"),
+        (User, "bot_policy"),
+        (Game, "finished")
+    ], []),
+    ("Event log", [
+        (Game, "action_count"),
+        (Game, "round_end_sequence"),
+        (Game, "compacted_sequence"),
+        (Game, "archived"),
+        (Action, "sequence"),
+        (Action, "state_hash")
+    ], [
+        (Action, ("game", "sequence"), True)
+    ]),
+    ("Cold storage", [
+        (Game, "cold_archive"),
+        (Game, "in_cold_storage"),
+        (Game, "rehydrated")
+    ], [])
+]
+
+def column_names(model):
+    return set(column.name for column in db.get_columns(model._meta.table_name))
+
+def indexed_column_names(model):
+    return set(tuple(index.columns) for index in db.get_indexes(model._meta.table_name))
+
+def migration_operations(migrator, columns, indexes):
+    operations = []
+
+    for (model, field_name) in columns:
+        field = model._meta.fields[field_name]
+        if field.column_name not in column_names(model):
+            operations.append(migrator.add_column(model._meta.table_name, field.column_name, field))
+
+    # Indexes go after the columns they cover
+    for (model, field_names, unique) in indexes:
+        index_column_names = tuple(model._meta.fields[field_name].column_name for field_name in field_names)
+        if index_column_names not in indexed_column_names(model):
+            operations.append(migrator.add_index(model._meta.table_name, index_column_names, unique))
+
+    return operations
+
+def migrate(log=print):
+    migrator = playhouse.migrate.SchemaMigrator.from_database(db)
+
+    for (name, columns, indexes) in MIGRATIONS:
+        operations = migration_operations(migrator, columns, indexes)
+        if len(operations) == 0:
+            continue
+
+        log("Migrating: %s (%d changes)" % (name, len(operations)))
+        with db.atomic():
+            playhouse.migrate.migrate(*operations)
+
+#
+# Main
+#
+
+if __name__ == "__main__":
+    with db.connection_context():
+        migrate()
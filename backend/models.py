@@ -1,6 +1,8 @@
 import datetime
 import enum
 import json
+import secrets
+import zlib
 
 import flask_login
 import itsdangerous
@@ -8,6 +10,7 @@ import peewee
 import werkzeug
 
 import engine
+import engine_pool
 import sekrits
 
 db = peewee.MySQLDatabase(
@@ -18,6 +21,10 @@ db = peewee.MySQLDatabase(
     charset="utf8mb4" # Enable unicode
 )
 
+# Rows per statement for multi-row inserts. An initial state is around 40KB,
+# so even a batch of games stays within a few megabytes.
+INSERT_BATCH_SIZE = 100
+
 class UserRole(enum.Enum):
     OWNER = "owner"
     PLAYER = "player"
@@ -33,6 +40,8 @@ class User(BaseModel, flask_login.UserMixin):
     password_hash = peewee.CharField()
     created = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
     last_updated = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    is_bot = peewee.BooleanField(default=False)
+    bot_policy = peewee.CharField(null=True)
 
     @staticmethod
     def login(email, password):
@@ -51,6 +60,16 @@ class User(BaseModel, flask_login.UserMixin):
         password_hash = werkzeug.security.generate_password_hash(password)
         user = User(email=email, first_name=first_name, last_name=last_name, password_hash=password_hash)
         user.save()
+        UserSearchTerm.index_users([user])
+        return user
+
+    @staticmethod
+    def create_bot(email, first_name, last_name, bot_policy):
+        # Bots never log in, so they get a password nobody knows
+        password_hash = werkzeug.security.generate_password_hash(secrets.token_hex(32))
+        user = User(email=email, first_name=first_name, last_name=last_name, password_hash=password_hash, is_bot=True, bot_policy=bot_policy)
+        user.save()
+        UserSearchTerm.index_users([user])
         return user
 
     def check_password(self, password):
@@ -83,30 +102,168 @@ class User(BaseModel, flask_login.UserMixin):
             "first_name": self.first_name,
             "last_name": self.last_name,
             "email": self.email,
+            "is_bot": self.is_bot,
             "created": self.created,
             "last_updated": self.last_updated
         }
 
+#
+# User Search
+#
+
+# Users are found by the start of any word of their name. "John Smith" is
+# stored under "john smith" and "smith", so a search is one range scan of the
+# term index however many users there are, and matches come back in index
+# order: whole words first, since they're the shortest, then alphabetically.
+
+MAX_SEARCH_TERM_LENGTH = 191
+
+def search_normal_form(text):
+    return " ".join(text.casefold().split())[:MAX_SEARCH_TERM_LENGTH]
+
+class UserSearchTerm(BaseModel):
+    term = peewee.CharField(max_length=MAX_SEARCH_TERM_LENGTH)
+    user = peewee.ForeignKeyField(User, lazy_load=False)
+
+    class Meta:
+        indexes = (
+            (("term", "user"), True),
+        )
+
+    @staticmethod
+    def terms_for_user(user):
+        words = search_normal_form(user.first_name + " " + user.last_name).split(" ")
+        return set([" ".join(words[i:]) for i in range(0, len(words)) if len(words[i]) > 0])
+
+    @staticmethod
+    def index_users(users):
+        users = list(users)
+        term_rows = [{"term": term, "user": user.id} for user in users for term in UserSearchTerm.terms_for_user(user)]
+
+        with db.atomic():
+            UserSearchTerm.delete().where(UserSearchTerm.user.in_([user.id for user in users])).execute()
+
+            for rows in peewee.chunked(term_rows, INSERT_BATCH_SIZE * 10):
+                UserSearchTerm.insert_many(rows).execute()
+
+    @staticmethod
+    def index_all_users(batch_size=1000):
+        # Fills in the index for users created before it existed
+        for users in peewee.chunked(User.select().order_by(User.id).iterator(), batch_size):
+            UserSearchTerm.index_users(users)
+
+    @staticmethod
+    def search(search_term, excluded_user_id=None, offset=0, count=25):
+        prefix = search_normal_form(search_term)
+        if len(prefix) == 0:
+            return []
+
+        # LIKE with the wildcards in the prefix escaped, which uses the index
+        # under any collation, unlike a range on the next string up
+        query = UserSearchTerm.select(UserSearchTerm.user).where(UserSearchTerm.term.startswith(prefix))
+        if excluded_user_id is not None:
+            query = query.where(UserSearchTerm.user != excluded_user_id)
+
+        # A name with a repeated word can match more than once, so only each
+        # user's first match counts. That's filtered before the offset, so
+        # pages are full and no user is on two of them.
+        EarlierTerm = UserSearchTerm.alias()
+        earlier_match = EarlierTerm.select().where(
+            (EarlierTerm.user == UserSearchTerm.user) &
+            EarlierTerm.term.startswith(prefix) &
+            ((EarlierTerm.term < UserSearchTerm.term) | ((EarlierTerm.term == UserSearchTerm.term) & (EarlierTerm.id < UserSearchTerm.id))))
+        query = query.where(~peewee.fn.EXISTS(earlier_match))
+
+        user_ids = [row.user_id for row in query.order_by(UserSearchTerm.term, UserSearchTerm.user).offset(offset).limit(count)]
+        users = {user.id: user for user in User.select().where(User.id.in_(user_ids))}
+
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+class ActionRejectedError(Exception):
+    pass
+
+class ActionConflictError(ActionRejectedError):
+    # Another action took the next sequence number first, so the same action
+    # may well go through against the game as it is now
+    pass
+
 class Game(BaseModel):
     initial_state = peewee.TextField()
     title = peewee.CharField()
     current_user = peewee.ForeignKeyField(User, lazy_load=False)
+    finished = peewee.BooleanField(default=False)
     created = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
     last_updated = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
 
+    # Event log bookkeeping: how many actions have been appended, the sequence
+    # number of the action that last ended a round, how far snapshots go, and
+    # whether the log has been moved into a GameArchive
+    action_count = peewee.IntegerField(default=0)
+    round_end_sequence = peewee.IntegerField(default=0)
+    compacted_sequence = peewee.IntegerField(default=0)
+    archived = peewee.BooleanField(default=False)
+
+    # Cold storage: the archive file holding the game's record, whether the
+    # hot rows have been replaced by this stub, and when it was last put back
+    cold_archive = peewee.CharField(null=True)
+    in_cold_storage = peewee.BooleanField(default=False)
+    rehydrated = peewee.DateTimeField(null=True)
+
     @staticmethod
-    def create(title, users):
+    def create(title, users, rules=None):
         player_names = [user.email for user in users]
-        game_engine = engine.Engine(player_names)
-
-        initial_game_state_json = game_engine.generate_initial_game_state()
-        initial_game_state_string = json.dumps(initial_game_state_json)
+        (initial_game_state_string, snapshot_state) = engine_pool.create_initial_state(player_names, rules)
 
         game = Game(title=title, initial_state=initial_game_state_string, current_user=users[0])
         game.save()
 
+        # Round one loads from this snapshot instead of the initial state
+        GameSnapshot(game=game, sequence=0, state=snapshot_state).save()
+
         return game
 
+    @staticmethod
+    def create_many(game_setups, all_accepted=False):
+        # Each setup is (title, users, initial state, snapshot state), with
+        # the owner first in users. Everything goes in one transaction, with
+        # invitations and snapshots inserted a batch at a time.
+        now = datetime.datetime.now(datetime.timezone.utc)
+        game_rows = [{
+            "title": title,
+            "initial_state": initial_game_state_string,
+            "current_user": users[0].id,
+            "created": now,
+            "last_updated": now
+        } for (title, users, initial_game_state_string, snapshot_state) in game_setups]
+
+        with db.atomic():
+            if db.returning_clause:
+                game_ids = []
+                for rows in peewee.chunked(game_rows, INSERT_BATCH_SIZE):
+                    game_ids += [row[0] for row in Game.insert_many(rows).returning(Game.id).tuples().execute()]
+            else:
+                # Without RETURNING, the IDs of a multi-row insert aren't
+                # guaranteed to be consecutive, so games go in one at a time
+                game_ids = [Game.insert(row).execute() for row in game_rows]
+
+            usergame_rows = []
+            snapshot_rows = []
+
+            for (game_id, (title, users, initial_game_state_string, snapshot_state)) in zip(game_ids, game_setups):
+                for (i, user) in enumerate(users):
+                    role = UserRole.OWNER if i == 0 else UserRole.PLAYER
+                    usergame_rows.append({"user": user.id, "game": game_id, "role": role.value, "user_accepted": all_accepted or (role == UserRole.OWNER) or user.is_bot})
+
+                snapshot_rows.append({"game": game_id, "sequence": 0, "state": snapshot_state})
+
+            for rows in peewee.chunked(usergame_rows, INSERT_BATCH_SIZE):
+                UserGame.insert_many(rows).execute()
+
+            for rows in peewee.chunked(snapshot_rows, INSERT_BATCH_SIZE):
+                GameSnapshot.insert_many(rows).execute()
+
+        return game_ids
+
     @property
     def usergames(self):
         return UserGame.select().where(UserGame.game == self.id).order_by(UserGame.id)
@@ -115,24 +272,123 @@ class Game(BaseModel):
     def have_all_players_accepted_invite(self):
         return (len([usergame for usergame in self.usergames if not usergame.user_accepted]) == 0)
 
+    @property
+    def player_names(self):
+        return [usergame.fetch_user().email for usergame in self.usergames]
+
     def load_initial_state(self):
-        player_names = [usergame.fetch_user().email for usergame in self.usergames]
-        self.game_engine = engine.Engine(player_names)
+        self.game_engine = engine.Engine(self.player_names)
 
         initial_game_state_json = json.loads(self.initial_state)
         self.game_engine.start_game_with_initial_state(initial_game_state_json)
+        self.sequence = 0
 
-    def load_actions(self):
-        actions = Action.select().where(Action.game == self).order_by(Action.created)
+    @property
+    def actions(self):
+        # Actions saved before sequence numbers existed sort first, in the
+        # order they were created
+        return Action.select().where(Action.game == self).order_by(Action.sequence, Action.created)
 
-        for action in actions:
+    def actions_after(self, sequence):
+        return Action.select().where((Action.game == self) & (Action.sequence > sequence)).order_by(Action.sequence)
+
+    def load_actions(self):
+        for action in self.actions:
             self.apply_action(action)
 
+    @property
+    def latest_snapshot(self):
+        return GameSnapshot.select().where(GameSnapshot.game == self).order_by(GameSnapshot.sequence.desc()).first()
+
+    def load_log(self, since=None):
+        # Starts from the latest snapshot, so only the actions in the current
+        # round are read and replayed. Views from before the latest snapshot
+        # can't be diffed against, so asking for one starts from the top.
+        snapshot = self.latest_snapshot
+
+        if (snapshot is None) or ((since is not None) and (since < snapshot.sequence) and not self.archived):
+            action_contents = [action.content for action in self.actions]
+            return engine_pool.GameLog(self.player_names, self.initial_state, None, 0, action_contents)
+
+        action_contents = [action.content for action in self.actions_after(snapshot.sequence)]
+        return engine_pool.GameLog(self.player_names, None, snapshot.state, snapshot.sequence, action_contents)
+
+    def load_state(self):
+        game_log = self.load_log()
+        self.game_engine = engine_pool.replay_game(game_log)
+        self.sequence = game_log.final_sequence
+
+    def load_views(self, viewer_name, since=None):
+        return engine_pool.project_views(self.load_log(since), viewer_name, since)
+
     def apply_action(self, action):
         self.game_engine.apply_action(action.load_content_json())
+        self.sequence += 1
+
+    def check_action_for_user(self, user, action_json):
+        # Every action, whether it comes from the API or a bot, goes through
+        # the same checks before it's applied
+        if not self.have_all_players_accepted_invite:
+            raise ActionRejectedError("Players have not all accepted invites yet")
+
+        action = Action.create_without_saving(action_json, self)
+
+        if not action.content_has_player:
+            raise ActionRejectedError("Invalid action")
+
+        if not action.is_for_player(user.email):
+            raise ActionRejectedError("Cannot play for another player")
+
+        return action
+
+    def add_action_for_user(self, user, action_json, metrics_sink=None):
+        action = self.check_action_for_user(user, action_json)
+
+        try:
+            self.load_state()
+        except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+            raise ActionRejectedError("Error loading game: " + str(e))
+
+        # Only the new action goes into the metrics, not the replay before it
+        self.game_engine.set_metrics_sink(metrics_sink)
+
+        previous_round = self.game_engine.game.round
+
+        try:
+            self.apply_action(action)
+        except (engine.IllegalActionError, engine.IllegalSetupError) as e:
+            raise ActionRejectedError("Error applying new action: " + str(e))
+
+        return self.append_action(action, engine_pool.applied_action(self.game_engine, previous_round))
+
+    def append_action(self, action, applied_action):
+        # The log is append-only: every action gets the next sequence number
+        # and a hash of the state it left the game in
+        action.sequence = self.action_count + 1
+        action.state_hash = applied_action.state_hash
+        self.action_count = action.sequence
+
+        if applied_action.round_ended:
+            self.round_end_sequence = action.sequence
 
-    def update_current_user(self):
-        current_user_email = self.game_engine.current_player.name
+        self.update_current_user(applied_action.current_player_name)
+        self.finished = applied_action.finished
+        self.last_updated = datetime.datetime.now(datetime.timezone.utc)
+
+        try:
+            with db.atomic():
+                action.save()
+                self.save()
+
+                if applied_action.round_ended:
+                    TournamentTable.record_round(self, applied_action)
+        except peewee.IntegrityError:
+            # Someone else took this sequence number first
+            raise ActionConflictError("Game changed while applying the action, try again")
+
+        return action
+
+    def update_current_user(self, current_user_email):
         current_user = User.get_or_none(User.email == current_user_email)
         if current_user is None:
             raise ValueError("Something went terribly wrong")
@@ -145,6 +401,7 @@ class Game(BaseModel):
             "initial_state": self.initial_state,
             "title": self.title,
             "current_user": self.current_user_id,
+            "finished": self.finished,
             "created": self.created,
             "last_updated": self.last_updated
         }
@@ -159,7 +416,7 @@ class UserGame(BaseModel):
     def create(user, game, role):
         usergame = UserGame(user=user, game=game, role=role.value)
 
-        if role == UserRole.OWNER:
+        if (role == UserRole.OWNER) or user.is_bot:
             usergame.user_accepted = True
 
         usergame.save()
@@ -181,6 +438,13 @@ class Action(BaseModel):
     content = peewee.TextField()
     game = peewee.ForeignKeyField(Game, lazy_load=False)
     created = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    sequence = peewee.IntegerField(null=True)
+    state_hash = peewee.CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (("game", "sequence"), True),
+        )
 
     @staticmethod
     def create_without_saving(content_json, game):
@@ -211,3 +475,175 @@ class Action(BaseModel):
             "game": self.game_id,
             "created": self.created
         }
+
+class GameSnapshot(BaseModel):
+    game = peewee.ForeignKeyField(Game, lazy_load=False)
+    sequence = peewee.IntegerField()
+    state = peewee.TextField()
+    created = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
+
+    class Meta:
+        indexes = (
+            (("game", "sequence"), True),
+        )
+
+class GameArchive(BaseModel):
+    game = peewee.ForeignKeyField(Game, lazy_load=False, unique=True)
+    action_count = peewee.IntegerField()
+    actions = peewee.BlobField()
+    created = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
+
+    @staticmethod
+    def create_for_game(game, actions):
+        actions_json = [[action.id, action.sequence, action.state_hash, str(action.created), action.content] for action in actions]
+        return GameArchive.create_from_json(game, actions_json)
+
+    @staticmethod
+    def create_from_json(game, actions_json):
+        blob = zlib.compress(json.dumps(actions_json, separators=(",", ":")).encode("utf-8"), 9)
+
+        archive = GameArchive(game=game, action_count=len(actions_json), actions=blob)
+        archive.save()
+        return archive
+
+    @staticmethod
+    def actions_from_json(game_id, actions_json):
+        actions = []
+
+        for (action_id, sequence, state_hash, created, content) in actions_json:
+            created = datetime.datetime.fromisoformat(created)
+            actions.append(Action(id=action_id, game=game_id, sequence=sequence, state_hash=state_hash, created=created, content=content))
+
+        return actions
+
+    def load_actions_json(self):
+        return json.loads(zlib.decompress(self.actions).decode("utf-8"))
+
+    def load_actions(self):
+        return GameArchive.actions_from_json(self.game_id, self.load_actions_json())
+
+#
+# Tournaments
+#
+
+# A tournament seats its entrants at tables of 2-6 each round, with a game at
+# every table. As each round of a game ends its points are added to the
+# entrants who played it, and every change stamps those entrants with the
+# tournament's next standings version, so anything holding older standings
+# can catch up by reading just the entrants that changed.
+
+class Tournament(BaseModel):
+    title = peewee.CharField()
+    owner = peewee.ForeignKeyField(User, lazy_load=False)
+    table_size = peewee.IntegerField(default=4)
+    round_count = peewee.IntegerField()
+    rules = peewee.TextField(null=True)
+    current_round = peewee.IntegerField(default=0)
+    tables_remaining = peewee.IntegerField(default=0)
+    finished = peewee.BooleanField(default=False)
+    standings_version = peewee.IntegerField(default=0)
+    created = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    last_updated = peewee.DateTimeField(default=lambda: datetime.datetime.now(datetime.timezone.utc))
+
+    class Meta:
+        indexes = (
+            (("finished", "tables_remaining"), False),
+        )
+
+    @staticmethod
+    def create(title, owner, users, table_size, round_count, rules=None):
+        with db.atomic():
+            tournament = Tournament(title=title, owner=owner, table_size=table_size, round_count=round_count)
+            if rules is not None:
+                tournament.rules = json.dumps(rules.to_json())
+
+            tournament.save()
+
+            entrant_rows = [{"tournament": tournament.id, "user": user.id} for user in users]
+            for rows in peewee.chunked(entrant_rows, INSERT_BATCH_SIZE):
+                TournamentEntrant.insert_many(rows).execute()
+
+        return tournament
+
+    @property
+    def is_ready_to_advance(self):
+        # Before the first round, or once every table of the current one is
+        # finished
+        return (not self.finished) and (self.tables_remaining == 0)
+
+    def load_rules(self):
+        if self.rules is None:
+            return None
+
+        return engine.RuleSet.from_json(json.loads(self.rules))
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "owner": self.owner_id,
+            "table_size": self.table_size,
+            "round_count": self.round_count,
+            "current_round": self.current_round,
+            "tables_remaining": self.tables_remaining,
+            "finished": self.finished,
+            "created": self.created,
+            "last_updated": self.last_updated
+        }
+
+class TournamentEntrant(BaseModel):
+    tournament = peewee.ForeignKeyField(Tournament, lazy_load=False)
+    user = peewee.ForeignKeyField(User, lazy_load=False)
+    points = peewee.IntegerField(default=0)
+    games_finished = peewee.IntegerField(default=0)
+    current_game = peewee.ForeignKeyField(Game, null=True, lazy_load=False)
+    standings_version = peewee.IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (("tournament", "user"), True),
+            (("tournament", "standings_version"), False),
+        )
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "tournament": self.tournament_id,
+            "user": self.user_id,
+            "points": self.points,
+            "games_finished": self.games_finished,
+            "current_game": self.current_game_id
+        }
+
+class TournamentTable(BaseModel):
+    tournament = peewee.ForeignKeyField(Tournament, lazy_load=False)
+    round = peewee.IntegerField()
+    game = peewee.ForeignKeyField(Game, lazy_load=False, unique=True)
+    finished = peewee.BooleanField(default=False)
+
+    @staticmethod
+    def record_round(game, applied_action):
+        # Runs in the transaction that saves the action, so the points land
+        # exactly once, with the action
+        table = TournamentTable.get_or_none(TournamentTable.game == game.id)
+        if (table is None) or (applied_action.round_points is None):
+            return
+
+        # Bumping the version locks the tournament row until the action is
+        # committed, so versions are committed in order
+        Tournament.update(standings_version=Tournament.standings_version + 1).where(Tournament.id == table.tournament_id).execute()
+        standings_version = Tournament.select(Tournament.standings_version).where(Tournament.id == table.tournament_id).scalar()
+
+        user_ids = [usergame.user_id for usergame in game.usergames]
+        games_finished = 1 if applied_action.finished else 0
+
+        for (user_id, round_points) in zip(user_ids, applied_action.round_points):
+            TournamentEntrant.update({
+                TournamentEntrant.points: TournamentEntrant.points + round_points,
+                TournamentEntrant.games_finished: TournamentEntrant.games_finished + games_finished,
+                TournamentEntrant.standings_version: standings_version
+            }).where((TournamentEntrant.tournament == table.tournament_id) & (TournamentEntrant.user == user_id)).execute()
+
+        if applied_action.finished:
+            TournamentTable.update(finished=True).where(TournamentTable.id == table.id).execute()
+            Tournament.update(tables_remaining=Tournament.tables_remaining - 1, last_updated=datetime.datetime.now(datetime.timezone.utc)).where(Tournament.id == table.tournament_id).execute()
@@ -0,0 +1,362 @@
+import abc
+import time
+
+import determinization
+import engine
+import solver
+
+#
+# Helpers
+#
+
+def top_of_discard_pile(game):
+    if len(game.discard_pile) == 0:
+        return None
+
+    return game.discard_pile[-1]
+
+def can_add_card_to_book(book, card):
+    if card.is_wild:
+        return book.can_add_wild_card
+    else:
+        return (card.rank == book.rank)
+
+def naturals_by_rank(cards):
+    naturals = {}
+
+    for card in cards:
+        if card.can_start_book:
+            naturals.setdefault(card.rank, []).append(card)
+
+    return naturals
+
+def can_spare_cards(player, current_round, card_count, book=None):
+    # Once a player is in their foot they need a card left to discard, and
+    # they can only discard their last card if they're allowed to go out.
+    # Putting a wild into their only natural book takes that away.
+    cards_left = len(player.hand) - card_count
+
+    if not player.is_in_foot:
+        return (cards_left >= 0)
+    elif player.can_go_out(current_round) and not breaks_only_natural_book(player, current_round, book):
+        return (cards_left >= 1)
+    else:
+        return (cards_left >= 2)
+
+def breaks_only_natural_book(player, current_round, book):
+    if (book is None) or not book.is_natural:
+        return False
+
+    return (len([other_book for other_book in player.books[current_round].values() if other_book.is_natural]) == 1)
+
+def is_legal_discard(player, current_round, card):
+    if not player.can_end_turn:
+        return False
+
+    if (len(player.hand) == 1) and player.is_in_foot:
+        return player.can_go_out(current_round)
+
+    return True
+
+def next_player(game, player):
+    player_index = game.players.index(player)
+    return game.players[(player_index + 1) % len(game.players)]
+
+#
+# Legal Actions
+#
+
+def legal_actions(game, player):
+    if (game.round is None) or not game.player_iterator.is_current_player(player):
+        return []
+
+    current_round = game.round
+    books = player.books[current_round]
+    top_card = top_of_discard_pile(game)
+    actions = []
+
+    if player.can_draw_from_deck:
+        actions.append(engine.DrawFromDeckAction(player.name))
+
+    if (top_card is not None) and player.can_draw_from_discard_pile:
+        if player.has_laid_down_this_round:
+            for (book_rank, book) in books.items():
+                if can_add_card_to_book(book, top_card):
+                    actions.append(engine.DrawFromDiscardPileAndAddToBookAction(player.name, book_rank))
+
+            if top_card.can_start_book and (top_card.rank not in books):
+                matching_naturals = [card for card in player.hand if card.rank == top_card.rank]
+                hand_card_count = game.rules.minimum_book_size - 1
+                if (len(matching_naturals) >= hand_card_count) and can_spare_cards(player, current_round, hand_card_count):
+                    actions.append(engine.DrawFromDiscardPileAndStartBookAction(player.name, matching_naturals[:hand_card_count]))
+        else:
+            lay_down = solver.find_lay_down(player.hand, current_round, top_card, rules=game.rules)
+            if (lay_down is not None) and can_spare_cards(player, current_round, lay_down.card_count - 1):
+                actions.append(lay_down.to_action(player.name))
+
+    if not player.has_laid_down_this_round:
+        for goal in solver.LayDownGoal:
+            lay_down = solver.find_lay_down(player.hand, current_round, None, goal, game.rules)
+            if (lay_down is not None) and can_spare_cards(player, current_round, lay_down.card_count):
+                actions.append(lay_down.to_action(player.name))
+    else:
+        for (rank, cards) in naturals_by_rank(player.hand).items():
+            if rank in books:
+                if can_spare_cards(player, current_round, len(cards)):
+                    actions.append(engine.AddCardsFromHandToBookAction(player.name, cards, rank))
+            elif len(cards) >= game.rules.minimum_book_size:
+                if can_spare_cards(player, current_round, len(cards)):
+                    actions.append(engine.StartBookAction(player.name, cards))
+
+        wilds = [card for card in player.hand if card.is_wild]
+        if len(wilds) > 0:
+            for (book_rank, book) in books.items():
+                if can_add_card_to_book(book, wilds[0]) and can_spare_cards(player, current_round, 1, book):
+                    actions.append(engine.AddCardsFromHandToBookAction(player.name, [wilds[0]], book_rank))
+
+    discarded_cards = []
+    for card in player.hand:
+        if (card not in discarded_cards) and is_legal_discard(player, current_round, card):
+            discarded_cards.append(card)
+            actions.append(engine.DiscardCardAction(player.name, card))
+
+    return actions
+
+#
+# Policies
+#
+
+class Policy(abc.ABC):
+
+    @abc.abstractmethod
+    def choose_action(self, game, player):
+        pass
+
+class GreedyPolicy(Policy):
+    lay_down_goal = solver.LayDownGoal.MOST_POINTS
+
+    def choose_action(self, game, player):
+        if game.round is None:
+            return None
+
+        if player.can_draw_from_deck:
+            action = self.choose_draw_from_discard_pile(game, player)
+            if action is not None:
+                return action
+
+            return engine.DrawFromDeckAction(player.name)
+
+        action = self.choose_meld(game, player)
+        if action is not None:
+            return action
+
+        return self.choose_discard(game, player)
+
+    def choose_draw_from_discard_pile(self, game, player):
+        current_round = game.round
+        top_card = top_of_discard_pile(game)
+
+        if (top_card is None) or not player.can_draw_from_discard_pile:
+            return None
+
+        if not player.has_laid_down_this_round:
+            lay_down = solver.find_lay_down(player.hand, current_round, top_card, self.lay_down_goal, game.rules)
+            if (lay_down is None) or not can_spare_cards(player, current_round, lay_down.card_count - 1):
+                return None
+
+            return lay_down.to_action(player.name)
+
+        books = player.books[current_round]
+
+        if top_card.can_start_book:
+            if top_card.rank in books:
+                return engine.DrawFromDiscardPileAndAddToBookAction(player.name, top_card.rank)
+
+            matching_naturals = [card for card in player.hand if card.rank == top_card.rank]
+            hand_card_count = game.rules.minimum_book_size - 1
+            if (len(matching_naturals) >= hand_card_count) and can_spare_cards(player, current_round, hand_card_count):
+                return engine.DrawFromDiscardPileAndStartBookAction(player.name, matching_naturals[:hand_card_count])
+        elif top_card.is_wild:
+            book = self.choose_book_for_wild(player, current_round, top_card)
+            if book is not None:
+                return engine.DrawFromDiscardPileAndAddToBookAction(player.name, book.rank)
+
+        return None
+
+    def choose_meld(self, game, player):
+        current_round = game.round
+
+        if not player.has_laid_down_this_round:
+            lay_down = solver.find_lay_down(player.hand, current_round, None, self.lay_down_goal, game.rules)
+            if (lay_down is not None) and can_spare_cards(player, current_round, lay_down.card_count):
+                return lay_down.to_action(player.name)
+
+            return None
+
+        books = player.books[current_round]
+
+        for (rank, cards) in naturals_by_rank(player.hand).items():
+            if (rank in books) or (len(cards) >= game.rules.minimum_book_size):
+                if not can_spare_cards(player, current_round, len(cards)):
+                    continue
+
+                if rank in books:
+                    return engine.AddCardsFromHandToBookAction(player.name, cards, rank)
+                else:
+                    return engine.StartBookAction(player.name, cards)
+
+        for card in player.hand:
+            if not card.is_wild:
+                continue
+
+            book = self.choose_book_for_wild(player, current_round, card)
+            if (book is not None) and can_spare_cards(player, current_round, 1, book):
+                return engine.AddCardsFromHandToBookAction(player.name, [card], book.rank)
+
+        return None
+
+    def choose_book_for_wild(self, player, current_round, card):
+        books = [book for book in player.books[current_round].values() if not book.is_complete and can_add_card_to_book(book, card)]
+        if len(books) == 0:
+            return None
+
+        return max(books, key=lambda book: book.card_count)
+
+    def choose_discard(self, game, player):
+        candidates = [card for card in player.hand if is_legal_discard(player, game.round, card)]
+        if len(candidates) == 0:
+            return None
+
+        return engine.DiscardCardAction(player.name, min(candidates, key=lambda card: self.keep_score(game, player, card)))
+
+    def keep_score(self, game, player, card):
+        if card.rank == engine.CardRank.THREE:
+            return card.point_value
+
+        if card.is_wild:
+            return 1000 + card.point_value
+
+        matching_count = len([hand_card for hand_card in player.hand if hand_card.rank == card.rank])
+        return (matching_count * 100) - card.point_value
+
+class HeuristicPolicy(GreedyPolicy):
+    lay_down_goal = solver.LayDownGoal.FEWEST_CARDS
+
+    def choose_book_for_wild(self, player, current_round, card):
+        # Hold on to wilds unless they finish a book
+        books = [book for book in player.books[current_round].values() if not book.is_complete and can_add_card_to_book(book, card)]
+        books = [book for book in books if book.card_count >= (book.rules.complete_book_size - 1)]
+        if len(books) == 0:
+            return None
+
+        return max(books, key=lambda book: book.card_count)
+
+    def keep_score(self, game, player, card):
+        keep_score = super().keep_score(game, player, card)
+
+        if card.rank == engine.CardRank.THREE:
+            return keep_score
+
+        # Don't hand the next player a card they can put straight into a book
+        following_player = next_player(game, player)
+        if card.rank in following_player.books[game.round]:
+            keep_score += 500
+
+        # Cards that already have a book are cheap to play later
+        if card.rank in player.books[game.round]:
+            keep_score += 200
+
+        return keep_score
+
+class MonteCarloPolicy(HeuristicPolicy):
+
+    def __init__(self, time_budget=0.04, rollout_turns=4, max_rollouts=400, rollout_policy=None):
+        self.time_budget = time_budget
+        self.rollout_turns = rollout_turns
+        self.max_rollouts = max_rollouts
+        self.rollout_policy = rollout_policy if rollout_policy is not None else GreedyPolicy()
+
+    def choose_discard(self, game, player):
+        candidates = []
+        for card in player.hand:
+            if (card not in candidates) and is_legal_discard(player, game.round, card):
+                candidates.append(card)
+
+        if len(candidates) <= 1:
+            return super().choose_discard(game, player)
+
+        deadline = time.perf_counter() + self.time_budget
+        determinizer = determinization.Determinizer(game, player.name)
+        totals = [0.0] * len(candidates)
+        rollout_counts = [0] * len(candidates)
+        rollout_count = 0
+
+        while (rollout_count < self.max_rollouts) and (time.perf_counter() < deadline):
+            candidate_index = rollout_count % len(candidates)
+            totals[candidate_index] += self.rollout(determinizer, player, candidates[candidate_index])
+            rollout_counts[candidate_index] += 1
+            rollout_count += 1
+
+        if rollout_count < len(candidates):
+            return super().choose_discard(game, player)
+
+        best_index = max(range(0, len(candidates)), key=lambda i: totals[i] / rollout_counts[i])
+        return engine.DiscardCardAction(player.name, candidates[best_index])
+
+    def rollout(self, determinizer, player, card):
+        # Every rollout plays out in a different guess at the cards the
+        # player can't see
+        sampled_game = determinizer.sample()
+        sampled_player = sampled_game.get_player_named(player.name)
+        current_round = sampled_game.round
+
+        try:
+            sampled_game.apply_action(engine.DiscardCardAction(player.name, card))
+
+            turns_left = self.rollout_turns
+            while (turns_left > 0) and (sampled_game.round == current_round):
+                rollout_player = sampled_game.player_iterator.current_player
+                action = self.rollout_policy.choose_action(sampled_game, rollout_player)
+                if action is None:
+                    break
+
+                sampled_game.apply_action(action)
+
+                if type(action) is engine.DiscardCardAction:
+                    turns_left -= 1
+        except engine.IllegalActionError:
+            pass
+
+        return evaluate(sampled_game, sampled_player, current_round)
+
+def evaluate(game, player, current_round):
+    # A round that's still going is scored as it stands. One the rollout
+    # finished already has its points, and the hands and feet are the next
+    # round's now, so recalculating would score those instead.
+    if game.round == current_round:
+        for game_player in game.players:
+            game_player.calculate_points(current_round)
+
+    def round_points(game_player):
+        points = game_player.points[current_round]
+        return (points.in_hand + points.in_foot + points.in_books + points.laid_down + points.for_going_out)
+
+    opponent_points = [round_points(game_player) for game_player in game.players if game_player is not player]
+    return (round_points(player) - max(opponent_points))
+
+#
+# Registry
+#
+
+POLICIES = {
+    "greedy": GreedyPolicy,
+    "heuristic": HeuristicPolicy,
+    "monte_carlo": MonteCarloPolicy
+}
+
+def policy_named(policy_name):
+    policy_class = POLICIES.get(policy_name)
+    if policy_class is None:
+        raise ValueError("Unknown policy: " + policy_name)
+
+    return policy_class()
@@ -0,0 +1,196 @@
+import cProfile
+import datetime
+import os
+import random
+import threading
+import time
+
+import flask
+
+#
+# Request Profiles
+#
+
+PHASES = ["auth", "replay", "serialization", "compression", "push"]
+
+class RequestProfile(object):
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start_time = time.perf_counter()
+        self.phase_times = {}
+        self.query_count = 0
+        self.query_time = 0.0
+        self.profiler = None
+
+    def add_phase_time(self, phase_name, duration):
+        self.phase_times[phase_name] = self.phase_times.get(phase_name, 0.0) + duration
+
+    def add_query(self, duration):
+        self.query_count += 1
+        self.query_time += duration
+
+    def describe(self, wall_time):
+        phases = " ".join(["%s=%.1fms" % (phase_name, self.phase_times.get(phase_name, 0.0) * 1000.0) for phase_name in PHASES])
+        return "%s wall=%.1fms %s db=%.1fms/%d" % (self.endpoint, wall_time * 1000.0, phases, self.query_time * 1000.0, self.query_count)
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.request_count = 0
+        self.wall_time = 0.0
+        self.phase_times = {}
+        self.query_count = 0
+        self.query_time = 0.0
+
+    def add_request(self, profile, wall_time):
+        self.request_count += 1
+        self.wall_time += wall_time
+        self.query_count += profile.query_count
+        self.query_time += profile.query_time
+
+        for (phase_name, duration) in profile.phase_times.items():
+            self.phase_times[phase_name] = self.phase_times.get(phase_name, 0.0) + duration
+
+#
+# Phases
+#
+
+class Phase(object):
+
+    def __init__(self, phase_name):
+        self.phase_name = phase_name
+        self.profile = None
+
+    def __enter__(self):
+        self.profile = current_profile()
+
+        if self.profile is not None:
+            self.start_time = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            self.profile.add_phase_time(self.phase_name, time.perf_counter() - self.start_time)
+
+        return False
+
+def phase(phase_name):
+    return Phase(phase_name)
+
+def current_profile():
+    if not flask.has_request_context():
+        return None
+
+    return flask.g.get("request_profile")
+
+#
+# Profiler
+#
+
+class RequestProfiler(object):
+
+    def __init__(self, slow_request_seconds=0.5, sample_rate=0.1, dump_dir="profiles"):
+        self.slow_request_seconds = slow_request_seconds
+        self.sample_rate = sample_rate
+        self.dump_dir = dump_dir
+        self.lock = threading.Lock()
+        self.endpoint_stats = {}
+
+    def install(self, app, db):
+        self.logger = app.logger
+        app.before_request(self.start_request)
+        app.teardown_request(self.finish_request)
+        self.instrument_database(db)
+
+    def instrument_database(self, db):
+        execute_sql = db.execute_sql
+
+        def profiled_execute_sql(*args, **kwargs):
+            profile = current_profile()
+            if profile is None:
+                return execute_sql(*args, **kwargs)
+
+            start_time = time.perf_counter()
+            try:
+                return execute_sql(*args, **kwargs)
+            finally:
+                profile.add_query(time.perf_counter() - start_time)
+
+        db.execute_sql = profiled_execute_sql
+
+    def start_request(self):
+        profile = RequestProfile(flask.request.endpoint or "unknown")
+
+        if random.random() < self.sample_rate:
+            profile.profiler = cProfile.Profile()
+            profile.profiler.enable()
+
+        flask.g.request_profile = profile
+
+    def finish_request(self, exc):
+        profile = flask.g.pop("request_profile", None)
+        if profile is None:
+            return
+
+        wall_time = time.perf_counter() - profile.start_time
+
+        if profile.profiler is not None:
+            profile.profiler.disable()
+
+            if wall_time >= self.slow_request_seconds:
+                self.dump_profile(profile)
+
+        with self.lock:
+            endpoint_stats = self.endpoint_stats.get(profile.endpoint)
+            if endpoint_stats is None:
+                endpoint_stats = EndpointStats()
+                self.endpoint_stats[profile.endpoint] = endpoint_stats
+
+            endpoint_stats.add_request(profile, wall_time)
+
+        self.logger.info("Request profile: " + profile.describe(wall_time))
+
+    def dump_profile(self, profile):
+        os.makedirs(self.dump_dir, exist_ok=True)
+
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S-%f")
+        dump_path = os.path.join(self.dump_dir, "%s-%s.prof" % (profile.endpoint, timestamp))
+
+        try:
+            profile.profiler.dump_stats(dump_path)
+        except IOError as e:
+            self.logger.warning("Couldn't write request profile: " + str(e))
+
+    def render(self):
+        with self.lock:
+            lines = []
+
+            lines.append("# HELP handandfoot_requests_total Profiled requests, by endpoint.")
+            lines.append("# TYPE handandfoot_requests_total counter")
+            for (endpoint, endpoint_stats) in sorted(self.endpoint_stats.items()):
+                lines.append("handandfoot_requests_total{endpoint=\"%s\"} %d" % (endpoint, endpoint_stats.request_count))
+
+            lines.append("# HELP handandfoot_request_seconds_total Wall time spent in profiled requests, by endpoint.")
+            lines.append("# TYPE handandfoot_request_seconds_total counter")
+            for (endpoint, endpoint_stats) in sorted(self.endpoint_stats.items()):
+                lines.append("handandfoot_request_seconds_total{endpoint=\"%s\"} %f" % (endpoint, endpoint_stats.wall_time))
+
+            lines.append("# HELP handandfoot_request_phase_seconds_total Time spent in each request phase, by endpoint.")
+            lines.append("# TYPE handandfoot_request_phase_seconds_total counter")
+            for (endpoint, endpoint_stats) in sorted(self.endpoint_stats.items()):
+                for (phase_name, duration) in sorted(endpoint_stats.phase_times.items()):
+                    lines.append("handandfoot_request_phase_seconds_total{endpoint=\"%s\",phase=\"%s\"} %f" % (endpoint, phase_name, duration))
+
+            lines.append("# HELP handandfoot_request_queries_total Database queries made by profiled requests, by endpoint.")
+            lines.append("# TYPE handandfoot_request_queries_total counter")
+            for (endpoint, endpoint_stats) in sorted(self.endpoint_stats.items()):
+                lines.append("handandfoot_request_queries_total{endpoint=\"%s\"} %d" % (endpoint, endpoint_stats.query_count))
+
+            lines.append("# HELP handandfoot_request_query_seconds_total Time spent in database queries, by endpoint.")
+            lines.append("# TYPE handandfoot_request_query_seconds_total counter")
+            for (endpoint, endpoint_stats) in sorted(self.endpoint_stats.items()):
+                lines.append("handandfoot_request_query_seconds_total{endpoint=\"%s\"} %f" % (endpoint, endpoint_stats.query_time))
+
+            return "\n".join(lines) + "\n"
@@ -0,0 +1,208 @@
+import collections
+import math
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+#
+# Token Buckets
+#
+
+# Every user and every game has a bucket that holds up to burst tokens and
+# refills at rate tokens a second. Each limited request takes one, and a
+# request that finds its bucket empty is turned away with how long until
+# the next token. Buckets aren't stored while they're full, so idle users
+# and games cost nothing.
+
+class Limit(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+def refilled_tokens(tokens, updated_at, now, limit):
+    return min(limit.burst, tokens + max(0.0, now - updated_at) * limit.rate)
+
+class MemoryBucketStore(object):
+
+    # Buckets for this process only, dropping the least recently used past
+    # max_buckets, which at worst lets those users and games start full again
+
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()
+
+    def take(self, key, limit):
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                tokens = limit.burst
+            else:
+                tokens = refilled_tokens(bucket[0], bucket[1], now, limit)
+
+            if tokens >= 1.0:
+                retry_after = 0.0
+                tokens -= 1.0
+            else:
+                retry_after = (1.0 - tokens) / limit.rate
+
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+
+        return retry_after
+
+# The same bucket as a Redis script, so every process behind the load
+# balancer shares one. Time comes from the caller, since scripts that read
+# the clock can't be replicated on older servers, and a bucket expires once
+# it would be full again.
+REDIS_TAKE_SCRIPT = """
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated_at", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+"""
+
+class RedisBucketStore(object):
+
+    def __init__(self, url, key_prefix="handandfoot:rate_limit:"):
+        if redis is None:
+            raise ValueError("Shared rate limits need the redis package installed")
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.1, socket_connect_timeout=0.1)
+        self.take_script = self.client.register_script(REDIS_TAKE_SCRIPT)
+        self.key_prefix = key_prefix
+
+    def take(self, key, limit):
+        retry_after = self.take_script(keys=[self.key_prefix + key], args=[limit.rate, limit.burst, time.time()])
+        return float(retry_after)
+
+class FallbackBucketStore(object):
+
+    # A shared store that falls back to this process's buckets while it's
+    # unreachable, so an outage loosens the limits instead of failing every
+    # request
+
+    def __init__(self, shared_store, local_store, retry_seconds=10.0):
+        self.shared_store = shared_store
+        self.local_store = local_store
+        self.retry_seconds = retry_seconds
+        self.failed_at = None
+        self.logger = None
+
+    def take(self, key, limit):
+        failed_at = self.failed_at
+        if (failed_at is not None) and (time.monotonic() - failed_at < self.retry_seconds):
+            return self.local_store.take(key, limit)
+
+        try:
+            retry_after = self.shared_store.take(key, limit)
+        except Exception as e:
+            if (self.failed_at is None) and (self.logger is not None):
+                self.logger.warning("Couldn't reach shared rate limits, using local ones: " + str(e))
+
+            self.failed_at = time.monotonic()
+            return self.local_store.take(key, limit)
+
+        self.failed_at = None
+        return retry_after
+
+#
+# Admission Control
+#
+
+# Requests are checked before they touch the database or the engine: the
+# user comes from the signature on their token and the game from the body,
+# so a client looping on a bad request is turned away for the cost of an
+# HMAC. Replays also have a cap on how many run at once per endpoint, past
+# which requests are turned away rather than queued behind the others.
+
+class Rejection(object):
+
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, int(math.ceil(self.retry_after))))
+
+class AdmissionControl(object):
+
+    def __init__(self, store, limits, max_concurrent):
+        self.store = store
+        self.limits = limits
+        self.semaphores = {endpoint: threading.BoundedSemaphore(count) for (endpoint, count) in max_concurrent.items()}
+        self.lock = threading.Lock()
+        self.rejections = {}
+
+    def check_rates(self, endpoint, keys):
+        # keys are (kind, ID) pairs, like ("game", 12), each with the limit
+        # for its kind, in the order they're checked: the user first, so a
+        # user that's over their own limit can't drain a game's bucket and
+        # lock out the other players. Buckets after a rejection are left
+        # alone.
+        for (kind, key) in keys:
+            limit = self.limits.get(kind)
+            if limit is None:
+                continue
+
+            retry_after = self.store.take("%s:%s" % (kind, key), limit)
+            if retry_after > 0.0:
+                rejection = Rejection(kind + "_rate", retry_after)
+                self.count_rejection(endpoint, rejection)
+                return rejection
+
+        return None
+
+    def enter(self, endpoint):
+        semaphore = self.semaphores.get(endpoint)
+        if (semaphore is None) or semaphore.acquire(blocking=False):
+            return None
+
+        rejection = Rejection("concurrency", 1.0)
+        self.count_rejection(endpoint, rejection)
+        return rejection
+
+    def leave(self, endpoint):
+        semaphore = self.semaphores.get(endpoint)
+        if semaphore is not None:
+            semaphore.release()
+
+    def count_rejection(self, endpoint, rejection):
+        with self.lock:
+            key = (endpoint, rejection.reason)
+            self.rejections[key] = self.rejections.get(key, 0) + 1
+
+    def render(self):
+        with self.lock:
+            lines = []
+
+            lines.append("# HELP handandfoot_admission_rejections_total Requests turned away with 429 before any work, by endpoint and reason.")
+            lines.append("# TYPE handandfoot_admission_rejections_total counter")
+            for ((endpoint, reason), count) in sorted(self.rejections.items()):
+                lines.append("handandfoot_admission_rejections_total{endpoint=\"%s\",reason=\"%s\"} %d" % (endpoint, reason, count))
+
+            return "\n".join(lines) + "\n"
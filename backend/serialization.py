@@ -0,0 +1,134 @@
+import collections
+import json
+import threading
+
+import werkzeug.http
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#
+# Backends
+#
+
+# Responses are encoded the way flask.jsonify does: sorted keys, no spaces,
+# and dates as HTTP dates. orjson is used when it's installed. It writes
+# non-ASCII characters as UTF-8 instead of escaping them, which decodes to
+# the same JSON.
+
+def json_default(value):
+    if hasattr(value, "timetuple"):
+        return werkzeug.http.http_date(value)
+
+    raise TypeError("Can't encode %s as JSON" % type(value).__name__)
+
+def encode_with_json(value):
+    return json.dumps(value, default=json_default, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+def encode_with_orjson(value):
+    return orjson.dumps(value, default=json_default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+BACKENDS = {
+    "json": encode_with_json
+}
+
+if orjson is not None:
+    BACKENDS["orjson"] = encode_with_orjson
+
+def backend_named(name):
+    if name == "auto":
+        return BACKENDS.get("orjson", encode_with_json)
+
+    if name not in BACKENDS:
+        raise ValueError("Unknown or missing JSON backend: " + name)
+
+    return BACKENDS[name]
+
+#
+# Fragments
+#
+
+class Fragment(object):
+
+    # JSON that's already encoded, to go into a response as it is
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+class Encoder(object):
+
+    def __init__(self, backend_name="auto"):
+        self.encode_value = backend_named(backend_name)
+
+    def encode(self, value):
+        # Fragments are spliced in where responses have rows: as values of
+        # the top level object, or items of a list that is one. Every piece
+        # is joined once at the end, since responses run to megabytes.
+        if type(value) is not dict:
+            return self.encode_value(value)
+
+        parts = [b"{"]
+        for key in sorted(value.keys()):
+            item = value[key]
+
+            if len(parts) > 1:
+                parts.append(b",")
+
+            parts.append(self.encode_value(key))
+            parts.append(b":")
+
+            if type(item) is Fragment:
+                parts.append(item.encoded)
+            elif (type(item) is list) and any(type(list_item) is Fragment for list_item in item):
+                parts.append(b"[")
+                parts.append(b",".join([list_item.encoded if type(list_item) is Fragment else self.encode_value(list_item) for list_item in item]))
+                parts.append(b"]")
+            else:
+                parts.append(self.encode_value(item))
+
+        parts.append(b"}")
+        return b"".join(parts)
+
+class FragmentCache(object):
+
+    # Encoded rows, keyed by model, ID and a version that changes whenever
+    # the row's JSON does, which for most models is last_updated. The least
+    # recently used are dropped past the size limit.
+
+    def __init__(self, encoder, max_bytes=64 * 1024 * 1024):
+        self.encoder = encoder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.fragments = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def fragment(self, row, version):
+        key = (type(row).__name__, row.id, version)
+
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+            self.misses += 1
+
+        # Encoded outside the lock, since two requests encoding the same row
+        # at once only costs the time
+        fragment = Fragment(self.encoder.encode_value(row.to_json()))
+
+        with self.lock:
+            if key not in self.fragments:
+                self.fragments[key] = fragment
+                self.size += len(fragment.encoded)
+
+                while self.size > self.max_bytes:
+                    (_, dropped_fragment) = self.fragments.popitem(last=False)
+                    self.size -= len(dropped_fragment.encoded)
+
+        return fragment
@@ -0,0 +1,238 @@
+import enum
+
+import engine
+
+#
+# Goals
+#
+
+class LayDownGoal(enum.Enum):
+    FEWEST_CARDS = "fewest_cards"
+    MOST_POINTS = "most_points"
+
+#
+# Lay Downs
+#
+
+class LayDown(object):
+
+    def __init__(self, books, partial_book, points):
+        self.books = books
+        self.partial_book = partial_book
+        self.points = points
+
+    @property
+    def card_count(self):
+        card_count = sum([len(book) for book in self.books])
+
+        if self.partial_book is not None:
+            card_count += len(self.partial_book) + 1
+
+        return card_count
+
+    def to_action(self, player_name):
+        if self.partial_book is None:
+            return engine.LayDownInitialBooksAction(player_name, self.books)
+        else:
+            return engine.DrawFromDiscardPileAndLayDownInitialBooksAction(player_name, self.partial_book, self.books)
+
+    def to_action_json(self, player_name):
+        return self.to_action(player_name).to_json()
+
+#
+# Solver
+#
+
+EMPTY_SOLUTION = (0, 0, None, None)
+
+def find_lay_down(hand, current_round, discard_pile_top=None, goal=LayDownGoal.FEWEST_CARDS, rules=None):
+    if rules is None:
+        rules = engine.DEFAULT_RULES.compile()
+
+    max_wild_counts = rules.max_wild_counts
+    minimum_book_size = rules.minimum_book_size
+    points_needed = rules.points_needed[current_round]
+
+    naturals = {}
+    wilds = []
+
+    for card in hand:
+        if card.is_wild:
+            wilds.append(card)
+        elif card.can_start_book:
+            naturals.setdefault(card.rank, []).append(card)
+
+    # Swapping a wild for a more valuable one never breaks a book, so books
+    # always take wilds in order of value. The top of the discard pile goes
+    # first in its pool so whichever book takes the first card of that kind
+    # is the one that gets completed with it.
+    wilds.sort(key=lambda card: card.point_value, reverse=True)
+
+    forced_rank = None
+    forced_wild = False
+
+    if discard_pile_top is not None:
+        if discard_pile_top.can_start_book:
+            forced_rank = discard_pile_top.rank
+            naturals.setdefault(forced_rank, []).insert(0, discard_pile_top)
+        elif discard_pile_top.is_wild:
+            forced_wild = True
+            wilds.insert(0, discard_pile_top)
+        else:
+            return None
+
+    ranks = sorted(naturals.keys(), key=lambda rank: engine.RANK_INDICES[rank])
+    counts = [len(naturals[rank]) for rank in ranks]
+    values = [naturals[rank][0].point_value for rank in ranks]
+
+    wild_points = [0]
+    for card in wilds:
+        wild_points.append(wild_points[-1] + card.point_value)
+
+    # Upper bound on the points the naturals from each rank onward can add
+    remaining_natural_points = [0] * (len(ranks) + 1)
+    for rank_index in reversed(range(0, len(ranks))):
+        remaining_natural_points[rank_index] = remaining_natural_points[rank_index + 1]
+        if (counts[rank_index] + max_wild_counts[counts[rank_index]]) >= minimum_book_size:
+            remaining_natural_points[rank_index] += counts[rank_index] * values[rank_index]
+
+    forced_rank_index = ranks.index(forced_rank) if forced_rank is not None else -1
+
+    fewest_cards = (goal == LayDownGoal.FEWEST_CARDS)
+
+    # The most points one card from each rank onward, and one wild from each
+    # wild onward, is worth, for a lower bound on how many more cards the
+    # threshold needs. Wilds aren't quite in order of value, since the top of
+    # the discard pile goes first.
+    best_natural_values = [0] * (len(ranks) + 1)
+    for rank_index in reversed(range(0, len(ranks))):
+        best_natural_values[rank_index] = max(best_natural_values[rank_index + 1], values[rank_index])
+
+    best_wild_values = [0] * (len(wilds) + 1)
+    for wild_index in reversed(range(0, len(wilds))):
+        best_wild_values[wild_index] = max(best_wild_values[wild_index + 1], wilds[wild_index].point_value)
+
+    def min_card_count(rank_index, wilds_used, points_needed):
+        if points_needed <= 0:
+            return 0
+
+        best_value = max(1, best_natural_values[rank_index], best_wild_values[wilds_used])
+        return max(minimum_book_size, -(-points_needed // best_value))
+
+    # Solutions are (card count, points, (rank index, natural count, wild count), rest of the solution).
+    #
+    # Looking for the fewest cards, each search has a card limit: the best
+    # found so far, so books that can't get under it are skipped without
+    # searching the ranks after them. A solution found under a limit is still
+    # the best one there is, but not finding one only means there's none
+    # under that limit, so the memo keeps the limit with it.
+    memo = {}
+
+    def search(rank_index, wilds_used, points_needed, card_limit):
+        key = (rank_index, wilds_used, points_needed)
+        if key in memo:
+            (solution, searched_limit) = memo[key]
+            if solution is not None:
+                return solution if solution[0] <= card_limit else None
+            elif card_limit <= searched_limit:
+                return None
+
+        solution = search_ranks(rank_index, wilds_used, points_needed, card_limit)
+        memo[key] = (solution, card_limit)
+        return solution
+
+    def search_ranks(rank_index, wilds_used, points_needed, card_limit):
+        if rank_index == len(ranks):
+            if (points_needed > 0) or (forced_wild and (wilds_used == 0)):
+                return None
+
+            return EMPTY_SOLUTION
+
+        if points_needed > (remaining_natural_points[rank_index] + wild_points[-1] - wild_points[wilds_used]):
+            return None
+
+        if min_card_count(rank_index, wilds_used, points_needed) > card_limit:
+            return None
+
+        # Once the threshold is met, any further book only adds cards
+        if fewest_cards and (points_needed == 0) and (forced_rank_index < rank_index) and (wilds_used > 0 or not forced_wild):
+            return EMPTY_SOLUTION
+
+        best_solution = None
+        best_card_count = 0
+        best_points = 0
+
+        if ranks[rank_index] != forced_rank:
+            best_solution = search(rank_index + 1, wilds_used, points_needed, card_limit)
+            if best_solution is not None:
+                (best_card_count, best_points) = best_solution[:2]
+
+        for natural_count in range(1, counts[rank_index] + 1):
+            natural_points = natural_count * values[rank_index]
+            max_wild_count = min(max_wild_counts[natural_count], len(wilds) - wilds_used)
+
+            for wild_count in range(max(0, minimum_book_size - natural_count), max_wild_count + 1):
+                book_points = natural_points + wild_points[wilds_used + wild_count] - wild_points[wilds_used]
+
+                # A tie on cards is still worth searching, since it might
+                # have more points
+                rest_card_limit = card_limit
+                if fewest_cards and (best_solution is not None):
+                    rest_card_limit = min(card_limit, best_card_count)
+
+                rest = search(rank_index + 1, wilds_used + wild_count, max(0, points_needed - book_points), rest_card_limit - natural_count - wild_count)
+                if rest is None:
+                    continue
+
+                card_count = rest[0] + natural_count + wild_count
+                points = rest[1] + book_points
+
+                if best_solution is not None:
+                    if fewest_cards:
+                        is_better = (card_count < best_card_count) or ((card_count == best_card_count) and (points > best_points))
+                    else:
+                        is_better = (points > best_points) or ((points == best_points) and (card_count < best_card_count))
+
+                    if not is_better:
+                        continue
+
+                best_solution = (card_count, points, (rank_index, natural_count, wild_count), rest)
+                best_card_count = card_count
+                best_points = points
+
+        return best_solution
+
+    # Maximizing points uses as many cards as it can anyway, so the threshold
+    # only needs checking once at the end
+    if goal == LayDownGoal.MOST_POINTS:
+        solution = search(0, 0, 0, len(hand) + 1)
+        if (solution is not None) and (solution[1] < points_needed):
+            solution = None
+    else:
+        solution = search(0, 0, points_needed, len(hand) + 1)
+
+    if solution is None:
+        return None
+
+    points = solution[1]
+    books = []
+    partial_book = None
+    wilds_used = 0
+
+    while solution is not EMPTY_SOLUTION:
+        (rank_index, natural_count, wild_count) = solution[2]
+        solution = solution[3]
+
+        book_naturals = naturals[ranks[rank_index]][:natural_count]
+        book_wilds = wilds[wilds_used:(wilds_used + wild_count)]
+
+        if ranks[rank_index] == forced_rank:
+            partial_book = book_naturals[1:] + book_wilds
+        elif forced_wild and (wilds_used == 0) and (wild_count > 0):
+            partial_book = book_naturals + book_wilds[1:]
+        else:
+            books.append(book_naturals + book_wilds)
+
+        wilds_used += wild_count
+
+    return LayDown(books, partial_book, points)
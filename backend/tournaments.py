@@ -0,0 +1,388 @@
+import collections
+import datetime
+import random
+import threading
+
+import peewee
+
+import engine_pool
+
+from models import db
+from models import INSERT_BATCH_SIZE
+from models import User
+from models import Game
+from models import Tournament
+from models import TournamentEntrant
+from models import TournamentTable
+
+MIN_TABLE_SIZE = 2
+MAX_TABLE_SIZE = 6
+
+#
+# Ranked Sets
+#
+
+# Standings need both the entrant at a given place and the place of a given
+# entrant, as entrants' points change under them. A treap that keeps the size
+# of every subtree answers both, and takes adds and removes, in O(log n).
+
+class RankedNode(object):
+
+    def __init__(self, key, priority):
+        self.key = key
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.size = 1
+
+def node_size(node):
+    return node.size if node is not None else 0
+
+def update_size(node):
+    node.size = 1 + node_size(node.left) + node_size(node.right)
+
+def split_nodes(node, key):
+    # Everything below key, and everything from key up
+    if node is None:
+        return (None, None)
+
+    if node.key < key:
+        (node.right, right) = split_nodes(node.right, key)
+        update_size(node)
+        return (node, right)
+    else:
+        (left, node.left) = split_nodes(node.left, key)
+        update_size(node)
+        return (left, node)
+
+def merge_nodes(left, right):
+    # Every key in left is below every key in right
+    if (left is None) or (right is None):
+        return left if right is None else right
+
+    if left.priority > right.priority:
+        left.right = merge_nodes(left.right, right)
+        update_size(left)
+        return left
+    else:
+        right.left = merge_nodes(left, right.left)
+        update_size(right)
+        return right
+
+def remove_node(node, key):
+    if node is None:
+        return None
+
+    if key == node.key:
+        return merge_nodes(node.left, node.right)
+
+    if key < node.key:
+        node.left = remove_node(node.left, key)
+    else:
+        node.right = remove_node(node.right, key)
+
+    update_size(node)
+    return node
+
+class RankedSet(object):
+
+    def __init__(self, seed=None):
+        self.root = None
+        self.random = random.Random(seed)
+
+    def __len__(self):
+        return node_size(self.root)
+
+    def add(self, key):
+        (left, right) = split_nodes(self.root, key)
+        self.root = merge_nodes(merge_nodes(left, RankedNode(key, self.random.random())), right)
+
+    def remove(self, key):
+        self.root = remove_node(self.root, key)
+
+    def count_below(self, key):
+        count = 0
+        node = self.root
+
+        while node is not None:
+            if node.key < key:
+                count += node_size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+
+        return count
+
+    def key_at(self, index):
+        node = self.root
+
+        while node is not None:
+            left_size = node_size(node.left)
+
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node.key
+            else:
+                index -= left_size + 1
+                node = node.right
+
+        raise IndexError("Ranked set index out of range")
+
+#
+# Standings
+#
+
+# Entrants are ordered by points, highest first, and then by when they
+# entered. Entrants with the same points share a place.
+
+def standing_key(points, entrant_id):
+    return (-points, entrant_id)
+
+class Standing(object):
+
+    def __init__(self, place, entrant):
+        self.place = place
+        self.entrant = entrant
+
+    def to_json(self, user=None):
+        standing_json = self.entrant.to_json()
+        standing_json["place"] = self.place
+
+        if user is not None:
+            standing_json["user"] = user.to_json()
+
+        return standing_json
+
+class TournamentStandings(object):
+
+    def __init__(self, tournament_id):
+        self.tournament_id = tournament_id
+        self.version = -1
+        self.ranking = RankedSet()
+        self.entrants = {}
+
+    def catch_up(self, version):
+        # Reads only the entrants stamped after the version already seen,
+        # which the first time is all of them
+        if version <= self.version:
+            return
+
+        changed_entrants = TournamentEntrant.select().where(
+            (TournamentEntrant.tournament == self.tournament_id) &
+            (TournamentEntrant.standings_version > self.version))
+
+        for entrant in changed_entrants:
+            self.update_entrant(entrant)
+
+        self.version = version
+
+    def update_entrant(self, entrant):
+        previous_entrant = self.entrants.get(entrant.id)
+        if previous_entrant is not None:
+            self.ranking.remove(standing_key(previous_entrant.points, previous_entrant.id))
+
+        self.ranking.add(standing_key(entrant.points, entrant.id))
+        self.entrants[entrant.id] = entrant
+
+    def place_of(self, entrant):
+        return self.ranking.count_below(standing_key(entrant.points, 0)) + 1
+
+    def standing_of(self, entrant_id):
+        entrant = self.entrants.get(entrant_id)
+        if entrant is None:
+            return None
+
+        return Standing(self.place_of(entrant), entrant)
+
+    def standings(self, offset, count):
+        standings = []
+
+        for index in range(offset, min(offset + count, len(self.ranking))):
+            entrant = self.entrants[self.ranking.key_at(index)[1]]
+            standings.append(Standing(self.place_of(entrant), entrant))
+
+        return standings
+
+class StandingsCache(object):
+
+    # Standings are kept per process for the most recently read tournaments,
+    # and brought up to date from the tournament's standings version on every
+    # read
+
+    def __init__(self, max_tournaments=64):
+        self.max_tournaments = max_tournaments
+        self.lock = threading.Lock()
+        self.tournament_standings = collections.OrderedDict()
+
+    def standings_for(self, tournament):
+        tournament_standings = self.tournament_standings.pop(tournament.id, None)
+        if tournament_standings is None:
+            tournament_standings = TournamentStandings(tournament.id)
+
+        self.tournament_standings[tournament.id] = tournament_standings
+        while len(self.tournament_standings) > self.max_tournaments:
+            self.tournament_standings.popitem(last=False)
+
+        tournament_standings.catch_up(tournament.standings_version)
+        return tournament_standings
+
+    def standing_of(self, tournament, entrant):
+        with self.lock:
+            return self.standings_for(tournament).standing_of(entrant.id)
+
+    def standings(self, tournament, offset, count):
+        with self.lock:
+            tournament_standings = self.standings_for(tournament)
+            return (tournament_standings.standings(offset, count), len(tournament_standings.ranking))
+
+#
+# Seating
+#
+
+def table_sizes(entrant_count, table_size):
+    # As few tables as the table size allows, evened out, and never a table
+    # of one. No table is bigger than table_size except when it's two and the
+    # entrant count is odd, which leaves one table of three; creating a
+    # tournament checks for that, so it only happens here if asked directly.
+    table_count = -(-entrant_count // table_size)
+    if entrant_count // table_count < MIN_TABLE_SIZE:
+        table_count = entrant_count // MIN_TABLE_SIZE
+
+    (size, extra_count) = divmod(entrant_count, table_count)
+    return [(size + 1) if i < extra_count else size for i in range(0, table_count)]
+
+def seat_entrants(entrants, table_size, generator):
+    # Entrants come in by standings, so after the first round, which is drawn
+    # at random, players sit with others on about the same points. Seats at
+    # each table are drawn at random.
+    tables = []
+    start = 0
+
+    for size in table_sizes(len(entrants), table_size):
+        table = entrants[start:(start + size)]
+        generator.shuffle(table)
+        tables.append(table)
+        start += size
+
+    return tables
+
+def deal_tables(player_names_and_rules):
+    return [engine_pool.create_initial_state(player_names, rules) for (player_names, rules) in player_names_and_rules]
+
+def advance_tournament(tournament, deal=deal_tables, generator=random):
+    # Seats the next round, or finishes the tournament after its last one,
+    # and returns the IDs of any new games
+    if not tournament.is_ready_to_advance:
+        return []
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ready = (Tournament.id == tournament.id) & (Tournament.current_round == tournament.current_round) & (Tournament.tables_remaining == 0) & (Tournament.finished == False)
+
+    if tournament.current_round >= tournament.round_count:
+        Tournament.update(finished=True, last_updated=now).where(ready).execute()
+        return []
+
+    entrants = list(TournamentEntrant.select().where(TournamentEntrant.tournament == tournament.id).order_by(TournamentEntrant.points.desc(), TournamentEntrant.id))
+    if tournament.current_round == 0:
+        generator.shuffle(entrants)
+
+    users = {user.id: user for user in User.select().join(TournamentEntrant, on=(TournamentEntrant.user == User.id)).where(TournamentEntrant.tournament == tournament.id)}
+    tables = [[users[entrant.user_id] for entrant in table] for table in seat_entrants(entrants, tournament.table_size, generator)]
+
+    rules = tournament.load_rules()
+    next_round = tournament.current_round + 1
+    initial_states = deal([([user.email for user in table], rules) for table in tables])
+
+    with db.atomic():
+        # Claiming the round first means only one process ever seats it
+        if Tournament.update(current_round=next_round, tables_remaining=len(tables), last_updated=now).where(ready).execute() == 0:
+            return []
+
+        game_setups = []
+        for (table_number, (table, (initial_state, snapshot_state))) in enumerate(zip(tables, initial_states)):
+            title = "%s: round %d, table %d" % (tournament.title, next_round, table_number + 1)
+            game_setups.append((title, table, initial_state, snapshot_state))
+
+        # Entrants are entered, so there are no invitations to accept
+        game_ids = Game.create_many(game_setups, all_accepted=True)
+
+        table_rows = [{"tournament": tournament.id, "round": next_round, "game": game_id} for game_id in game_ids]
+        for rows in peewee.chunked(table_rows, INSERT_BATCH_SIZE):
+            TournamentTable.insert_many(rows).execute()
+
+        for (table, game_id) in zip(tables, game_ids):
+            TournamentEntrant.update(current_game=game_id).where((TournamentEntrant.tournament == tournament.id) & TournamentEntrant.user.in_([user.id for user in table])).execute()
+
+    tournament.current_round = next_round
+    tournament.tables_remaining = len(tables)
+    return game_ids
+
+def tournaments_ready_to_advance(limit=None):
+    query = Tournament.select().where((Tournament.finished == False) & (Tournament.tables_remaining == 0)).order_by(Tournament.id)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
+
+#
+# Background Director
+#
+
+class TournamentDirector(object):
+
+    # Seats each round once the one before it is finished. Games only ever
+    # end in add_action, so polling is enough, and wake() starts a new
+    # tournament's first round right away.
+
+    def __init__(self, poll_seconds=5.0, batch_size=10, deal=deal_tables, notify=None):
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.deal = deal
+        self.notify = notify
+        self.stopping = threading.Event()
+        self.waking = threading.Event()
+        self.thread = None
+
+    def start(self, logger):
+        self.logger = logger
+        self.thread = threading.Thread(target=self.run, name="tournament-director", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.waking.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def wake(self):
+        self.waking.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.waking.wait(self.poll_seconds)
+            self.waking.clear()
+
+            if self.stopping.is_set():
+                break
+
+            try:
+                with db.connection_context():
+                    self.advance_ready_tournaments()
+            except Exception as e:
+                self.logger.warning("Couldn't advance tournaments: " + str(e))
+
+    def advance_ready_tournaments(self):
+        advanced_count = 0
+
+        for tournament in tournaments_ready_to_advance(self.batch_size):
+            game_ids = advance_tournament(tournament, self.deal)
+            advanced_count += 1
+
+            if (len(game_ids) > 0) and (self.notify is not None):
+                self.notify(game_ids)
+
+        return advanced_count
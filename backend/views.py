@@ -0,0 +1,123 @@
+import engine
+
+#
+# Player Views
+#
+
+# A view is everything one player is allowed to see, already worked out by the
+# server: their own hand and foot, how many cards everyone else is holding,
+# the books on the table, how close everyone is to going out, the top of the
+# discard pile, points and whose turn it is. The version is the number of
+# actions that have been applied, so a client can ask for only what's changed
+# since the view it already has.
+
+def project_game(game, viewer_name, version):
+    viewer = game.get_player_named(viewer_name)
+    if viewer is None:
+        raise ValueError("Unknown player: " + viewer_name)
+
+    current_round = game.round
+
+    players_json = {}
+    for player in game.players:
+        players_json[player.name] = project_player(player, current_round)
+
+    if current_round is None:
+        current_player_name = None
+        deck_count = 0
+    else:
+        current_player_name = game.player_iterator.current_player.name
+        deck_count = game.deck.card_count
+
+    if len(game.discard_pile) > 0:
+        discard_pile_top = game.discard_pile[-1].to_json()
+    else:
+        discard_pile_top = None
+
+    return {
+        "version": version,
+        "rules": game.rules.rule_set.to_json(),
+        "round": None if current_round is None else current_round.value,
+        "current_player": current_player_name,
+        "player_order": [player.name for player in game.players],
+        "players": players_json,
+        "discard_pile_top": discard_pile_top,
+        "discard_pile_count": len(game.discard_pile),
+        "deck_count": deck_count,
+        "hand": [card.to_json() for card in viewer.hand],
+        "foot": [card.to_json() for card in viewer.foot],
+        "turn": {
+            "cards_drawn_from_deck": viewer.cards_drawn_from_deck,
+            "cards_drawn_from_discard_pile": viewer.cards_drawn_from_discard_pile
+        }
+    }
+
+def project_player(player, current_round):
+    books_json = {}
+    status_json = None
+    if current_round is not None:
+        for (rank, book) in player.books[current_round].items():
+            books_json[rank.value] = book.to_json()
+
+        status_json = player.turn_status(current_round)
+
+    points_json = {}
+    for (points_round, points) in player.points.items():
+        points_json[points_round.value] = points.to_json()
+
+    return {
+        "hand_count": len(player.hand),
+        "foot_count": len(player.foot),
+        "has_laid_down_this_round": player.has_laid_down_this_round,
+        "books": books_json,
+        "status": status_json,
+        "points": points_json
+    }
+
+#
+# Deltas
+#
+
+# Deltas are JSON merge patches (RFC 7386): only keys whose values changed are
+# included, objects are patched recursively, and a null value removes the key
+# (books are cleared when a round ends). Every view field that can be null is
+# optional, so a client can treat a removed key and a null one the same way.
+
+def diff_views(old_view, new_view):
+    return {
+        "since": old_view["version"],
+        "version": new_view["version"],
+        "changes": diff_objects(old_view, new_view)
+    }
+
+def diff_objects(old_object, new_object):
+    changes = {}
+
+    for (key, new_value) in new_object.items():
+        old_value = old_object.get(key)
+        if (key in old_object) and (old_value == new_value):
+            continue
+
+        if (type(old_value) is dict) and (type(new_value) is dict):
+            changes[key] = diff_objects(old_value, new_value)
+        else:
+            changes[key] = new_value
+
+    for key in old_object.keys():
+        if key not in new_object:
+            changes[key] = None
+
+    return changes
+
+def apply_changes(old_object, changes):
+    new_object = dict(old_object)
+
+    for (key, value) in changes.items():
+        if value is None:
+            new_object.pop(key, None)
+        elif (type(value) is dict) and (type(new_object.get(key)) is dict):
+            new_object[key] = apply_changes(new_object[key], value)
+        else:
+            new_object[key] = value
+
+    return new_object
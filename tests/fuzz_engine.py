@@ -0,0 +1,482 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import engine
+import policies
+
+from test_engine import conditionFinalStateForComparison
+
+"""
+Differential fuzzing for engines
+
+Every fuzz case comes from a seed: the player count, the four decks, and a
+run of actions picked from the legal ones, with the occasional near-legal
+action (the wrong player, a card that isn't in hand, a book that doesn't
+exist, ...) mixed in. The Python engine plays the actions as they're picked,
+so a case ends at the first action it rejects, just like an engine running
+the test case stops at its first IllegalActionError.
+
+Each case is summed up by a fingerprint of its final state, conditioned the
+same way test_engine.py compares them. An action that makes the Python
+engine raise anything other than IllegalActionError is a bug in the Python
+engine itself, so the case is recorded as a crash instead and reported on
+its own. A fingerprint corpus is a JSON lines file: the settings on the
+first line, then one seed and fingerprint per case.
+
+    # Fingerprint cases with the Python engine
+    python fuzz_engine.py generate corpus.jsonl 100000
+
+    # Write the cases out as test cases, to run another engine elsewhere
+    python fuzz_engine.py export corpus.jsonl cases/
+
+    # Run another engine on every case, and minimize any that disagree
+    python fuzz_engine.py check "path/to/EngineTest" corpus.jsonl reproducers/
+
+Minimized reproducers are regular test cases, with the Python engine's final
+state as the expected one, so test_engine.py can run them against either
+engine.
+"""
+
+DEFAULT_SETTINGS = {
+    "max_actions": 200,
+    "near_legal_rate": 0.02
+}
+
+ROUNDS = list(engine.Round)
+DECK_KEYS = {current_round: current_round.value + "_deck" for current_round in ROUNDS}
+NATURAL_RANKS = sorted(set([card.rank for card in engine.CARDS_BY_CODE if card.can_start_book]), key=lambda rank: engine.RANK_INDICES[rank])
+
+#
+# Case Generation
+#
+
+class EngineCrash(Exception):
+
+    def __init__(self, action_json, error):
+        super().__init__("%s: %s applying %s" % (type(error).__name__, error, json.dumps(action_json)))
+        self.action_json = action_json
+        self.error = error
+
+class FuzzCase(object):
+
+    def __init__(self, seed, player_names, deck_codes, actions_json):
+        self.seed = seed
+        self.player_names = player_names
+        self.deck_codes = deck_codes
+        self.actions_json = actions_json
+
+    def start_game(self):
+        decks = {current_round: engine.Deck.from_codes(self.deck_codes[current_round]) for current_round in ROUNDS}
+        return engine.Game(self.player_names, decks)
+
+    def with_actions(self, actions_json):
+        return FuzzCase(self.seed, self.player_names, self.deck_codes, actions_json)
+
+    def to_test_case_json(self, final_state_json=None):
+        test_case_json = {
+            "description": "Fuzz case %d" % self.seed,
+            "players": self.player_names,
+            "actions": self.actions_json
+        }
+
+        for current_round in ROUNDS:
+            test_case_json[DECK_KEYS[current_round]] = {"cards": [engine.CARD_JSON_BY_CODE[code] for code in self.deck_codes[current_round]]}
+
+        if final_state_json is not None:
+            test_case_json["final_state"] = final_state_json
+
+        return test_case_json
+
+def generate_case(seed, settings):
+    generator = random.Random(seed)
+
+    player_names = ["player_%d" % (i + 1) for i in range(0, generator.randint(2, 4))]
+    template = engine.standard_deck_codes(engine.DEFAULT_RULES.standard_deck_count(len(player_names)))
+
+    deck_codes = {}
+    for current_round in ROUNDS:
+        codes = list(template)
+        generator.shuffle(codes)
+        deck_codes[current_round] = codes
+
+    case = FuzzCase(seed, player_names, deck_codes, [])
+    game = case.start_game()
+
+    while (len(case.actions_json) < settings["max_actions"]) and (game.round is not None):
+        player = game.players[game.player_iterator.index]
+
+        if generator.random() < settings["near_legal_rate"]:
+            action = near_legal_action(generator, game, player)
+        elif player.can_draw_from_deck and (generator.random() < 0.5):
+            # Working out every legal action runs the lay down solver, and
+            # most turns start with a plain draw anyway
+            action = engine.DrawFromDeckAction(player.name)
+        else:
+            action = generator.choice(policies.legal_actions(game, player))
+
+        action_json = action.to_json()
+        case.actions_json.append(action_json)
+
+        if not apply_action_json(game, action_json):
+            break
+
+    return (case, game)
+
+def apply_action_json(game, action_json):
+    # Mirrors engine.main, which gives up on the first illegal action. Any
+    # other exception is raised as an EngineCrash.
+    try:
+        game.apply_action(engine.Action.from_json(action_json))
+    except engine.IllegalActionError:
+        return False
+    except Exception as e:
+        raise EngineCrash(action_json, e)
+
+    return True
+
+def play_actions(game, actions_json):
+    # How many actions are played before the first illegal one
+    for (index, action_json) in enumerate(actions_json):
+        if not apply_action_json(game, action_json):
+            return index
+
+    return len(actions_json)
+
+def near_legal_action(generator, game, player):
+    # Actions that are almost right, to check that both engines turn down
+    # the same things
+    other_player = generator.choice([other for other in game.players if other is not player])
+    random_card = engine.CARDS_BY_CODE[generator.choice(engine.standard_deck_codes(1))]
+    natural_rank = generator.choice(NATURAL_RANKS)
+    hand = player.hand
+    sample = lambda count: generator.sample(hand, min(count, len(hand)))
+
+    mutations = [
+        lambda: engine.DrawFromDeckAction(other_player.name),
+        lambda: engine.DrawFromDeckAction(player.name),
+        lambda: engine.DiscardCardAction(player.name, random_card),
+        lambda: engine.DiscardCardAction(other_player.name, generator.choice(other_player.hand) if len(other_player.hand) > 0 else random_card),
+        lambda: engine.StartBookAction(player.name, sample(3)),
+        lambda: engine.AddCardsFromHandToBookAction(player.name, sample(1), natural_rank),
+        lambda: engine.DrawFromDiscardPileAndAddToBookAction(player.name, natural_rank),
+        lambda: engine.DrawFromDiscardPileAndStartBookAction(player.name, sample(2)),
+        lambda: engine.LayDownInitialBooksAction(player.name, [sample(3)])
+    ]
+
+    return generator.choice(mutations)()
+
+#
+# Fingerprints
+#
+
+def fingerprint(final_state_json):
+    final_state_json = conditionFinalStateForComparison(json.loads(json.dumps(final_state_json)))
+    canonical_json = json.dumps(final_state_json, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(canonical_json.encode("utf-8"), digest_size=16).hexdigest()
+
+def python_final_state(case):
+    game = case.start_game()
+    play_actions(game, case.actions_json)
+    return game.to_json()
+
+def fingerprint_seeds(chunk):
+    (seeds, settings) = chunk
+    fingerprints = []
+
+    for seed in seeds:
+        try:
+            (case, game) = generate_case(seed, settings)
+        except EngineCrash as e:
+            fingerprints.append({"seed": seed, "crash": str(e)})
+            continue
+
+        fingerprints.append({"seed": seed, "actions": len(case.actions_json), "fingerprint": fingerprint(game.to_json())})
+
+    return fingerprints
+
+def generate(corpus_path, case_count, first_seed, settings, process_count=None, chunk_size=64):
+    seeds = range(first_seed, first_seed + case_count)
+    chunks = [(seeds[start:(start + chunk_size)], settings) for start in range(0, case_count, chunk_size)]
+
+    start_time = time.perf_counter()
+    action_count = 0
+    crashes = []
+
+    with open(corpus_path, "w") as corpus_file:
+        corpus_file.write(json.dumps({"settings": settings}) + "\n")
+
+        with multiprocessing.Pool(process_count) as pool:
+            for fingerprints in pool.imap(fingerprint_seeds, chunks):
+                for entry in fingerprints:
+                    if "crash" in entry:
+                        crashes.append(entry)
+                    else:
+                        action_count += entry["actions"]
+
+                    corpus_file.write(json.dumps(entry) + "\n")
+
+    duration = time.perf_counter() - start_time
+    print("Fingerprinted %d cases (%d actions) in %.1fs: %.0f cases/s, %.0f actions/s" % (case_count, action_count, duration, case_count / duration, action_count / duration))
+
+    for entry in crashes:
+        print("Seed %d crashes the Python engine: %s" % (entry["seed"], entry["crash"]))
+
+def read_corpus(corpus_path):
+    with open(corpus_path, "r") as corpus_file:
+        settings = json.loads(corpus_file.readline())["settings"]
+        entries = [json.loads(line) for line in corpus_file if len(line.strip()) > 0]
+
+    return (settings, entries)
+
+#
+# Other Engines
+#
+
+def run_engine(engine_path, case):
+    # Runs an engine the way test_engine.py does, on a temporary test case
+    (case_fd, case_path) = tempfile.mkstemp(suffix=".json", text=True)
+
+    try:
+        with os.fdopen(case_fd, "w") as case_file:
+            json.dump(case.to_test_case_json(), case_file)
+
+        output = subprocess.check_output("%s %s" % (engine_path, case_path), shell=True, stderr=subprocess.DEVNULL)
+    finally:
+        os.remove(case_path)
+
+    return json.loads(output)
+
+def diverges(engine_path, case):
+    try:
+        return fingerprint(run_engine(engine_path, case)) != fingerprint(python_final_state(case))
+    except (subprocess.CalledProcessError, ValueError):
+        # A crash or unreadable output counts too
+        return True
+
+def python_plays_every_action(case):
+    # Up to the last one, which might be the action the engines disagree on,
+    # and without crashing on that either
+    try:
+        return play_actions(case.start_game(), case.actions_json) >= len(case.actions_json) - 1
+    except EngineCrash:
+        return False
+
+def still_diverges(engine_path, case):
+    return (len(case.actions_json) > 0) and python_plays_every_action(case) and diverges(engine_path, case)
+
+#
+# Minimizing
+#
+
+# Deleting single actions almost never works: it leaves a turn half played, or
+# a later player drawing different cards and then discarding one they don't
+# have. So after cutting the case down to the shortest run of actions that
+# still disagrees, whole rounds of turns are deleted, one turn for each player
+# so the same player is up afterwards, with the cards they drew moved to the
+# bottom of the deck so every later draw gets the same cards. Single actions,
+# like a near-legal one that happened to be legal, go last.
+
+def split_turns(actions_json):
+    turns = []
+
+    for action_json in actions_json:
+        if (len(turns) == 0) or (turns[-1][-1]["player"] != action_json["player"]):
+            turns.append([])
+
+        turns[-1].append(action_json)
+
+    return turns
+
+def deck_draws(case):
+    # The round and positions in that round's deck each action drew from, or
+    # None for an action that did anything else to the deck, like starting a
+    # round or reshuffling the discard pile into it
+    game = case.start_game()
+    draws = []
+
+    for action_json in case.actions_json:
+        current_round = game.round
+        reshuffle_count = game.reshuffle_count
+        card_count = game.deck.card_count if current_round is not None else 0
+
+        apply_action_json(game, action_json)
+
+        if (current_round is not None) and (game.round is current_round) and (game.reshuffle_count == reshuffle_count):
+            draws.append((current_round, range(game.deck.card_count, card_count)))
+        else:
+            draws.append(None)
+
+    return draws
+
+def without_turns(case, turns, start, count):
+    first_index = sum(len(turn) for turn in turns[:start])
+    end_index = first_index + sum(len(turn) for turn in turns[start:(start + count)])
+
+    drawn_positions = {}
+    for draw in deck_draws(case)[first_index:end_index]:
+        if draw is None:
+            return None
+
+        (current_round, positions) = draw
+        drawn_positions.setdefault(current_round, set()).update(positions)
+
+    # Cards are drawn off the end of the deck, so moving these to the front
+    # leaves the rest in the same order
+    deck_codes = dict(case.deck_codes)
+    for (current_round, positions) in drawn_positions.items():
+        codes = case.deck_codes[current_round]
+        deck_codes[current_round] = [codes[i] for i in sorted(positions)] + [code for (i, code) in enumerate(codes) if i not in positions]
+
+    return FuzzCase(case.seed, case.player_names, deck_codes, case.actions_json[:first_index] + case.actions_json[end_index:])
+
+def minimize(engine_path, case):
+    actions_json = case.actions_json
+
+    # The shortest run of actions that still disagrees
+    low = 0
+    high = len(actions_json)
+    while low < high:
+        middle = (low + high) // 2
+        if diverges(engine_path, case.with_actions(actions_json[:middle])):
+            high = middle
+        else:
+            low = middle + 1
+
+    case = case.with_actions(actions_json[:high])
+
+    # Then whole rounds of turns, biggest spans first, never the last turn
+    player_count = len(case.player_names)
+    turns = split_turns(case.actions_json)
+    turn_chunk_size = max(1, len(turns) // (2 * player_count)) * player_count
+    while turn_chunk_size > 0:
+        start = 0
+        while start + turn_chunk_size < len(turns):
+            candidate = without_turns(case, turns, start, turn_chunk_size)
+
+            if (candidate is not None) and still_diverges(engine_path, candidate):
+                case = candidate
+                turns = split_turns(case.actions_json)
+            else:
+                start += 1
+
+        turn_chunk_size = (turn_chunk_size // (2 * player_count)) * player_count
+
+    # Then whatever single actions it can do without
+    actions_json = case.actions_json
+    chunk_size = max(1, len(actions_json) // 2)
+    while chunk_size > 0:
+        start = 0
+        while start < len(actions_json) - 1:
+            candidate = case.with_actions(actions_json[:start] + actions_json[(start + chunk_size):])
+
+            if still_diverges(engine_path, candidate):
+                actions_json = candidate.actions_json
+            else:
+                start += chunk_size
+
+        chunk_size //= 2
+
+    return case.with_actions(actions_json)
+
+#
+# Checking
+#
+
+def check(engine_path, corpus_path, reproducer_dir=None):
+    (settings, entries) = read_corpus(corpus_path)
+    divergent_seeds = []
+    crashed_seeds = []
+
+    for entry in entries:
+        try:
+            (case, game) = generate_case(entry["seed"], settings)
+        except EngineCrash as e:
+            print("Seed %d crashes the Python engine: %s" % (entry["seed"], e))
+            crashed_seeds.append(entry["seed"])
+            continue
+
+        if "crash" in entry:
+            print("Seed %d no longer crashes the Python engine" % entry["seed"])
+            divergent_seeds.append(entry["seed"])
+            continue
+
+        if fingerprint(game.to_json()) != entry["fingerprint"]:
+            print("Seed %d no longer matches its fingerprint in the Python engine" % entry["seed"])
+            divergent_seeds.append(entry["seed"])
+            continue
+
+        if not diverges(engine_path, case):
+            continue
+
+        divergent_seeds.append(entry["seed"])
+        reproducer = minimize(engine_path, case)
+        print("Seed %d diverges, minimized from %d to %d actions" % (entry["seed"], len(case.actions_json), len(reproducer.actions_json)))
+
+        if reproducer_dir is not None:
+            os.makedirs(reproducer_dir, exist_ok=True)
+            reproducer_path = os.path.join(reproducer_dir, "fuzz_%d.json" % entry["seed"])
+
+            with open(reproducer_path, "w") as reproducer_file:
+                json.dump(reproducer.to_test_case_json(python_final_state(reproducer)), reproducer_file, indent=4)
+
+    print("Diverged on %d of %d cases, and the Python engine crashed on %d" % (len(divergent_seeds), len(entries), len(crashed_seeds)))
+
+def export(corpus_path, case_dir):
+    (settings, entries) = read_corpus(corpus_path)
+    os.makedirs(case_dir, exist_ok=True)
+
+    for entry in entries:
+        if "crash" in entry:
+            continue
+
+        (case, game) = generate_case(entry["seed"], settings)
+
+        with open(os.path.join(case_dir, "fuzz_%d.json" % entry["seed"]), "w") as case_file:
+            json.dump(case.to_test_case_json(game.to_json()), case_file)
+
+    print("Exported %d cases to %s" % (len(entries), case_dir))
+
+#
+# Main
+#
+
+def printUsageAndExit():
+    fileName = os.path.split(__file__)[1]
+
+    print("Usage:")
+    print("    python %s generate <CORPUS_PATH> [<CASES>] [<FIRST_SEED>] [<MAX_ACTIONS>]" % fileName)
+    print("    python %s export <CORPUS_PATH> <CASE_DIR>" % fileName)
+    print("    python %s check <ENGINE PATH> <CORPUS_PATH> [<REPRODUCER_DIR>]" % fileName)
+
+    sys.exit(1)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        printUsageAndExit()
+
+    command = sys.argv[1]
+
+    if command == "generate":
+        case_count = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+        first_seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+        settings = dict(DEFAULT_SETTINGS)
+        if len(sys.argv) > 5:
+            settings["max_actions"] = int(sys.argv[5])
+
+        generate(sys.argv[2], case_count, first_seed, settings)
+    elif command == "export" and len(sys.argv) > 3:
+        export(sys.argv[2], sys.argv[3])
+    elif command == "check" and len(sys.argv) > 3:
+        check(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
+    else:
+        printUsageAndExit()
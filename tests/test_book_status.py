@@ -0,0 +1,97 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import engine
+
+import fuzz_engine
+
+from test_state_hash import test_case_game
+from test_state_hash import test_case_paths
+
+"""
+Checks the incremental book statuses
+
+Each player's BookStatus is kept up to date as cards are added to their
+books, rather than worked out from the books whenever going out is checked.
+This plays every test case, and some random games made the same way as fuzz
+cases, with every status built before the first action, and after each action
+compares them with statuses rebuilt from the books.
+
+    python test_book_status.py [<RANDOM_GAME_COUNT>] [<TEST_CASE_PATH | TEST_CASE_DIR> ...]
+
+With no test cases given, the ones next to this script are used.
+"""
+
+DEFAULT_RANDOM_GAME_COUNT = 50
+
+def status_json(status):
+    status_json = status.to_json()
+    status_json["book_states"] = {rank.value: state for (rank, state) in status.book_states.items()}
+    return status_json
+
+def statuses_match(game):
+    for player in game.players:
+        for current_round in fuzz_engine.ROUNDS:
+            rebuilt_status = engine.BookStatus.from_books(player.books[current_round])
+            if status_json(player.book_status(current_round)) != status_json(rebuilt_status):
+                return False
+
+    return True
+
+def first_mismatch(game, actions_json):
+    # The index of the first action after which the statuses differ, or None
+    # if they always agree. Building every status first means all of them are
+    # updated as the game goes, not only the ones going out has needed.
+    for player in game.players:
+        for current_round in fuzz_engine.ROUNDS:
+            player.book_status(current_round)
+
+    for (index, action_json) in enumerate(actions_json):
+        if not fuzz_engine.apply_action_json(game, action_json):
+            break
+
+        if not statuses_match(game):
+            return index
+
+    return None
+
+def check_test_case(test_case_path):
+    with open(test_case_path, "r") as test_case_file:
+        test_case = json.load(test_case_file)
+
+    return first_mismatch(test_case_game(test_case), test_case["actions"])
+
+def check_random_game(seed):
+    (case, _) = fuzz_engine.generate_case(seed, fuzz_engine.DEFAULT_SETTINGS)
+    return first_mismatch(case.start_game(), case.actions_json)
+
+def main(random_game_count, paths):
+    results = []
+
+    for test_case_path in test_case_paths(paths):
+        results.append((test_case_path, check_test_case(test_case_path)))
+
+    for seed in range(0, random_game_count):
+        results.append(("Random game %d" % seed, check_random_game(seed)))
+
+    failed_tests = [result for result in results if result[1] is not None]
+
+    plural = "" if len(results) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(results), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, index) in failed_tests:
+            print("\t%s (statuses differ after action %d)" % (name, index))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    random_game_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RANDOM_GAME_COUNT
+    paths = sys.argv[2:] if len(sys.argv) > 2 else [os.path.dirname(os.path.abspath(__file__))]
+
+    main(random_game_count, paths)
@@ -0,0 +1,224 @@
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import app
+import cold_storage
+import compaction
+import engine_pool
+import models
+
+from models import User
+from models import Game
+from models import GameSnapshot
+from models import GameArchive
+
+from test_compaction import use_scratch_database
+from test_compaction import create_game
+from test_compaction import play_until
+from test_compaction import needs_compaction
+from test_compaction import loaded_state_hash
+from test_compaction import replayed_state_hash
+
+"""
+Checks cold storage on a scratch database
+
+Games are played out and archived like in test_compaction.py, then moved
+into archive files in a scratch directory. The stubs they leave behind have
+to sync the same as the games did, rehydrate to the same state, and go back
+to being stubs without being written out again. Run it from the backend
+directory like the app, since models reads secrets.yaml:
+
+    python ../tests/test_cold_storage.py
+"""
+
+LONG_AGO = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+AN_HOUR = 3600
+
+class Fixture(object):
+
+    def __init__(self):
+        use_scratch_database()
+        cold_storage.db = models.db
+
+        self.storage = cold_storage.ColdStorage(tempfile.mkdtemp())
+        app.cold_store = self.storage
+
+        self.game_ids = [archived_game("cold-%d" % i) for i in range(0, 2)]
+        self.user = User.get(User.email == "cold-0-0@handandfoot")
+
+        # Everything the games come to before they're stubbed
+        self.state_hashes = {game_id: loaded_state_hash(game_id) for game_id in self.game_ids}
+        self.records = {game_id: record_file_json(cold_storage.game_record(Game.get_by_id(game_id))) for game_id in self.game_ids}
+        self.sync_json = sync_json(self.user)
+        self.view_hashes = view_hashes(self.user)
+
+    @property
+    def file_names(self):
+        return sorted(os.listdir(self.storage.directory))
+
+def archived_game(title):
+    # Compacted as each round ends, and archived once the last one has
+    game_id = create_game(title)
+
+    while True:
+        game = play_until(game_id, needs_compaction)
+        compaction.compact_game(game)
+
+        if game.finished:
+            return game_id
+
+def record_file_json(record):
+    # Dates are written out as strings
+    return json.loads(json.dumps(record, default=str))
+
+def sync_json(user):
+    # As the client would see it, with cached fragments spliced in
+    (sync_json, view_logs) = app.load_sync(user, LONG_AGO, False)
+    sync_json = json.loads(app.response_encoder.encode(sync_json))
+
+    return {
+        "actions": sorted(sync_json["actions"], key=lambda action_json: action_json["id"]),
+        "initial_states": sorted([(game_json["id"], game_json["initial_state"]) for game_json in sync_json["games"]])
+    }
+
+def view_hashes(user):
+    (sync_json, view_logs) = app.load_sync(user, LONG_AGO, True)
+    return {game_id: engine_pool.replay_game(game_log).game.state_hash for (game_id, game_log) in view_logs.items()}
+
+def hot_row_counts(game_id):
+    return (GameSnapshot.select().where(GameSnapshot.game == game_id).count(), GameArchive.select().where(GameArchive.game == game_id).count())
+
+def assert_cold_storage_error(load, message):
+    try:
+        load()
+    except cold_storage.ColdStorageError:
+        pass
+    else:
+        raise AssertionError(message)
+
+#
+# Tests
+#
+
+def check_moving_games(fixture):
+    ready_ids = [game.id for game in cold_storage.games_ready_for_cold_storage(0)]
+    assert ready_ids == fixture.game_ids, "Ready to move %r" % ready_ids
+
+    moved_count = cold_storage.move_games_to_cold_storage(fixture.storage, cold_storage.games_ready_for_cold_storage(0))
+    assert moved_count == len(fixture.game_ids), "Moved %d games" % moved_count
+    assert len(fixture.file_names) == 1, "Wrote %r" % fixture.file_names
+
+    for game_id in fixture.game_ids:
+        game = Game.get_by_id(game_id)
+        assert game.in_cold_storage and (game.initial_state == ""), "Game %d wasn't stubbed" % game_id
+        assert game.cold_archive == fixture.file_names[0], "Game %d points at %r" % (game_id, game.cold_archive)
+        assert hot_row_counts(game_id) == (0, 0), "Game %d left hot rows behind" % game_id
+        assert fixture.storage.load_record(game) == fixture.records[game_id], "Game %d came back differently" % game_id
+
+    assert len(list(cold_storage.games_ready_for_cold_storage(0))) == 0, "Stubs are still ready to move"
+
+def check_syncing_stubs(fixture):
+    assert sync_json(fixture.user) == fixture.sync_json, "Stubs sync differently"
+    assert view_hashes(fixture.user) == fixture.view_hashes, "Stubs project different views"
+
+def check_rehydrating(fixture):
+    game = Game.get_by_id(fixture.game_ids[0])
+    cold_storage.rehydrate_game(game, fixture.storage)
+
+    game = Game.get_by_id(fixture.game_ids[0])
+    assert not game.in_cold_storage and (game.rehydrated is not None), "Game wasn't rehydrated"
+    assert hot_row_counts(game.id) == (1, 1), "Rehydrated %r hot rows" % (hot_row_counts(game.id),)
+    assert loaded_state_hash(game.id) == fixture.state_hashes[game.id], "Rehydrated game loads differently"
+    assert replayed_state_hash(game.id) == fixture.state_hashes[game.id], "Rehydrated game replays differently"
+
+    # A sync with one game hot and one cold is still the same
+    assert sync_json(fixture.user) == fixture.sync_json, "Rehydrated game syncs differently"
+
+def check_restubbing(fixture):
+    # The games finished a while ago, but one was only just rehydrated
+    two_hours_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=(2 * AN_HOUR))
+    Game.update(last_updated=two_hours_ago).where(Game.id.in_(fixture.game_ids)).execute()
+
+    game = Game.get_by_id(fixture.game_ids[0])
+    assert len(list(cold_storage.games_ready_for_cold_storage(AN_HOUR))) == 0, "Moved a game that was just rehydrated"
+
+    Game.update(rehydrated=two_hours_ago).where(Game.id == game.id).execute()
+    file_names = fixture.file_names
+
+    moved_count = cold_storage.move_games_to_cold_storage(fixture.storage, cold_storage.games_ready_for_cold_storage(AN_HOUR))
+    assert moved_count == 1, "Moved %d games" % moved_count
+    assert fixture.file_names == file_names, "Wrote the game out again"
+
+    game = Game.get_by_id(game.id)
+    assert game.in_cold_storage and (game.cold_archive == file_names[0]), "Game wasn't stubbed again"
+    assert hot_row_counts(game.id) == (0, 0), "Game left hot rows behind"
+    assert sync_json(fixture.user) == fixture.sync_json, "Stubbed again, it syncs differently"
+
+def check_errors(fixture):
+    game = Game.get_by_id(fixture.game_ids[0])
+    name = game.cold_archive
+
+    # Not in cold storage at all
+    hot_game = Game.get_by_id(archived_game("hot"))
+    assert_cold_storage_error(lambda: fixture.storage.load_record(hot_game), "Loaded a game that isn't in cold storage")
+
+    # Not archived yet, so there's nothing to write out
+    unarchived_game = Game.get_by_id(create_game("unarchived"))
+    assert_cold_storage_error(lambda: cold_storage.game_record(unarchived_game), "Made a record of a game that isn't archived")
+    assert cold_storage.move_games_to_cold_storage(fixture.storage, [unarchived_game]) == 0, "Stubbed a game that isn't archived"
+    assert not Game.get_by_id(unarchived_game.id).in_cold_storage, "Stubbed a game that isn't archived"
+
+    # In a file that isn't there, with storage that hasn't opened it yet
+    moved_directory = tempfile.mkdtemp()
+    shutil.copy(os.path.join(fixture.storage.directory, name), moved_directory)
+    moved_storage = cold_storage.ColdStorage(moved_directory)
+    os.remove(os.path.join(moved_directory, name))
+
+    assert_cold_storage_error(lambda: moved_storage.load_record(game), "Loaded a game from a missing file")
+    assert_cold_storage_error(lambda: cold_storage.rehydrate_game(game, moved_storage), "Rehydrated a game from a missing file")
+
+    game = Game.get_by_id(game.id)
+    assert game.in_cold_storage and (hot_row_counts(game.id) == (0, 0)), "Failing to rehydrate changed the game"
+
+    # Missing from the file it points at
+    hot_game.cold_archive = name
+    assert_cold_storage_error(lambda: fixture.storage.load_record(hot_game), "Loaded a game missing from its file")
+
+TESTS = [
+    ("Moving games", check_moving_games),
+    ("Syncing stubs", check_syncing_stubs),
+    ("Rehydrating", check_rehydrating),
+    ("Stubbing again", check_restubbing),
+    ("Errors", check_errors)
+]
+
+def main():
+    fixture = Fixture()
+    failed_tests = []
+
+    # Each test carries on from where the last one left the games
+    for (name, test) in TESTS:
+        try:
+            test(fixture)
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
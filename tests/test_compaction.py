@@ -0,0 +1,248 @@
+import os
+import sys
+
+import peewee
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import compaction
+import engine
+import models
+import policies
+
+from models import User
+from models import UserGame
+from models import UserRole
+from models import Game
+from models import Action
+from models import GameSnapshot
+from models import GameArchive
+
+"""
+Checks compaction on a scratch database
+
+Games are played out with the greedy bot on a scratch SQLite database, so
+the real one is never touched, and compacted as their rounds end. Whatever
+compaction leaves behind, a snapshot or an archive, has to load to the same
+state as replaying every action from the initial state, and a log with a
+wrong hash, a gap or unnumbered actions has to be turned down without
+changing anything. Run it from the backend directory like the app, since
+models reads secrets.yaml:
+
+    python ../tests/test_compaction.py
+"""
+
+MODELS = [User, models.UserSearchTerm, Game, UserGame, Action, GameSnapshot, GameArchive, models.Tournament, models.TournamentEntrant, models.TournamentTable]
+
+# Small hands and no points needed to lay down, so games are over quickly
+RULES = engine.RuleSet.from_json({
+    "hand_size": 5,
+    "foot_size": 5,
+    "points_needed": {current_round.value: 0 for current_round in engine.Round}
+})
+
+def use_scratch_database():
+    database = peewee.SqliteDatabase(":memory:")
+    database.bind(MODELS)
+    models.db = database
+    compaction.db = database
+    database.create_tables(MODELS)
+
+def create_game(title):
+    users = [User.create("%s-%d@handandfoot" % (title, i), "Player", str(i), "password") for i in range(0, 2)]
+    game = Game.create(title, users, RULES)
+
+    for (i, user) in enumerate(users):
+        UserGame.create(user, game, UserRole.OWNER if i == 0 else UserRole.PLAYER)
+
+    UserGame.update(user_accepted=True).where(UserGame.game == game).execute()
+    return game.id
+
+def play_until(game_id, done):
+    # Plays greedy moves until done(game) or the game is over, and returns
+    # the game as it was last saved
+    policy = policies.GreedyPolicy()
+
+    while True:
+        game = Game.get_by_id(game_id)
+        if game.finished or done(game):
+            return game
+
+        game.load_state()
+        player = game.game_engine.current_player
+        action = policy.choose_action(game.game_engine.game, player)
+        game.add_action_for_user(User.get(User.email == player.name), action.to_json())
+
+def needs_compaction(game):
+    return (game.round_end_sequence > game.compacted_sequence)
+
+def replayed_state_hash(game_id):
+    # Every action in order from the initial state, without any snapshots
+    game = Game.get_by_id(game_id)
+    game.load_initial_state()
+
+    if game.archived:
+        for action in GameArchive.get(GameArchive.game == game).load_actions():
+            game.apply_action(action)
+    else:
+        game.load_actions()
+
+    return game.game_engine.game.state_hash
+
+def loaded_state_hash(game_id):
+    game = Game.get_by_id(game_id)
+    game.load_state()
+    return game.game_engine.game.state_hash
+
+def snapshot_count(game_id):
+    return GameSnapshot.select().where(GameSnapshot.game == game_id).count()
+
+def assert_refused(game_id):
+    game = Game.get_by_id(game_id)
+    (compacted_sequence, snapshots) = (game.compacted_sequence, snapshot_count(game_id))
+
+    try:
+        compaction.compact_game(game)
+    except compaction.CompactionError:
+        pass
+    else:
+        raise AssertionError("Compacted a broken log")
+
+    game = Game.get_by_id(game_id)
+    assert (game.compacted_sequence, snapshot_count(game_id)) == (compacted_sequence, snapshots), "Changed the game while refusing it"
+
+#
+# Tests
+#
+
+def check_every_round():
+    game_id = create_game("rounds")
+    compacted_round_count = 0
+
+    while True:
+        game = play_until(game_id, needs_compaction)
+        if not needs_compaction(game):
+            break
+
+        replayed_hash = replayed_state_hash(game_id)
+        assert game.id in [pending.id for pending in compaction.games_needing_compaction()], "Not pending at %d" % game.round_end_sequence
+
+        compaction.compact_game(game, archive_finished_games=False)
+        compacted_round_count += 1
+
+        snapshot = Game.get_by_id(game_id).latest_snapshot
+        assert snapshot.sequence == game.round_end_sequence, "Snapshot at %d instead of %d" % (snapshot.sequence, game.round_end_sequence)
+        assert loaded_state_hash(game_id) == replayed_hash, "Snapshot at %d loads differently" % snapshot.sequence
+        assert game.id not in [pending.id for pending in compaction.games_needing_compaction()], "Still pending at %d" % snapshot.sequence
+
+        # Nothing new to compact, so nothing changes
+        snapshots = snapshot_count(game_id)
+        compaction.compact_game(Game.get_by_id(game_id), archive_finished_games=False)
+        assert snapshot_count(game_id) == snapshots, "Compacted the same round twice"
+
+    assert game.finished, "Game didn't finish"
+    assert compacted_round_count == len(engine.Round), "Compacted %d rounds" % compacted_round_count
+    assert loaded_state_hash(game_id) == replayed_state_hash(game_id), "Finished game loads differently"
+
+def check_archiving():
+    game_id = create_game("archive")
+
+    # Earlier rounds are compacted as they end, so the game is only archived
+    # once its last round is
+    while True:
+        game = play_until(game_id, needs_compaction)
+        if game.finished:
+            break
+
+        compaction.compact_game(game)
+        assert not Game.get_by_id(game_id).archived, "Archived before it finished"
+
+    action_count = game.action_count
+    hashes = [action.state_hash for action in game.actions]
+    replayed_hash = replayed_state_hash(game_id)
+
+    compaction.compact_game(game)
+
+    game = Game.get_by_id(game_id)
+    assert game.archived, "Finished game wasn't archived"
+    assert Action.select().where(Action.game == game_id).count() == 0, "Hot actions left behind"
+
+    archived_actions = GameArchive.get(GameArchive.game == game_id).load_actions()
+    assert [action.sequence for action in archived_actions] == list(range(1, action_count + 1)), "Archive out of order"
+    assert [action.state_hash for action in archived_actions] == hashes, "Archive hashes differ"
+
+    assert loaded_state_hash(game_id) == replayed_hash, "Archived game loads differently"
+    assert replayed_state_hash(game_id) == replayed_hash, "Archive replays differently"
+
+def check_wrong_state_hash():
+    game_id = create_game("hash")
+    game = play_until(game_id, needs_compaction)
+
+    action = game.actions_after(game.round_end_sequence // 2).first()
+    action.state_hash = engine.state_hash_string(0)
+    action.save()
+
+    assert_refused(game_id)
+
+def check_missing_action():
+    game_id = create_game("gap")
+    game = play_until(game_id, needs_compaction)
+
+    Action.delete().where((Action.game == game_id) & (Action.sequence == game.round_end_sequence // 2)).execute()
+
+    assert_refused(game_id)
+
+def check_unnumbered_actions():
+    # Actions from before the event log are refused until they're numbered,
+    # which has to give them the same numbers and hashes they'd have had
+    game_id = create_game("unnumbered")
+    game = play_until(game_id, needs_compaction)
+
+    numbered = [(action.id, action.sequence, action.state_hash) for action in game.actions]
+    round_end_sequence = game.round_end_sequence
+
+    Action.update(sequence=None, state_hash=None).where(Action.game == game_id).execute()
+    Game.update(action_count=0, round_end_sequence=0).where(Game.id == game_id).execute()
+
+    assert_refused(game_id)
+
+    compaction.assign_action_sequences(Game.get_by_id(game_id))
+
+    game = Game.get_by_id(game_id)
+    assert [(action.id, action.sequence, action.state_hash) for action in game.actions] == numbered, "Numbered differently"
+    assert (game.action_count, game.round_end_sequence) == (len(numbered), round_end_sequence), "Game counts differ"
+
+    compaction.compact_game(game)
+    assert loaded_state_hash(game_id) == replayed_state_hash(game_id), "Numbered game loads differently"
+
+TESTS = [
+    ("Compacting every round", check_every_round),
+    ("Archiving a finished game", check_archiving),
+    ("Wrong state hash", check_wrong_state_hash),
+    ("Missing action", check_missing_action),
+    ("Unnumbered actions", check_unnumbered_actions)
+]
+
+def main():
+    use_scratch_database()
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        try:
+            test()
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
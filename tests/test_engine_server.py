@@ -0,0 +1,163 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import engine_server
+
+"""
+Checks the engine server
+
+Requests go through EngineServer.handle_line, the same as lines read from
+stdin, so every response is checked the way a client would see it.
+
+    python test_engine_server.py
+"""
+
+def send(server, request):
+    line = request if type(request) is str else json.dumps(request)
+    return json.loads(server.encoder.encode(server.handle_line(line)))
+
+def new_game(server, game_id, players=["a", "b"]):
+    response = send(server, {"command": "new_game", "game": game_id, "players": players})
+    assert response["success"], "Couldn't start %s: %r" % (game_id, response)
+    return response
+
+def game_state(server, game_id):
+    response = send(server, {"command": "state", "game": game_id})
+    assert response["success"], "Couldn't read %s: %r" % (game_id, response)
+    return response
+
+def draw(player):
+    return {"type": "draw_from_deck", "player": player}
+
+#
+# Tests
+#
+
+def check_malformed_requests():
+    server = engine_server.EngineServer()
+    new_game(server, "g")
+
+    requests = [
+        "not json",
+        "[1, 2]",
+        {"id": 1, "command": "shuffle"},
+        {"id": 2, "command": "state"},
+        {"id": 3, "command": "state", "game": "missing"},
+        {"id": 4, "command": "new_game", "game": "k", "players": ["a"]},
+        {"id": 5, "command": "new_game", "game": "k", "players": "ab"},
+        {"id": 6, "command": "new_game", "game": "k", "players": ["a", "b"], "initial_state": 5},
+        {"id": 7, "command": "new_game", "game": "k", "players": ["a", "b"], "initial_state": {"decks": 5}},
+        {"id": 8, "command": "new_game", "game": "k", "players": ["a", "b"], "snapshot": {"rules": []}},
+        {"id": 9, "command": "new_game", "game": "k", "players": ["a", "b"], "rules": {"hand_size": -1}},
+        {"id": 10, "command": "apply_action", "game": "g", "action": 5},
+        {"id": 11, "command": "apply_action", "game": "g", "actions": [{"type": "fly", "player": "a"}]},
+        {"id": 12, "command": "state", "game": "g", "viewer": "nobody"},
+        {"id": 13, "command": "run_test_case", "test_case": {"players": []}}
+    ]
+
+    for request in requests:
+        response = send(server, request)
+        assert response["success"] is False, "%r succeeded" % (request,)
+        assert type(response["message"]) is str, "%r has no message" % (request,)
+
+        expected_id = request.get("id") if type(request) is dict else None
+        assert response["id"] == expected_id, "%r answered as %r" % (request, response["id"])
+
+    # None of that broke the server or made a game
+    assert list(server.games.keys()) == ["g"], "Games %r" % list(server.games.keys())
+    assert game_state(server, "g")["action_count"] == 0, "Game changed"
+
+def check_illegal_action():
+    server = engine_server.EngineServer()
+    new_game(server, "g")
+    send(server, {"command": "apply_action", "game": "g", "action": draw("a")})
+    before = game_state(server, "g")
+
+    bad_actions = [
+        draw("b"),
+        {"type": "discard_card", "player": "a", "card": {"suit": "hearts", "rank": "two"}},
+        {"type": "start_book", "player": "a", "cards": []},
+        {"type": "draw_from_deck"}
+    ]
+
+    for action in bad_actions:
+        response = send(server, {"command": "apply_action", "game": "g", "action": action})
+        assert response["success"] is False, "%r was applied" % action
+
+        after = game_state(server, "g")
+        assert (after["state_hash"], after["action_count"]) == (before["state_hash"], before["action_count"]), "%r changed the game" % action
+        assert after["state"] == before["state"], "%r changed the state" % action
+
+    # The game carries on from where it was
+    response = send(server, {"command": "apply_action", "game": "g", "action": draw("a")})
+    assert response["success"] and (response["action_count"] == 2), "Couldn't carry on: %r" % response
+
+def check_actions_stop_at_first_bad_one():
+    server = engine_server.EngineServer()
+    new_game(server, "g")
+
+    response = send(server, {"command": "apply_action", "game": "g", "actions": [draw("a"), draw("a"), draw("a"), draw("b")]})
+    assert (response["success"] is False) and response["message"].startswith("Illegal action 2"), "Response %r" % response
+
+    # The actions before it stay applied, and none after it are
+    after = game_state(server, "g")
+    assert after["action_count"] == 2, "%d actions applied" % after["action_count"]
+
+    replayed = engine_server.EngineServer()
+    replayed_response = send(replayed, {"command": "new_game", "game": "g", "players": ["a", "b"], "initial_state": server.games["g"].initial_state})
+    assert replayed_response["success"], "Couldn't replay: %r" % replayed_response
+    replayed_response = send(replayed, {"command": "apply_action", "game": "g", "actions": [draw("a"), draw("a")]})
+    assert replayed_response["state_hash"] == after["state_hash"], "State differs from the first two actions alone"
+
+def check_least_recently_used():
+    server = engine_server.EngineServer(max_games=2)
+    new_game(server, "g1")
+    new_game(server, "g2")
+
+    # Reading g1 makes g2 the least recently used, so g3 pushes it out
+    game_state(server, "g1")
+    new_game(server, "g3")
+
+    assert sorted(server.games.keys()) == ["g1", "g3"], "Kept %r" % sorted(server.games.keys())
+    assert send(server, {"command": "state", "game": "g2"})["message"] == "Unknown game", "g2 still answers"
+
+    # Starting a game again under the same ID replaces it
+    new_game(server, "g1", ["c", "d"])
+    assert sorted(server.games.keys()) == ["g1", "g3"], "Kept %r" % sorted(server.games.keys())
+    assert game_state(server, "g1")["current_player"] == "c", "g1 wasn't replaced"
+
+    response = send(server, {"command": "drop_game", "game": "g3"})
+    assert response["dropped"] and (list(server.games.keys()) == ["g1"]), "g3 wasn't dropped"
+
+TESTS = [
+    ("Malformed requests", check_malformed_requests),
+    ("Illegal action", check_illegal_action),
+    ("Actions stop at the first bad one", check_actions_stop_at_first_bad_one),
+    ("Least recently used games", check_least_recently_used)
+]
+
+def main():
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        try:
+            test()
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import http_caching
+
+"""
+Checks content coding negotiation and entity tags
+
+Negotiation is checked both with and without brotli installed, by taking it
+away from the compressor when it is.
+
+    python test_http_caching.py
+"""
+
+#
+# Tests
+#
+
+def check_parse_accept_encoding():
+    cases = [
+        (None, {}),
+        ("", {}),
+        ("gzip", {"gzip": 1.0}),
+        ("gzip, deflate;q=0.5, br", {"gzip": 1.0, "deflate": 0.5, "br": 1.0}),
+        (" GZIP ; Q=0.3 ,br;q=0", {"gzip": 0.3, "br": 0.0}),
+        ("gzip;q=oops, *;q=0.1", {"gzip": 0.0, "*": 0.1}),
+        ("identity;level=1, ,", {"identity": 1.0})
+    ]
+
+    for (accept_encoding, qualities) in cases:
+        actual_qualities = http_caching.parse_accept_encoding(accept_encoding)
+        assert actual_qualities == qualities, "%r parsed as %r" % (accept_encoding, actual_qualities)
+
+def check_negotiate():
+    compressor = http_caching.Compressor()
+    compressor.codings = ["gzip"]
+
+    cases = [
+        (None, None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("br", None),
+        ("gzip;q=0", None),
+        ("*", "gzip"),
+        ("*;q=0.5, gzip;q=0", None)
+    ]
+
+    for (accept_encoding, coding) in cases:
+        assert compressor.negotiate(accept_encoding) == coding, "%r without brotli" % accept_encoding
+
+    # Ours is preferred on a tie, and the client's preference otherwise
+    compressor.codings = ["br", "gzip"]
+
+    cases = [
+        ("gzip, br", "br"),
+        ("*", "br"),
+        ("gzip;q=1, br;q=0.5", "gzip"),
+        ("br;q=0, *", "gzip"),
+        ("deflate", None)
+    ]
+
+    for (accept_encoding, coding) in cases:
+        assert compressor.negotiate(accept_encoding) == coding, "%r with brotli" % accept_encoding
+
+def check_compress():
+    compressor = http_caching.Compressor(min_bytes=100)
+    body = b'{"actions":[' + b",".join([b'{"type":"draw_from_deck","player":"a@b.c"}'] * 50) + b"]}"
+
+    assert not compressor.should_compress(body[:99]), "Compressed a small body"
+    assert compressor.should_compress(body[:100]), "Didn't compress a body at the limit"
+
+    # The same body always compresses to the same bytes, so it can be cached
+    compressed_body = compressor.compress(body, "gzip")
+    assert compressed_body == compressor.compress(body, "gzip"), "gzip isn't deterministic"
+    assert gzip.decompress(compressed_body) == body, "gzip doesn't round trip"
+    assert len(compressed_body) < len(body), "gzip made the body bigger"
+
+    if http_caching.brotli is not None:
+        assert http_caching.brotli.decompress(compressor.compress(body, "br")) == body, "Brotli doesn't round trip"
+
+    try:
+        compressor.compress(body, "deflate")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Compressed with an unknown coding")
+
+def check_entity_tags():
+    etag = http_caching.entity_tag(12, 3, "2026-01-01 00:00:00")
+
+    assert etag == http_caching.entity_tag(12, 3, "2026-01-01 00:00:00"), "Same versions, different tags"
+    assert (etag[0], etag[-1]) == ('"', '"'), "Tag %r isn't quoted" % etag
+
+    # Versions are kept apart, and their types count
+    different_versions = [(12, 4, "2026-01-01 00:00:00"), (123, "", "2026-01-01 00:00:00"), ("12", 3, "2026-01-01 00:00:00"), (12, 3)]
+    for versions in different_versions:
+        assert http_caching.entity_tag(*versions) != etag, "%r has the same tag" % (versions,)
+
+    for coding in ["gzip", "br"]:
+        coded_etag = http_caching.coded_entity_tag(etag, coding)
+        assert coded_etag == etag[:-1] + "-" + coding + '"', "Coded tag %r" % coded_etag
+        assert http_caching.uncoded_entity_tag(coded_etag[1:-1]) == etag[1:-1], "%r doesn't uncode" % coded_etag
+
+    # Tags that only look coded are left alone
+    for unquoted_etag in ["abc-deflate", "-gzip", "abc"]:
+        assert http_caching.uncoded_entity_tag(unquoted_etag) == unquoted_etag, "%r was uncoded" % unquoted_etag
+
+def check_entity_tag_matches():
+    etag = http_caching.entity_tag(1, 2)
+    other_etag = http_caching.entity_tag(1, 3)
+
+    cases = [
+        (None, False),
+        ("", False),
+        ("*", True),
+        (etag, True),
+        ("W/" + etag, True),
+        (http_caching.coded_entity_tag(etag, "gzip"), True),
+        ("W/" + http_caching.coded_entity_tag(etag, "br"), True),
+        (other_etag + ", " + etag, True),
+        (other_etag, False),
+        (http_caching.coded_entity_tag(other_etag, "gzip"), False),
+        (etag[:-1] + "-deflate" + '"', False)
+    ]
+
+    for (if_none_match, matches) in cases:
+        assert http_caching.entity_tag_matches(if_none_match, etag) == matches, "If-None-Match %r" % if_none_match
+
+TESTS = [
+    ("Parsing Accept-Encoding", check_parse_accept_encoding),
+    ("Negotiating a coding", check_negotiate),
+    ("Compressing", check_compress),
+    ("Entity tags", check_entity_tags),
+    ("Matching entity tags", check_entity_tag_matches)
+]
+
+def main():
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        try:
+            test()
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import copy
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import engine
+import policies
+
+import fuzz_engine
+
+from test_state_hash import test_case_game
+
+"""
+Checks how the bots score games
+
+Rollouts are scored with policies.evaluate, which has to use a finished
+round's stored points rather than whatever the next round's hands and feet
+come to. The round ends come from the test cases next to this script.
+
+    python test_policies.py
+"""
+
+TEST_CASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def points_json(game, current_round):
+    return [game_player.points[current_round].to_json() for game_player in game.players]
+
+def round_total(points_json):
+    return sum(points_json.values())
+
+def round_ends(test_case_path):
+    # The game right after each action that ended a round, the round, and
+    # the type of the action
+    with open(test_case_path, "r") as test_case_file:
+        test_case = json.load(test_case_file)
+
+    game = test_case_game(test_case)
+
+    for action_json in test_case["actions"]:
+        current_round = game.round
+        if not fuzz_engine.apply_action_json(game, action_json):
+            break
+
+        if game.round != current_round:
+            yield (game, current_round, action_json["type"])
+
+#
+# Tests
+#
+
+def check_finished_round():
+    ending_action_types = set()
+
+    for file_name in sorted(os.listdir(TEST_CASE_DIR)):
+        if not file_name.endswith(".json"):
+            continue
+
+        for (game, finished_round, action_type) in round_ends(os.path.join(TEST_CASE_DIR, file_name)):
+            stored_points = copy.deepcopy(points_json(game, finished_round))
+
+            for (seat, player) in enumerate(game.players):
+                score = policies.evaluate(game, player, finished_round)
+
+                assert points_json(game, finished_round) == stored_points, "%s: %s round points changed" % (file_name, finished_round.value)
+
+                opponent_totals = [round_total(points) for (other_seat, points) in enumerate(stored_points) if other_seat != seat]
+                expected_score = round_total(stored_points[seat]) - max(opponent_totals)
+                assert score == expected_score, "%s: scored %d instead of %d" % (file_name, score, expected_score)
+
+            ending_action_types.add(action_type)
+
+    # Going out by discarding, and running out of cards
+    assert ending_action_types == set(["discard_card", "draw_from_deck"]), "Rounds only ended by %r" % sorted(ending_action_types)
+
+def check_round_in_progress():
+    # Mid round, the points are worked out from the cards as they are
+    (case, game) = fuzz_engine.generate_case(0, {"max_actions": 60, "near_legal_rate": 0.0})
+    current_round = game.round
+    player = game.players[0]
+
+    score = policies.evaluate(game, player, current_round)
+
+    for game_player in game.players:
+        expected_points = copy.deepcopy(game_player.points[current_round].to_json())
+        game_player.calculate_points(current_round)
+        assert game_player.points[current_round].to_json() == expected_points, "Points not brought up to date"
+
+    totals = [round_total(game_player.points[current_round].to_json()) for game_player in game.players]
+    assert score == totals[0] - max(totals[1:]), "Scored %d" % score
+
+TESTS = [
+    ("Finished round", check_finished_round),
+    ("Round in progress", check_round_in_progress)
+]
+
+def main():
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        try:
+            test()
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import rate_limiting
+
+"""
+Checks the token buckets and admission control
+
+The buckets read the clock through the time module, which is swapped for
+one that only moves when a test moves it, so every refill and retry time
+can be checked exactly.
+
+    python test_rate_limiting.py
+"""
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class UnreachableStore(object):
+
+    def __init__(self):
+        self.reachable = False
+        self.take_count = 0
+
+    def take(self, key, limit):
+        self.take_count += 1
+        if not self.reachable:
+            raise ConnectionError("Connection refused")
+
+        return 0.0
+
+class RecordingLogger(object):
+
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+def assert_close(actual, expected, description):
+    assert abs(actual - expected) < 1e-9, "%s: %r instead of %r" % (description, actual, expected)
+
+#
+# Tests
+#
+
+def check_bucket(clock):
+    store = rate_limiting.MemoryBucketStore()
+    limit = rate_limiting.Limit(2.0, 3)
+
+    # A new bucket starts full, so the burst goes through
+    for i in range(0, 3):
+        assert_close(store.take("user:1", limit), 0.0, "Take %d of the burst" % i)
+
+    # Then a token comes every half second
+    assert_close(store.take("user:1", limit), 0.5, "Empty bucket")
+    clock.advance(0.25)
+    assert_close(store.take("user:1", limit), 0.25, "Half refilled bucket")
+    clock.advance(0.25)
+    assert_close(store.take("user:1", limit), 0.0, "Refilled bucket")
+
+    # Other keys have their own buckets
+    assert_close(store.take("user:2", limit), 0.0, "Other bucket")
+
+    # Refills stop at the burst
+    clock.advance(60.0)
+    for i in range(0, 3):
+        assert_close(store.take("user:1", limit), 0.0, "Take %d after a long wait" % i)
+    assert store.take("user:1", limit) > 0.0, "Bucket filled past its burst"
+
+def check_least_recently_used(clock):
+    store = rate_limiting.MemoryBucketStore(max_buckets=2)
+    limit = rate_limiting.Limit(1.0, 1)
+
+    store.take("a", limit)
+    store.take("b", limit)
+    assert store.take("a", limit) > 0.0, "Bucket a dropped too soon"
+
+    # b is now the least recently used, so c pushes it out and it starts
+    # full again
+    store.take("c", limit)
+    assert list(store.buckets.keys()) == ["a", "c"], "Kept %r" % list(store.buckets.keys())
+    assert_close(store.take("b", limit), 0.0, "Dropped bucket")
+
+def check_fallback(clock):
+    shared_store = UnreachableStore()
+    fallback_store = rate_limiting.FallbackBucketStore(shared_store, rate_limiting.MemoryBucketStore(), retry_seconds=10.0)
+    fallback_store.logger = RecordingLogger()
+    limit = rate_limiting.Limit(1.0, 1)
+
+    # The local buckets stand in, and the shared store isn't tried again
+    # until the retry time is up
+    assert_close(fallback_store.take("user:1", limit), 0.0, "First take while unreachable")
+    assert fallback_store.take("user:1", limit) > 0.0, "Local bucket didn't limit"
+    assert shared_store.take_count == 1, "Tried the shared store %d times" % shared_store.take_count
+
+    clock.advance(10.0)
+    fallback_store.take("user:1", limit)
+    assert shared_store.take_count == 2, "Didn't retry the shared store"
+    assert len(fallback_store.logger.warnings) == 1, "Warned %d times for one outage" % len(fallback_store.logger.warnings)
+
+    shared_store.reachable = True
+    clock.advance(10.0)
+    fallback_store.take("user:1", limit)
+    fallback_store.take("user:1", limit)
+    assert (shared_store.take_count, fallback_store.failed_at) == (4, None), "Didn't go back to the shared store"
+
+def check_rate_order(clock):
+    limits = {"user": rate_limiting.Limit(1.0, 2), "game": rate_limiting.Limit(1.0, 3)}
+    admission_control = rate_limiting.AdmissionControl(rate_limiting.MemoryBucketStore(), limits, {})
+
+    # A user over their own limit is turned away before touching the game's
+    # bucket, so the other player still gets the game's last token
+    for _ in range(0, 2):
+        assert admission_control.check_rates("add_action", [("user", 1), ("game", 7)]) is None, "Turned away within the limits"
+
+    rejection = admission_control.check_rates("add_action", [("user", 1), ("game", 7)])
+    assert (rejection is not None) and (rejection.reason == "user_rate"), "Not turned away by the user's limit"
+    assert admission_control.check_rates("add_action", [("user", 2), ("game", 7)]) is None, "User's rejection took the game's token"
+
+    rejection = admission_control.check_rates("add_action", [("user", 3), ("game", 7)])
+    assert (rejection is not None) and (rejection.reason == "game_rate"), "Not turned away by the game's limit"
+
+    # Kinds without a limit aren't limited
+    for _ in range(0, 10):
+        assert admission_control.check_rates("add_action", [("ip", "10.0.0.1")]) is None, "Limited a kind without a limit"
+
+    rendered = admission_control.render()
+    for reason in ["user_rate", "game_rate"]:
+        line = "handandfoot_admission_rejections_total{endpoint=\"add_action\",reason=\"%s\"} 1" % reason
+        assert line in rendered.split("\n"), "No %r in %r" % (line, rendered)
+
+def check_concurrency(clock):
+    admission_control = rate_limiting.AdmissionControl(rate_limiting.MemoryBucketStore(), {}, {"view": 2})
+
+    assert admission_control.enter("view") is None, "First replay turned away"
+    assert admission_control.enter("view") is None, "Second replay turned away"
+
+    rejection = admission_control.enter("view")
+    assert (rejection is not None) and (rejection.reason == "concurrency"), "Third replay let in"
+
+    admission_control.leave("view")
+    assert admission_control.enter("view") is None, "Replay turned away after one left"
+
+    # Endpoints without a cap are always let in
+    for _ in range(0, 10):
+        assert admission_control.enter("sync") is None, "Uncapped endpoint turned away"
+        admission_control.leave("sync")
+
+def check_retry_after_header(clock):
+    for (retry_after, header) in [(0.01, "1"), (0.5, "1"), (1.0, "1"), (1.01, "2"), (2.5, "3")]:
+        actual_header = rate_limiting.Rejection("user_rate", retry_after).retry_after_header
+        assert actual_header == header, "Retry-After %r for %r" % (actual_header, retry_after)
+
+TESTS = [
+    ("Bucket", check_bucket),
+    ("Least recently used buckets", check_least_recently_used),
+    ("Fallback store", check_fallback),
+    ("Rate order", check_rate_order),
+    ("Concurrency", check_concurrency),
+    ("Retry-After header", check_retry_after_header)
+]
+
+def main():
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        clock = FakeClock()
+        rate_limiting.time = clock
+
+        try:
+            test(clock)
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import datetime
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import serialization
+
+"""
+Checks response encoding with cached fragments
+
+A response with its rows spliced in from the fragment cache has to be the
+same bytes as one encoded whole, with every backend that's installed.
+
+    python test_serialization.py
+"""
+
+class Row(object):
+
+    def __init__(self, id, name, last_updated):
+        self.id = id
+        self.name = name
+        self.last_updated = last_updated
+
+    def to_json(self):
+        return {"id": self.id, "name": self.name, "last_updated": self.last_updated}
+
+def made_up_rows(count):
+    start = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    return [Row(i, "Player %d éè \"quoted\"" % i, start + datetime.timedelta(minutes=i)) for i in range(0, count)]
+
+#
+# Tests
+#
+
+def check_fragments_match(backend_name):
+    encoder = serialization.Encoder(backend_name)
+    cache = serialization.FragmentCache(encoder)
+    rows = made_up_rows(20)
+
+    responses = [
+        lambda rows_json: {"users": rows_json, "success": True, "count": len(rows_json)},
+        lambda rows_json: {"user": rows_json[0], "games": rows_json[1:], "empty": [], "nested": {"a": [1, 2]}},
+        lambda rows_json: {"mixed": [rows_json[0], 7, "x", None], "last_updated": rows[0].last_updated}
+    ]
+
+    for make_response in responses:
+        whole = encoder.encode(make_response([row.to_json() for row in rows]))
+        spliced = encoder.encode(make_response([cache.fragment(row, row.last_updated) for row in rows]))
+
+        assert spliced == whole, "%s spliced %r instead of %r" % (backend_name, spliced[:80], whole[:80])
+
+    # Dates go out as HTTP dates, like flask.jsonify's
+    rows_json = [row.to_json() for row in rows[:1]]
+    assert json.loads(encoder.encode({"users": rows_json}))["users"][0]["last_updated"] == "Thu, 01 Jan 2026 00:00:00 GMT", "Dates aren't HTTP dates"
+
+    # Only objects are spliced into, so anything else is encoded as it is
+    assert encoder.encode([1, {"b": 2, "a": 1}]) == b'[1,{"a":1,"b":2}]', "Top level list encoded differently"
+
+def check_backends_agree():
+    rows_json = [row.to_json() for row in made_up_rows(5)]
+    decoded = [json.loads(serialization.Encoder(backend_name).encode({"users": rows_json})) for backend_name in serialization.BACKENDS]
+
+    assert all(other == decoded[0] for other in decoded[1:]), "Backends decode differently"
+
+def check_cache():
+    encoder = serialization.Encoder("json")
+    rows = made_up_rows(10)
+    fragment_size = len(encoder.encode_value(rows[0].to_json()))
+    cache = serialization.FragmentCache(encoder, max_bytes=fragment_size * 4)
+
+    first_fragment = cache.fragment(rows[0], 1)
+    assert cache.fragment(rows[0], 1) is first_fragment, "Same version encoded again"
+    assert (cache.hits, cache.misses) == (1, 1), "Counted %d hits and %d misses" % (cache.hits, cache.misses)
+
+    # A new version is a new fragment
+    rows[0].name = "Renamed"
+    assert b"Renamed" in cache.fragment(rows[0], 2).encoded, "Old version served for a new one"
+
+    # Fragments past the size limit push out the least recently used
+    cache.fragment(rows[0], 1)
+    for row in rows[1:]:
+        cache.fragment(row, 1)
+        assert cache.size <= cache.max_bytes, "Cache grew to %d bytes" % cache.size
+
+    assert cache.size == sum(len(fragment.encoded) for fragment in cache.fragments.values()), "Size doesn't add up"
+    assert ("Row", 9, 1) in cache.fragments, "Newest fragment dropped"
+    assert ("Row", 0, 2) not in cache.fragments, "Oldest fragment kept"
+
+TESTS = [("Fragments with the %s backend" % backend_name, (lambda backend_name=backend_name: check_fragments_match(backend_name))) for backend_name in sorted(serialization.BACKENDS)]
+TESTS += [
+    ("Backends agree", check_backends_agree),
+    ("Fragment cache", check_cache)
+]
+
+def main():
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        try:
+            test()
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import engine
+
+import fuzz_engine
+
+"""
+Checks the incremental state hash
+
+Game.state_hash is kept up to date piece by piece as cards move. This plays
+every test case, and some random games made the same way as fuzz cases, and
+after each action compares the game's hash with one worked out from scratch,
+by rebuilding the game from a snapshot of it.
+
+    python test_state_hash.py [<RANDOM_GAME_COUNT>] [<TEST_CASE_PATH | TEST_CASE_DIR> ...]
+
+With no test cases given, the ones next to this script are used.
+"""
+
+DEFAULT_RANDOM_GAME_COUNT = 50
+
+def recomputed_state_hash(game):
+    return engine.Game.from_snapshot_json(game.to_snapshot_json()).state_hash
+
+def first_mismatch(game, actions_json):
+    # The index of the first action after which the hashes differ, -1 if it's
+    # the starting state, or None if they always agree
+    if game.state_hash != recomputed_state_hash(game):
+        return -1
+
+    for (index, action_json) in enumerate(actions_json):
+        if not fuzz_engine.apply_action_json(game, action_json):
+            break
+
+        if game.state_hash != recomputed_state_hash(game):
+            return index
+
+    return None
+
+def test_case_game(test_case):
+    decks = {current_round: engine.Deck.from_json(test_case[fuzz_engine.DECK_KEYS[current_round]]) for current_round in fuzz_engine.ROUNDS}
+
+    rules_json = test_case.get("rules")
+    rules = engine.RuleSet.from_json(rules_json) if rules_json is not None else None
+
+    return engine.Game(test_case["players"], decks, None, rules)
+
+def check_test_case(test_case_path):
+    with open(test_case_path, "r") as test_case_file:
+        test_case = json.load(test_case_file)
+
+    return first_mismatch(test_case_game(test_case), test_case["actions"])
+
+def check_random_game(seed):
+    (case, _) = fuzz_engine.generate_case(seed, fuzz_engine.DEFAULT_SETTINGS)
+    return first_mismatch(case.start_game(), case.actions_json)
+
+def test_case_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for file_name in sorted(os.listdir(path)):
+                if file_name.endswith(".json"):
+                    yield os.path.join(path, file_name)
+        else:
+            yield path
+
+def main(random_game_count, paths):
+    results = []
+
+    for test_case_path in test_case_paths(paths):
+        results.append((test_case_path, check_test_case(test_case_path)))
+
+    for seed in range(0, random_game_count):
+        results.append(("Random game %d" % seed, check_random_game(seed)))
+
+    failed_tests = [result for result in results if result[1] is not None]
+
+    plural = "" if len(results) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(results), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, index) in failed_tests:
+            print("\t%s (hashes differ after action %d)" % (name, index))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    random_game_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RANDOM_GAME_COUNT
+    paths = sys.argv[2:] if len(sys.argv) > 2 else [os.path.dirname(os.path.abspath(__file__))]
+
+    main(random_game_count, paths)
@@ -0,0 +1,114 @@
+import bisect
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import tournaments
+
+"""
+Checks the tournament helpers that don't need a database
+
+RankedSet is checked against a sorted list put through the same random adds
+and removes, and table_sizes and seat_entrants against every entrant count
+and table size a tournament can have. Run it from the backend directory like
+the app, since tournaments imports models, which reads secrets.yaml:
+
+    python ../tests/test_tournaments.py
+"""
+
+def check_ranked_set(seed, operation_count=2000):
+    generator = random.Random(seed)
+    ranked_set = tournaments.RankedSet(seed)
+    reference = []
+
+    for _ in range(0, operation_count):
+        if (len(reference) > 0) and (generator.random() < 0.4):
+            key = generator.choice(reference)
+            ranked_set.remove(key)
+            reference.remove(key)
+        else:
+            # Keys shaped like standings, with plenty of ties on points
+            key = tournaments.standing_key(generator.randint(0, 50) * 10, generator.randint(0, 100000))
+            if key in reference:
+                continue
+
+            ranked_set.add(key)
+            bisect.insort(reference, key)
+
+        assert len(ranked_set) == len(reference), "Size %d instead of %d" % (len(ranked_set), len(reference))
+
+        probe = tournaments.standing_key(generator.randint(0, 50) * 10, generator.randint(0, 100000))
+        count_below = ranked_set.count_below(probe)
+        assert count_below == bisect.bisect_left(reference, probe), "%d keys below %r instead of %d" % (count_below, probe, bisect.bisect_left(reference, probe))
+
+        if len(reference) > 0:
+            index = generator.randrange(0, len(reference))
+            assert ranked_set.key_at(index) == reference[index], "%r at %d instead of %r" % (ranked_set.key_at(index), index, reference[index])
+
+    assert [ranked_set.key_at(index) for index in range(0, len(reference))] == reference, "Keys out of order"
+
+    try:
+        ranked_set.key_at(len(reference))
+    except IndexError:
+        pass
+    else:
+        raise AssertionError("No IndexError past the last key")
+
+def check_table_sizes():
+    for table_size in range(tournaments.MIN_TABLE_SIZE, tournaments.MAX_TABLE_SIZE + 1):
+        for entrant_count in range(tournaments.MIN_TABLE_SIZE, 200):
+            sizes = tournaments.table_sizes(entrant_count, table_size)
+            description = "%d entrants %d to a table: %r" % (entrant_count, table_size, sizes)
+
+            assert sum(sizes) == entrant_count, description
+            assert max(sizes) - min(sizes) <= 1, description
+            assert min(sizes) >= tournaments.MIN_TABLE_SIZE, description
+
+            # The one case creating a tournament turns down
+            if (table_size == 2) and (entrant_count % 2 == 1):
+                assert sizes[0] == 3, description
+            else:
+                assert max(sizes) <= table_size, description
+                assert len(sizes) == -(-entrant_count // table_size), description
+
+def check_seat_entrants():
+    generator = random.Random(0)
+
+    for entrant_count in range(tournaments.MIN_TABLE_SIZE, 60):
+        entrants = list(range(0, entrant_count))
+        tables = tournaments.seat_entrants(list(entrants), 4, generator)
+
+        # Tables take entrants in order, so each table is a run of standings
+        assert [len(table) for table in tables] == tournaments.table_sizes(entrant_count, 4), "%d entrants" % entrant_count
+        assert sum([sorted(table) for table in tables], []) == entrants, "%d entrants" % entrant_count
+
+TESTS = [("Ranked set, seed %d" % seed, (lambda seed=seed: check_ranked_set(seed))) for seed in range(0, 10)]
+TESTS += [
+    ("Table sizes", check_table_sizes),
+    ("Seating", check_seat_entrants)
+]
+
+def main():
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        try:
+            test()
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+import random
+import sys
+
+import peewee
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import models
+
+from models import User
+from models import UserSearchTerm
+
+"""
+Checks user search on a scratch database
+
+Made up users, with repeated words, LIKE wildcards and odd spacing and case
+in their names, are indexed on a scratch SQLite database, and every search
+is compared with the same search done in Python over every user's terms:
+each user once, by their first matching term, then by ID, a page at a time.
+Run it from the backend directory like the app, since models reads
+secrets.yaml:
+
+    python ../tests/test_user_search.py
+"""
+
+WORDS = ["Ann", "Anne", "anna", "Annabel", "Bo", "Bob", "BOBBY", "Lee", "Leeds", "O'Neil", "100%", "10_0", "a_b", "a%b", "Straße", "STRASSE", "Zoë"]
+
+PAGE_SIZE = 7
+
+def use_scratch_database():
+    database = peewee.SqliteDatabase(":memory:", pragmas={"case_sensitive_like": "on"})
+    database.bind([User, UserSearchTerm])
+    models.db = database
+    database.create_tables([User, UserSearchTerm])
+
+def made_up_name(generator):
+    words = [generator.choice(WORDS) for _ in range(0, generator.randint(1, 3))]
+    spaces = lambda: " " * generator.randint(1, 2)
+    return spaces().join(words)
+
+def create_users(generator, user_count):
+    user_rows = [{"email": "user%d@handandfoot" % i, "first_name": made_up_name(generator), "last_name": made_up_name(generator), "password_hash": ""} for i in range(0, user_count)]
+
+    for rows in peewee.chunked(user_rows, 100):
+        User.insert_many(rows).execute()
+
+    UserSearchTerm.index_all_users(batch_size=50)
+
+def expected_user_ids(search_term, excluded_user_id=None):
+    prefix = models.search_normal_form(search_term)
+    if len(prefix) == 0:
+        return []
+
+    first_matches = []
+    for user in User.select():
+        if user.id == excluded_user_id:
+            continue
+
+        matching_terms = [term for term in UserSearchTerm.terms_for_user(user) if term.startswith(prefix)]
+        if len(matching_terms) > 0:
+            first_matches.append((min(matching_terms), user.id))
+
+    return [user_id for (_, user_id) in sorted(first_matches)]
+
+def searched_user_ids(search_term, excluded_user_id=None):
+    # Every page, until one comes back short
+    user_ids = []
+
+    while True:
+        page = UserSearchTerm.search(search_term, excluded_user_id, len(user_ids), PAGE_SIZE)
+        user_ids += [user.id for user in page]
+
+        if len(page) < PAGE_SIZE:
+            return user_ids
+
+def search_terms(generator):
+    # Every prefix of some names as they'd be typed, and some whole words in
+    # other cases, spacing and with wildcards that mustn't match anything
+    terms = []
+
+    for user in User.select().order_by(User.id).limit(15):
+        full_name = user.first_name + " " + user.last_name
+        terms += [full_name[:length] for length in range(1, len(full_name) + 1)]
+
+    terms += [word.upper() for word in WORDS] + ["  " + word.lower() + "  " for word in WORDS]
+    terms += ["%", "_", "a%", "a_", "10%", "\\", "''", "   ", "", "strasse", "zoe"]
+
+    generator.shuffle(terms)
+    return terms
+
+#
+# Tests
+#
+
+def check_searches(generator):
+    for search_term in search_terms(generator):
+        expected = expected_user_ids(search_term)
+        searched = searched_user_ids(search_term)
+        assert searched == expected, "%r found %r instead of %r" % (search_term, searched[:10], expected[:10])
+
+def check_excluded_user(generator):
+    for search_term in ["ann", "bo", "lee", "a_b", "100%"]:
+        excluded_user_id = generator.choice(expected_user_ids(search_term))
+        searched = searched_user_ids(search_term, excluded_user_id)
+
+        assert excluded_user_id not in searched, "%r found the excluded user" % search_term
+        assert searched == expected_user_ids(search_term, excluded_user_id), "%r found different users" % search_term
+
+def check_renamed_user(generator):
+    # Reindexing a user replaces their terms rather than adding to them
+    user = User.select().order_by(User.id).first()
+    user.first_name = "Quentin"
+    user.last_name = "Quibble  Quibble"
+    user.save()
+    UserSearchTerm.index_users([user])
+
+    assert UserSearchTerm.select().where(UserSearchTerm.user == user).count() == 3, "Old terms left behind"
+
+    for search_term in ["q", "quibble", "quentin quibble q", "QUIBBLE quibble"]:
+        assert searched_user_ids(search_term) == expected_user_ids(search_term) == [user.id], "%r didn't find the renamed user" % search_term
+
+TESTS = [
+    ("Searches", check_searches),
+    ("Excluded user", check_excluded_user),
+    ("Renamed user", check_renamed_user)
+]
+
+def main():
+    use_scratch_database()
+
+    generator = random.Random(0)
+    create_users(generator, 300)
+
+    failed_tests = []
+
+    for (name, test) in TESTS:
+        try:
+            test(generator)
+        except AssertionError as e:
+            failed_tests.append((name, str(e)))
+
+    plural = "" if len(TESTS) == 1 else "s"
+    print("Failed %d of %d test%s" % (len(failed_tests), len(TESTS), plural))
+
+    if len(failed_tests) > 0:
+        print()
+        print("Failing tests:")
+        for (name, message) in failed_tests:
+            print("\t%s: %s" % (name, message))
+
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()